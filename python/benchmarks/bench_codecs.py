@@ -0,0 +1,169 @@
+"""
+Compares the size of tiny forecasts stored using each of the
+tinylib codecs.
+
+    python benchmarks/bench_codecs.py
+
+The forecasts are derived from data/GFS20131226164503639.grb, a 1 degree
+GFS forecast of 10m winds off eastern Australia (7 daily forecast times
+on a 31 x 46 grid).  Since reading GRIB requires gribapi the decoded
+winds are kept in data/GFS20131226164503639.nc, which is what is read
+here.  Besides the full domain, smaller coastal and spot sized domains
+and a coarser 2 degree grid are cut from it, and the daily times are
+interpolated to 3 hourly times, which is what most requests ask for.
+There is no ensemble in the sample, so a 21 member ensemble is made up
+by adding perturbations (which grow with lead time) to a coastal domain.
+The 'joint' rows quantize wind speed and direction together (see
+to_beaufort's joint_wind argument), their size is shown under speed.
+"""
+import os
+import sys
+import time
+import zlib
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import xray
+
+from sl.lib import tinylib
+from sl.lib import conventions as conv
+
+_fixture = os.path.join(os.path.dirname(__file__), '../../data',
+                        'GFS20131226164503639.nc')
+
+
+def load_fixture(path=_fixture):
+    """
+    Loads the wind forecast that was derived from the sample GRIB.
+    """
+    fcst = xray.open_dataset(path)
+    # the winds are stored as scaled integers, but tinylib expects float32
+    for v in [conv.UWND, conv.VWND]:
+        fcst[v] = (fcst[v].dims, fcst[v].values.astype(np.float32),
+                   fcst[v].attrs)
+    return fcst
+
+
+def three_hourly(fcst):
+    """
+    Linearly interpolates the daily forecast times in fcst to every three
+    hours, which is a rough stand in for the 3 hourly forecasts most of
+    our requests are for.
+    """
+    hours = np.arange(0, 24 * (fcst.dims[conv.TIME] - 1) + 1, 3)
+    days = hours / 24.
+    lower = np.minimum(np.floor(days).astype('int'),
+                       fcst.dims[conv.TIME] - 2)
+    weight = (days - lower)[:, np.newaxis, np.newaxis]
+    times = fcst[conv.TIME].values
+    new_times = times[0] + hours.astype('timedelta64[h]')
+    out = xray.Dataset()
+    out[conv.TIME] = (conv.TIME, new_times, fcst[conv.TIME].attrs)
+    out[conv.LAT] = fcst[conv.LAT]
+    out[conv.LON] = fcst[conv.LON]
+    for v in [conv.UWND, conv.VWND]:
+        values = fcst[v].values
+        interpolated = ((1 - weight) * values[lower] +
+                        weight * values[lower + 1])
+        out[v] = (fcst[v].dims, interpolated.astype(np.float32),
+                  fcst[v].attrs)
+    return out
+
+
+def ensemble(fcst, n_ens=21, seed=1982):
+    """
+    Makes up an ensemble forecast by adding smooth random perturbations,
+    which grow with the forecast lead time, to the winds in fcst.  The
+    first member (the control) is left unperturbed.
+    """
+    rs = np.random.RandomState(seed)
+    n_time = fcst.dims[conv.TIME]
+    y, x = np.mgrid[0:fcst.dims[conv.LAT], 0:fcst.dims[conv.LON]]
+    growth = np.linspace(0.3, 2.5, n_time)[:, np.newaxis, np.newaxis]
+    out = xray.Dataset()
+    for v in [conv.TIME, conv.LAT, conv.LON]:
+        out[v] = fcst[v]
+    out[conv.ENSEMBLE] = (conv.ENSEMBLE, np.arange(n_ens))
+    dims = (conv.TIME, conv.ENSEMBLE, conv.LAT, conv.LON)
+    for v in [conv.UWND, conv.VWND]:
+        values = np.repeat(fcst[v].values[:, np.newaxis], n_ens, axis=1)
+        for i in range(1, n_ens):
+            for _ in range(4):
+                kx, ky = rs.uniform(0.05, 0.3, size=2)
+                phase = rs.uniform(0, 2 * np.pi)
+                values[:, i] += (rs.normal() * growth *
+                                 np.sin(kx * x + ky * y + phase))
+        out[v] = (dims, values.astype(np.float32), fcst[v].attrs)
+    return out
+
+
+def fixtures(fcst):
+    """
+    Yields (name, forecast) pairs of several differently sized
+    forecasts cut from fcst.
+    """
+    yield 'full 31x46', fcst
+    yield '3 hourly', three_hourly(fcst)
+    yield 'coarse 16x23', fcst.isel(**{conv.LAT: slice(None, None, 2),
+                                       conv.LON: slice(None, None, 2)})
+    yield 'coastal 10x10', fcst.isel(**{conv.LAT: slice(10, 20),
+                                        conv.LON: slice(20, 30)})
+    yield 'spot 2x2', fcst.isel(**{conv.LAT: slice(10, 12),
+                                   conv.LON: slice(20, 22)})
+    yield 'ensemble 21x', ensemble(fcst.isel(**{conv.LAT: slice(10, 20),
+                                                conv.LON: slice(20, 30)}))
+
+
+def field_sizes(fcst, codec):
+    """
+    Returns the size in bytes of each binned variable in fcst when
+    stored with codec.  The 'raw' sizes include the zlib compression
+    that is applied to the entire payload.
+    """
+    fields = tinylib._beaufort_fields(fcst)
+    if codec == 'joint':
+        fields = tinylib._joint_wind_fields(fields)
+        codec = 'range'
+    sizes = {}
+    for vname, values in fields.iteritems():
+        encoded = tinylib._encode_field(vname, values, codec)
+        if codec == 'raw':
+            encoded = zlib.compress(encoded, 9)
+        sizes[vname] = len(encoded)
+    return sizes
+
+
+def main():
+    fcst = load_fixture()
+    fmt = '%-15s %-10s %8s %8s %8s %10s %10s'
+    print fmt % ('forecast', 'codec', 'payload', 'speed', 'dir',
+                 'encode', 'decode')
+    for name, sub in fixtures(fcst):
+        payloads = {}
+        for codec in ['raw', 'range', 'delta', 'ensemble', 'joint']:
+            if codec == 'joint':
+                kwargs = {'joint_wind': True}
+            else:
+                kwargs = {'codec': codec}
+            start = time.time()
+            payload = tinylib.to_beaufort(sub.copy(deep=True), **kwargs)
+            encode_time = time.time() - start
+            start = time.time()
+            tinylib.from_beaufort(payload)
+            decode_time = time.time() - start
+            sizes = field_sizes(sub.copy(deep=True), codec)
+            payloads[codec] = len(payload)
+            print fmt % (name, codec,
+                         '%d' % len(payload),
+                         sizes.get(conv.WIND_SPEED, sizes.get(conv.WIND)),
+                         sizes.get(conv.WIND_DIR, '-'),
+                         '%.3fs' % encode_time,
+                         '%.3fs' % decode_time)
+        best = min(payloads, key=payloads.get)
+        saving = 100. * (payloads['raw'] - payloads[best]) / payloads['raw']
+        print fmt % ('', 'saving', '%.0f%%' % saving, '(%s)' % best,
+                     '', '', '')
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,114 @@
+"""
+Benchmarks tinylib.pack_ints / unpack_ints against the original element
+by element implementation they replaced.
+
+    python benchmarks/bench_pack.py [--max-reference 100000]
+
+The reference implementation loops in python, so by default it is only
+timed on grids up to --max-reference cells and its time on larger grids
+is extrapolated linearly (these rows are marked with a '~').  The
+reference implementation only handled widths which divide 8, the
+other widths are timed without a reference.
+"""
+import os
+import sys
+import time
+import argparse
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+from sl.lib import tinylib
+
+
+def reference_pack_ints(arr, req_bits):
+    """
+    The python loop that pack_ints used to be.
+    """
+    vals_per_int = 8 // req_bits
+    packed_size = int(np.ceil(float(arr.size) * req_bits / 8))
+    output = np.zeros(shape=(packed_size,), dtype=np.uint8)
+    for i, x in enumerate(arr.flatten()):
+        ind = i // vals_per_int
+        if np.mod(i, vals_per_int):
+            output[ind] = output[ind] << req_bits
+        output[ind] += x
+    return output.tostring()
+
+
+def reference_unpack_ints(packed_array, bits, shape):
+    """
+    The generator based loop that unpack_ints used to be.
+    """
+    packed_array = np.fromstring(packed_array, dtype=np.uint8)
+    vals_per_int = 8 // bits
+    size = int(np.prod(shape))
+    masks = [(2 ** bits - 1) << i * bits for i in range(vals_per_int)]
+
+    def iter_vals():
+        cnt = 0
+        for x in packed_array:
+            nvals = min(size - cnt, vals_per_int)
+            reversed_vals = [(x & y) >> j * bits for j, y in enumerate(masks)]
+            for v in reversed(reversed_vals[:nvals]):
+                yield v
+            cnt += nvals
+    return np.array([x for x in iter_vals()]).reshape(shape)
+
+
+def timed(func, *args):
+    start = time.time()
+    ret = func(*args)
+    return ret, time.time() - start
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--max-reference', type=int, default=100000,
+                        help="largest grid the reference loop is run on")
+    parser.add_argument('--sizes', type=int, nargs='+',
+                        default=[10 ** 4, 10 ** 5, 10 ** 6, 10 ** 7])
+    args = parser.parse_args(argv)
+
+    np.random.seed(1982)
+    fmt = '%5s %10s %12s %12s %12s %12s %9s'
+    print fmt % ('bits', 'cells', 'ref pack', 'pack', 'ref unpack',
+                 'unpack', 'speedup')
+    for bits in [1, 2, 3, 4, 5, 6, 7, 9, 12, 16]:
+        for size in args.sizes:
+            arr = np.random.randint(2 ** bits, size=size)
+            packed, pack_time = timed(tinylib.pack_ints, arr, bits)
+            unpacked, unpack_time = timed(tinylib.unpack_ints,
+                                          packed['packed_array'], bits,
+                                          arr.shape)
+            assert np.all(unpacked == arr)
+
+            if 8 % bits:
+                print fmt % (bits, size, '-', '%.4fs' % pack_time,
+                             '-', '%.4fs' % unpack_time, '-')
+                continue
+            elif size <= args.max_reference:
+                ref, ref_pack = timed(reference_pack_ints, arr, bits)
+                assert ref == packed['packed_array']
+                _, ref_unpack = timed(reference_unpack_ints, ref, bits,
+                                      arr.shape)
+                mark = ''
+            else:
+                # the reference implementation is linear in the grid size
+                ref_arr = arr[:args.max_reference]
+                _, ref_pack = timed(reference_pack_ints, ref_arr, bits)
+                ref = reference_pack_ints(ref_arr, bits)
+                _, ref_unpack = timed(reference_unpack_ints, ref, bits,
+                                      ref_arr.shape)
+                ref_pack *= float(size) / args.max_reference
+                ref_unpack *= float(size) / args.max_reference
+                mark = '~'
+            speedup = (ref_pack + ref_unpack) / (pack_time + unpack_time)
+            print fmt % (bits, size,
+                         '%s%.4fs' % (mark, ref_pack), '%.4fs' % pack_time,
+                         '%s%.4fs' % (mark, ref_unpack), '%.4fs' % unpack_time,
+                         '%s%.0fx' % (mark, speedup))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,321 @@
+"""
+Measures the size, speed, memory use and reconstruction error of tiny
+forecasts across a grid of forecasts and to_beaufort options.
+
+    python benchmarks/bench_suite.py [--output results.json]
+                                     [--baseline baseline.json]
+
+Each forecast is encoded with each configuration (a set of to_beaufort
+arguments, see _configs) and decoded with from_beaufort, recording
+
+    bytes           the size of the payload
+    encode_ms       the fastest of --repeat to_beaufort calls
+    decode_ms       the fastest of --repeat from_beaufort calls
+    peak_kb         the peak memory used while encoding and decoding
+    wind_rms        the rms vector wind error (m/s)
+    pressure_rms    the rms pressure error (Pa)
+    precip_rms      the rms precipitation error (mm/hr)
+    beaufort_miss   the fraction of winds decoded with the wrong force
+    compass_miss    the fraction of winds decoded on the wrong one of
+                    the 16 compass points
+
+The forecasts are those of bench_codecs (cut from the sample GFS
+forecast) plus synthetic forecasts, holding winds, pressure and
+precipitation, of each combination of --sizes, --hours and --members
+(0 members being a deterministic forecast).  Each case is run in a
+forked process so the peak memory of one doesn't hide that of another
+(where there is no fork peak_kb is left out).
+
+--output writes the results as json, which can later be passed as
+--baseline to flag any case which has grown larger, slower, hungrier or
+less accurate than the baseline by more than the given tolerances, in
+which case the exit status is 1.
+
+baseline.json, next to this file, holds the results of a default run.
+Timings and memory vary from machine to machine, so elsewhere only
+compare the sizes and errors,
+
+    python benchmarks/bench_suite.py --baseline benchmarks/baseline.json \
+        --time-tolerance inf --memory-tolerance inf
+
+and regenerate it, from a default run, whenever a change is meant to
+alter the payloads,
+
+    python benchmarks/bench_suite.py --output benchmarks/baseline.json
+"""
+import os
+import sys
+import json
+import time
+import argparse
+import datetime
+import resource
+import traceback
+import numpy as np
+
+from collections import OrderedDict
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+
+import xray
+
+from sl.lib import tinylib
+from sl.lib import conventions as conv
+
+import bench_codecs
+
+# the to_beaufort arguments used by each configuration
+_configs = OrderedDict([('raw', {'codec': 'raw'}),
+                        ('range', {'codec': 'range'}),
+                        ('delta', {'codec': 'delta'}),
+                        ('ensemble', {'codec': 'ensemble'}),
+                        ('sparse', {'codec': 'sparse'}),
+                        ('indexed', {'indexed': True}),
+                        ('adaptive', {'adaptive': True}),
+                        ('joint', {'joint_wind': True}),
+                        ('progressive', {'progressive': 4.})])
+# the metrics compared with a baseline, and the tolerance each uses
+_metrics = OrderedDict([('bytes', 'size'),
+                        ('encode_ms', 'time'),
+                        ('decode_ms', 'time'),
+                        ('peak_kb', 'memory'),
+                        ('wind_rms', 'error'),
+                        ('pressure_rms', 'error'),
+                        ('precip_rms', 'error'),
+                        ('beaufort_miss', 'error'),
+                        ('compass_miss', 'error')])
+
+
+def synthetic(n_lat, n_lon, hours, n_ens=0, seed=1982):
+    """
+    Makes up a half degree forecast of 3 hourly winds, pressure and
+    precipitation out to 'hours', built from smooth travelling waves so
+    it compresses roughly like a real forecast would.
+    """
+    rs = np.random.RandomState(seed)
+    out = xray.Dataset()
+    out[conv.TIME] = (conv.TIME, np.arange(0, hours + 1, 3),
+                      {conv.UNITS: 'hours since 2014-01-01 00:00:00'})
+    out[conv.LAT] = (conv.LAT, -10. - 0.5 * np.arange(n_lat),
+                     {conv.UNITS: 'degrees north'})
+    out[conv.LON] = (conv.LON, 150. + 0.5 * np.arange(n_lon),
+                     {conv.UNITS: 'degrees east'})
+    dims = (conv.TIME, conv.LAT, conv.LON)
+    if n_ens:
+        out[conv.ENSEMBLE] = (conv.ENSEMBLE, np.arange(n_ens))
+        dims = (conv.TIME, conv.ENSEMBLE, conv.LAT, conv.LON)
+    shape = tuple(out.dims[d] for d in dims)
+    t, y, x = np.meshgrid(out[conv.TIME].values / 24., np.arange(n_lat),
+                          np.arange(n_lon), indexing='ij')
+
+    def waves(n, scale):
+        field = np.zeros(t.shape)
+        for _ in range(n):
+            kx, ky = rs.uniform(0.02, 0.2, size=2)
+            speed, phase = rs.uniform(0.5, 2.), rs.uniform(0, 2 * np.pi)
+            field += scale * np.sin(kx * x + ky * y - speed * t + phase)
+        if n_ens:
+            field = np.repeat(field[:, np.newaxis], n_ens, axis=1)
+            # the members drift apart with lead time
+            spread = np.linspace(0., 0.3, t.shape[0])
+            noise = rs.normal(size=shape)
+            field += (scale * spread[:, np.newaxis, np.newaxis, np.newaxis] *
+                      noise)
+        return field
+    fields = [(conv.UWND, 5. + waves(4, 3.), 'm/s'),
+              (conv.VWND, waves(4, 3.), 'm/s'),
+              (conv.PRESSURE, 101300. + waves(3, 800.), 'Pa'),
+              (conv.PRECIP, np.maximum(waves(3, 1.) - 1., 0.) / 3600.,
+               'kg.m-2.s-1')]
+    for vname, values, units in fields:
+        out[vname] = (dims, values.astype(np.float32), {conv.UNITS: units})
+    return out
+
+
+def forecasts(args):
+    """
+    Yields (name, forecast) pairs of each forecast that is benchmarked.
+    """
+    for name, fcst in bench_codecs.fixtures(bench_codecs.load_fixture()):
+        yield name, fcst
+    for size in args.sizes:
+        for hours in args.hours:
+            for members in args.members:
+                name = 'synth %dx%d %dh' % (size, size, hours)
+                if members:
+                    name = '%s %dx' % (name, members)
+                yield name, synthetic(size, size, hours, members)
+
+
+def wind_bins(uwnd, vwnd):
+    """
+    Returns the beaufort force and 16 point compass bins of winds.
+    """
+    speed = np.sqrt(uwnd ** 2 + vwnd ** 2)
+    direction = np.arctan2(uwnd, vwnd)
+    return (tinylib.bin_array(speed, tinylib._beaufort_scale),
+            tinylib.bin_array(direction, tinylib._direction_bins, wrap=True))
+
+
+def rms(x):
+    return float(np.sqrt(np.nanmean(np.square(x))))
+
+
+def measure(fcst, kwargs, repeat):
+    """
+    Encodes and decodes fcst using to_beaufort(**kwargs), returning a
+    dictionary of the metrics (other than the peak memory).
+    """
+    encode_times = []
+    for _ in range(repeat):
+        start = time.time()
+        payload = tinylib.to_beaufort(fcst.copy(deep=True), **kwargs)
+        encode_times.append(time.time() - start)
+    decode_times = []
+    for _ in range(repeat):
+        start = time.time()
+        decoded = tinylib.from_beaufort(payload)
+        decode_times.append(time.time() - start)
+    result = {'bytes': len(payload),
+              'encode_ms': 1000. * min(encode_times),
+              'decode_ms': 1000. * min(decode_times)}
+    uwnd, vwnd = fcst[conv.UWND].values, fcst[conv.VWND].values
+    du = decoded[conv.UWND].values - uwnd
+    dv = decoded[conv.VWND].values - vwnd
+    result['wind_rms'] = rms(np.sqrt(du ** 2 + dv ** 2))
+    for vname, key, scale in [(conv.PRESSURE, 'pressure_rms', 1.),
+                              (conv.PRECIP, 'precip_rms', 3600.)]:
+        if vname in fcst:
+            error = decoded[vname].values - fcst[vname].values
+            result[key] = scale * rms(error)
+    expected = wind_bins(uwnd, vwnd)
+    actual = wind_bins(decoded[conv.UWND].values, decoded[conv.VWND].values)
+    result['beaufort_miss'] = float(np.mean(expected[0] != actual[0]))
+    result['compass_miss'] = float(np.mean(expected[1] != actual[1]))
+    return result
+
+
+def _peak_kb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # linux reports kilobytes, os x bytes
+    return peak // 1024 if sys.platform == 'darwin' else peak
+
+
+def isolated(func, *args):
+    """
+    Calls func(*args) in a forked process, returning its result (which
+    must be a json serializable dictionary) with the peak memory the
+    call added to that of the process as 'peak_kb'.
+    """
+    if not hasattr(os, 'fork'):
+        return func(*args)
+    read, write = os.pipe()
+    pid = os.fork()
+    if pid == 0:
+        status = 1
+        try:
+            os.close(read)
+            # a forked process starts with the peak memory of its parent
+            start = _peak_kb()
+            result = func(*args)
+            result['peak_kb'] = _peak_kb() - start
+            with os.fdopen(write, 'wb') as f:
+                f.write(json.dumps(result))
+            status = 0
+        except:
+            traceback.print_exc()
+        finally:
+            os._exit(status)
+    os.close(write)
+    with os.fdopen(read, 'rb') as f:
+        output = f.read()
+    _, status = os.waitpid(pid, 0)
+    if status:
+        raise RuntimeError("benchmark process failed")
+    return json.loads(output)
+
+
+def regressions(results, baseline, tolerances):
+    """
+    Yields (forecast, config, metric, baseline, result) for each metric
+    of each result which is worse than that of the matching case in
+    baseline by more than the (relative) tolerance for that metric.
+    """
+    previous = dict(((r['forecast'], r['config']), r)
+                    for r in baseline['results'])
+    for result in results:
+        before = previous.get((result['forecast'], result['config']))
+        if before is None:
+            continue
+        for metric, kind in _metrics.iteritems():
+            if result.get(metric) is None or before.get(metric) is None:
+                continue
+            # errors which were zero shouldn't appear from rounding
+            allowed = before[metric] * (1. + tolerances[kind]) + 1e-9
+            if result[metric] > allowed:
+                yield (result['forecast'], result['config'], metric,
+                       before[metric], result[metric])
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description=__doc__.strip().split('\n')[0])
+    parser.add_argument('--output', help="write the results to this json file")
+    parser.add_argument('--baseline',
+                        help="json results to check for regressions against")
+    parser.add_argument('--configs', nargs='+', choices=_configs.keys(),
+                        default=_configs.keys())
+    parser.add_argument('--sizes', type=int, nargs='+', default=[10, 30])
+    parser.add_argument('--hours', type=int, nargs='+', default=[24, 72])
+    parser.add_argument('--members', type=int, nargs='+', default=[0, 11])
+    parser.add_argument('--repeat', type=int, default=3,
+                        help="timings are the fastest of this many runs")
+    parser.add_argument('--size-tolerance', type=float, default=0.005)
+    parser.add_argument('--error-tolerance', type=float, default=0.01)
+    parser.add_argument('--time-tolerance', type=float, default=0.5)
+    parser.add_argument('--memory-tolerance', type=float, default=0.25)
+    args = parser.parse_args(argv)
+
+    fmt = '%-22s %-11s %8s %9s %9s %9s %8s %7s %7s'
+    print fmt % ('forecast', 'config', 'bytes', 'encode', 'decode', 'peak',
+                 'wind', 'force', 'compass')
+    results = []
+    for name, fcst in forecasts(args):
+        for config in args.configs:
+            result = isolated(measure, fcst, _configs[config], args.repeat)
+            result.update({'forecast': name, 'config': config})
+            results.append(result)
+            peak = result.get('peak_kb')
+            print fmt % (name, config, result['bytes'],
+                         '%.1fms' % result['encode_ms'],
+                         '%.1fms' % result['decode_ms'],
+                         '-' if peak is None else '%dkB' % peak,
+                         '%.2f' % result['wind_rms'],
+                         '%.1f%%' % (100. * result['beaufort_miss']),
+                         '%.1f%%' % (100. * result['compass_miss']))
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'created': datetime.datetime.utcnow().isoformat(),
+                       'python': sys.version.split()[0],
+                       'numpy': np.__version__,
+                       'results': results}, f, indent=1, sort_keys=True)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        tolerances = {'size': args.size_tolerance,
+                      'error': args.error_tolerance,
+                      'time': args.time_tolerance,
+                      'memory': args.memory_tolerance}
+        flagged = list(regressions(results, baseline, tolerances))
+        for forecast, config, metric, before, after in flagged:
+            print 'REGRESSION %s %s %s: %.6g -> %.6g' % (forecast, config,
+                                                         metric, before,
+                                                         after)
+        if flagged:
+            return 1
+        print 'no regressions against %s' % args.baseline
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -9,6 +9,7 @@ VWND = 'vwnd'
 PRECIP = 'precip'
 CLOUD = 'cloud_cover'
 PRESSURE = 'pressure'
+LAND = 'land'
 UNITS = 'units'
 BEARING = 'bearing'
 HEADING = 'heading'
@@ -271,17 +271,22 @@ def set_data(source, grib):
     Sets the actual data of a grib message.
     """
     var_name = get_varible_name(source)
+    values = source[var_name].values
+    # land cells left out of tiny forecasts are nans
+    if (not isinstance(values, np.ma.core.MaskedArray) and
+            np.any(np.isnan(values))):
+        values = np.ma.masked_invalid(values)
     # treat masked arrays differently
-    if isinstance(source[var_name].values, np.ma.core.MaskedArray):
+    if isinstance(values, np.ma.core.MaskedArray):
         gribapi.grib_set(grib, "bitmapPresent", 1)
         # use the missing value from the masked array as default
-        missing_value = source[var_name].values.get_fill_value()
+        missing_value = values.get_fill_value()
         # but give the netCDF specified missing value preference
         missing_value = source[var_name].attrs.get('missing_value',
                                                         missing_value)
         gribapi.grib_set_double(grib, "missingValue",
                                 float(missing_value))
-        data = source[var_name].values.filled()
+        data = values.filled()
     else:
         gribapi.grib_set_double(grib, "missingValue", 9999)
         data = source[var_name].values[:]
@@ -362,7 +367,7 @@ def save(source, target, append=False, sample_file=_sample_file):
     # iterate over variables, unless they are considered
     # auxiliary variables (ie, variables used by slocum
     # but not in grib files).
-    auxilary_variables = [conv.WIND_SPEED, conv.WIND_DIR]
+    auxilary_variables = [conv.WIND_SPEED, conv.WIND_DIR, conv.LAND]
     for single_var in (v for k, v in source.noncoordinates.iteritems()
                        if not k in auxilary_variables):
         # then iterate over time slices
@@ -0,0 +1,372 @@
+"""
+An adaptive range coder for the bins of tiny arrays.
+
+The bins that tinylib produces are small integers which are strongly
+correlated with the bins of neighbouring cells.  Packing them a few to
+a byte and running zlib over the result hides most of that structure,
+so instead the bins are coded directly using adaptive frequency models.
+Each cell is coded with the model selected by the bins of its already
+coded west and north neighbours, so the models learn, for example, that
+a Force 4 cell is usually next to another Force 4 cell.
+
+Smooth fields, such as pressure, can instead be coded as the residual
+between each bin and the bin predicted from its neighbours, which is
+almost always zero (see encode_predicted_grid), and pairs of values
+where the precision of one depends on the other, such as wind speed and
+direction, can be coded jointly (see encode_joint_grid).
+
+This is the carry-less range coder described by Dmitry Subbotin, the
+frequency totals are kept below 2 ** 16 so that 32 bit arithmetic
+suffices.
+"""
+import numpy as np
+
+_TOP = 1 << 24
+_BOTTOM = 1 << 16
+_MASK = 0xffffffff
+# each time a symbol is seen its frequency is incremented by _INCREMENT,
+# once the total frequency grows beyond _LIMIT all the frequencies are
+# halved which lets the models follow changing statistics.
+_INCREMENT = 24
+_LIMIT = _BOTTOM
+
+
+class AdaptiveModel(object):
+    """
+    Holds the frequencies of each of nsymbols symbols, all of which
+    start out equally likely.
+    """
+    def __init__(self, nsymbols):
+        self.freqs = [1] * nsymbols
+        self.total = nsymbols
+
+    def update(self, symbol):
+        self.freqs[symbol] += _INCREMENT
+        self.total += _INCREMENT
+        if self.total > _LIMIT:
+            self.freqs = [(f + 1) // 2 for f in self.freqs]
+            self.total = sum(self.freqs)
+
+
+class RangeEncoder(object):
+
+    def __init__(self):
+        self.low = 0
+        self.range = _MASK
+        self.output = bytearray()
+
+    def encode(self, model, symbol):
+        """
+        Encodes symbol using the frequencies in model, then updates it.
+        """
+        freqs = model.freqs
+        r = self.range // model.total
+        self.low += r * sum(freqs[:symbol])
+        self.range = r * freqs[symbol]
+        self._normalize()
+        model.update(symbol)
+
+    def _normalize(self):
+        while True:
+            if (self.low ^ (self.low + self.range)) >= _TOP:
+                if self.range >= _BOTTOM:
+                    break
+                self.range = -self.low & (_BOTTOM - 1)
+            self.output.append((self.low >> 24) & 0xff)
+            self.low = (self.low << 8) & _MASK
+            self.range = (self.range << 8) & _MASK
+
+    def finish(self):
+        """
+        Flushes the state of the encoder and returns the encoded string.
+        """
+        # the decoder pads the data with zeros, so we only need to write
+        # enough bytes to identify a value in [low, low + range) which
+        # ends with zeros.
+        for nbytes in range(1, 5):
+            shift = 32 - 8 * nbytes
+            value = -(-self.low >> shift) << shift
+            if value < self.low + self.range:
+                break
+        for _ in range(nbytes):
+            self.output.append((value >> 24) & 0xff)
+            value = (value << 8) & _MASK
+        return str(self.output)
+
+
+class RangeDecoder(object):
+
+    def __init__(self, data):
+        # the encoder leaves off up to four trailing zeros.
+        self.data = bytearray(data) + bytearray(4)
+        self.low = 0
+        self.range = _MASK
+        self.code = 0
+        for i in range(4):
+            self.code = (self.code << 8) | self.data[i]
+        self.position = 4
+
+    def decode(self, model):
+        """
+        Decodes the next symbol using the frequencies in model, then
+        updates it.
+        """
+        freqs = model.freqs
+        r = self.range // model.total
+        target = min((self.code - self.low) // r, model.total - 1)
+        symbol = 0
+        cumulative = 0
+        while cumulative + freqs[symbol] <= target:
+            cumulative += freqs[symbol]
+            symbol += 1
+        self.low += r * cumulative
+        self.range = r * freqs[symbol]
+        self._normalize()
+        model.update(symbol)
+        return symbol
+
+    def _normalize(self):
+        while True:
+            if (self.low ^ (self.low + self.range)) >= _TOP:
+                if self.range >= _BOTTOM:
+                    break
+                self.range = -self.low & (_BOTTOM - 1)
+            self.code = ((self.code << 8) | self.data[self.position]) & _MASK
+            self.position += 1
+            self.low = (self.low << 8) & _MASK
+            self.range = (self.range << 8) & _MASK
+
+
+def grid_contexts(bins, nsymbols):
+    """
+    Returns the index of the context used to code each of the bins, which
+    is determined by the bins of its west and north neighbours (taken to
+    be 0 along the edges of the grid).  The last two dimensions of bins
+    are assumed to be the grid.
+    """
+    bins = np.asarray(bins)
+    if bins.ndim < 2:
+        bins = bins.reshape((1, -1))
+    west = np.zeros(bins.shape, dtype=np.int64)
+    west[..., 1:] = bins[..., :-1]
+    north = np.zeros(bins.shape, dtype=np.int64)
+    north[..., 1:, :] = bins[..., :-1, :]
+    return west * nsymbols + north
+
+
+def encode_grid(bins, nsymbols):
+    """
+    Range codes an array of integers in [0, nsymbols), returning a string.
+    """
+    bins = np.asarray(bins)
+    models = [AdaptiveModel(nsymbols) for _ in range(nsymbols * nsymbols)]
+    contexts = grid_contexts(bins, nsymbols).reshape(-1)
+    encoder = RangeEncoder()
+    for symbol, context in zip(bins.reshape(-1).tolist(), contexts.tolist()):
+        encoder.encode(models[context], symbol)
+    return encoder.finish()
+
+
+def decode_grid(data, shape, nsymbols):
+    """
+    Inverse of encode_grid, returns an integer array with shape 'shape'.
+    """
+    models = [AdaptiveModel(nsymbols) for _ in range(nsymbols * nsymbols)]
+    decoder = RangeDecoder(data)
+    size = int(np.prod(shape))
+    ncols = shape[-1] if len(shape) else 1
+    nrows = shape[-2] if len(shape) > 1 else 1
+    grid_size = ncols * nrows
+    bins = [0] * size
+    for i in xrange(size):
+        col = i % ncols
+        west = bins[i - 1] if col else 0
+        north = bins[i - ncols] if (i % grid_size) >= ncols else 0
+        bins[i] = decoder.decode(models[west * nsymbols + north])
+    return np.array(bins, dtype=np.int64).reshape(shape)
+
+
+def median_prediction(west, north, northwest):
+    """
+    The median edge detector of LOCO-I, which predicts a cell as the
+    median of west, north and west + north - northwest.
+    """
+    return max(min(west, north), min(max(west, north),
+                                     west + north - northwest))
+
+
+def _gradient_context(west, north, northwest, northeast):
+    """
+    The context used to code a residual is given by the local gradients,
+    each clipped to [-2, 2], which distinguishes flat regions (where the
+    prediction is nearly always right) from fronts.
+    """
+    def clip(x):
+        return min(max(x, -2), 2) + 2
+    return (clip(west - northwest) * 5 + clip(north - northwest)) * 5 + \
+        clip(northeast - north)
+
+
+def _iter_neighbours(shape):
+    """
+    Yields the index of each cell in a flattened array with shape 'shape'
+    along with the indices of its west, north, north west and north east
+    neighbours in the same grid, or None for neighbours beyond the edge.
+    """
+    ncols = shape[-1] if len(shape) else 1
+    nrows = shape[-2] if len(shape) > 1 else 1
+    size = int(np.prod(shape))
+    for start in xrange(0, size, ncols * nrows):
+        for row in xrange(nrows):
+            for col in xrange(ncols):
+                i = start + row * ncols + col
+                north = i - ncols if row else None
+                yield (i,
+                       i - 1 if col else None,
+                       north,
+                       north - 1 if row and col else None,
+                       north + 1 if row and col < ncols - 1 else None)
+
+
+def _predict(bins, neighbours):
+    """
+    Returns the prediction and context of a cell given the (already
+    known) bins and the indices of its neighbours.
+    """
+    _, w, n, nw, ne = neighbours
+    west = 0 if w is None else bins[w]
+    north = 0 if n is None else bins[n]
+    northwest = 0 if nw is None else bins[nw]
+    northeast = 0 if ne is None else bins[ne]
+    if n is None:
+        prediction = west
+    elif w is None:
+        prediction = north
+    else:
+        prediction = median_prediction(west, north, northwest)
+    return prediction, _gradient_context(west, north, northwest, northeast)
+
+
+def encode_predicted_grid(bins, nsymbols):
+    """
+    Range codes an array of integers in [0, nsymbols) as the residuals
+    (modulo nsymbols) between each value and its median_prediction from
+    the west, north and north west neighbours.  The first row of each
+    grid is predicted from the west and the first column from the north.
+    """
+    bins = np.asarray(bins)
+    flat = bins.reshape(-1).tolist()
+    models = [AdaptiveModel(nsymbols) for _ in range(125)]
+    encoder = RangeEncoder()
+    for neighbours in _iter_neighbours(bins.shape):
+        prediction, context = _predict(flat, neighbours)
+        residual = (flat[neighbours[0]] - prediction) % nsymbols
+        encoder.encode(models[context], residual)
+    return encoder.finish()
+
+
+def decode_predicted_grid(data, shape, nsymbols):
+    """
+    Inverse of encode_predicted_grid.
+    """
+    models = [AdaptiveModel(nsymbols) for _ in range(125)]
+    decoder = RangeDecoder(data)
+    bins = [0] * int(np.prod(shape))
+    for neighbours in _iter_neighbours(shape):
+        prediction, context = _predict(bins, neighbours)
+        residual = decoder.decode(models[context])
+        bins[neighbours[0]] = (residual + prediction) % nsymbols
+    return np.array(bins, dtype=np.int64).reshape(shape)
+
+
+def _joint_models(nminor):
+    """
+    The models used to code the major values (one for each pair of west
+    and north major values) and the minor values (five for each major
+    value, see _minor_prediction).
+    """
+    nmajor = len(nminor)
+    major = [AdaptiveModel(nmajor) for _ in range(nmajor * nmajor)]
+    minor = [[AdaptiveModel(n) for _ in range(5)] for n in nminor]
+    return major, minor
+
+
+def _minor_prediction(minor, neighbours, nlevels, step):
+    """
+    Predicts the minor value of a cell, at a resolution of nlevels, as
+    that of its west neighbour (or its north neighbour in the first
+    column).  The context is the difference between the north and west
+    neighbours, clipped to [-2, 2], which is zero where the prediction
+    is usually right.
+    """
+    _, w, n, _, _ = neighbours
+    west = None if w is None else minor[w] // step
+    north = None if n is None else minor[n] // step
+    prediction = west if west is not None else (north or 0)
+    other = north if north is not None else prediction
+    diff = (other - prediction) % nlevels
+    if diff > nlevels // 2:
+        diff -= nlevels
+    return prediction, min(max(diff, -2), 2) + 2
+
+
+def _major_context(major, neighbours, nmajor):
+    _, w, n, _, _ = neighbours
+    west = 0 if w is None else major[w]
+    north = 0 if n is None else major[n]
+    return west * nmajor + north
+
+
+def encode_joint_grid(major, minor, nminor):
+    """
+    Range codes pairs of integers, where major is in [0, len(nminor))
+    and the minor values which go with a major value m are multiples of
+    max(nminor) / nminor[m], so only take nminor[m] distinct values.
+    This suits quantizers in which the precision of one value depends
+    on another, such as wind directions which are more coarsely binned
+    at lower speeds.  The major values use the same contexts as
+    encode_grid, and the minor values are coded as their residual
+    (modulo nminor[m]) from a neighbour (see _minor_prediction).
+    """
+    major = np.asarray(major)
+    flat_major = major.reshape(-1).tolist()
+    flat_minor = np.asarray(minor).reshape(-1).tolist()
+    nfine = max(nminor)
+    major_models, minor_models = _joint_models(nminor)
+    encoder = RangeEncoder()
+    for neighbours in _iter_neighbours(major.shape):
+        i = neighbours[0]
+        m = flat_major[i]
+        encoder.encode(major_models[_major_context(flat_major, neighbours,
+                                                   len(nminor))], m)
+        step = nfine // nminor[m]
+        assert flat_minor[i] % step == 0
+        prediction, context = _minor_prediction(flat_minor, neighbours,
+                                                nminor[m], step)
+        encoder.encode(minor_models[m][context],
+                       (flat_minor[i] // step - prediction) % nminor[m])
+    return encoder.finish()
+
+
+def decode_joint_grid(data, shape, nminor):
+    """
+    Inverse of encode_joint_grid, returns the major and minor arrays.
+    """
+    size = int(np.prod(shape))
+    major = [0] * size
+    minor = [0] * size
+    nfine = max(nminor)
+    major_models, minor_models = _joint_models(nminor)
+    decoder = RangeDecoder(data)
+    for neighbours in _iter_neighbours(shape):
+        i = neighbours[0]
+        m = decoder.decode(major_models[_major_context(major, neighbours,
+                                                       len(nminor))])
+        major[i] = m
+        step = nfine // nminor[m]
+        prediction, context = _minor_prediction(minor, neighbours,
+                                                nminor[m], step)
+        residual = decoder.decode(minor_models[m][context])
+        minor[i] = ((residual + prediction) % nminor[m]) * step
+    return (np.array(major, dtype=np.int64).reshape(shape),
+            np.array(minor, dtype=np.int64).reshape(shape))
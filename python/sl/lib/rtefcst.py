@@ -500,7 +500,8 @@ class RouteForecast(object):
         self.curPos for all noncoordinate variables contained in the forecast.
         Returns a dictionary that maps variable names to the resulting forecast
         values.  Raises PointNotInsideGrid if self.curPos is not enclosed by
-        forecast grid points.
+        forecast grid points, or if any of them are land cells which were
+        left out of the forecast (and hold nans).
         """
         lat = self.rte.curPos.lat
         lon = self.rte.curPos.lon
@@ -527,7 +528,12 @@ class RouteForecast(object):
 
         out = {}
         for fVar in self.fcst.noncoordinates.keys():
+            if fVar == conv.LAND:
+                # the land mask has no forecast times
+                continue
             box = self.fcst[fVar].values[timeIndex, i-1:i+1, j-1:j+1]
+            if np.any(np.isnan(box)):
+                raise PointNotInsideGrid
 
             logger.debug("\n%s-box:\n%s" % (fVar, box))
 
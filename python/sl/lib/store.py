@@ -0,0 +1,361 @@
+"""
+A local store of the forecast data downloaded from openDAP servers.
+
+Data is stored in netCDF files under a directory, one for each model,
+model run, variable and tile of the model grid,
+
+    directory/model/YYYYmmddHH/variable_<lat tile>_<lon tile>.nc
+
+so that any request which covers part of a tile that has already been
+downloaded (for the same model run) is read from disk.  Tiles for runs
+older than max_age are removed, and if the store grows beyond max_bytes
+the least recently used tiles are removed until it fits.
+
+The RunCache remembers which forecast run is the latest on each server
+so the thredds catalogs needn't be read for every request, and the
+MetadataCache holds the coordinates and variables of each forecast run
+so requests can be subset without asking the server.
+"""
+import os
+import json
+import fcntl
+import errno
+import urllib
+import logging
+import datetime
+import tempfile
+import contextlib
+import numpy as np
+
+from collections import OrderedDict
+
+import xray
+
+logger = logging.getLogger(os.path.basename(__file__))
+
+_run_format = '%Y%m%d%H'
+_expires_format = '%Y-%m-%dT%H:%M:%S'
+# the encoding keys that are kept when writing a tile, others (such as
+# the chunking used by the server) may not make sense for a tile.
+_encoding_keys = ['units', 'calendar', 'dtype', 'scale_factor',
+                  'add_offset', '_FillValue']
+
+
+@contextlib.contextmanager
+def _locked(path):
+    """
+    Holds an exclusive lock on path, through the file path.lock, so
+    that processes reading, changing and then writing path don't lose
+    each other's changes.
+    """
+    with open(path + '.lock', 'a') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(f, fcntl.LOCK_UN)
+
+
+def _write_json(obj, path):
+    # write to a temporary file first so readers never see part of it
+    fd, tmp = tempfile.mkstemp(suffix='.tmp',
+                               dir=os.path.dirname(path) or '.')
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(obj, f)
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+
+def _to_json(obj):
+    """
+    Converts the numpy arrays and scalars in obj (which may be nested
+    in dictionaries and lists) to something json can hold.
+    """
+    if isinstance(obj, dict):
+        return dict((k, _to_json(v)) for k, v in obj.iteritems())
+    if isinstance(obj, (list, tuple)):
+        return [_to_json(x) for x in obj]
+    if isinstance(obj, (np.ndarray, np.generic)):
+        obj = np.asarray(obj)
+        return {'values': obj.tolist(), 'dtype': obj.dtype.str}
+    return obj
+
+
+def _from_json(obj):
+    """
+    The inverse of _to_json.
+    """
+    if isinstance(obj, dict):
+        if sorted(obj.keys()) == ['dtype', 'values']:
+            # scalars come back as numpy scalars
+            return np.array(obj['values'], dtype=obj['dtype'])[()]
+        return dict((k, _from_json(v)) for k, v in obj.iteritems())
+    if isinstance(obj, list):
+        return [_from_json(x) for x in obj]
+    return obj
+
+
+class ForecastStore(object):
+    """
+    Stores forecast tiles keyed by (model, run, variable, tile), where
+    run is the datetime of the model run and tile is a tuple of the
+    latitude and longitude tile indices.
+    """
+
+    def __init__(self, directory, max_bytes=500 * 2 ** 20,
+                 max_age=datetime.timedelta(days=2)):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+
+    def path(self, model, run, variable, tile):
+        """
+        Returns the path of the file which holds a tile.
+        """
+        name = '%s_%s.nc' % (variable, '_'.join(str(x) for x in tile))
+        return os.path.join(self.directory, model, run.strftime(_run_format),
+                            name)
+
+    def get(self, model, run, variable, tile):
+        """
+        Returns the stored tile as an xray.Dataset (loaded into memory),
+        or None if the store doesn't hold it.
+        """
+        path = self.path(model, run, variable, tile)
+        try:
+            ds = xray.open_dataset(path)
+        except (IOError, RuntimeError):
+            return None
+        ds.load_data()
+        ds.close()
+        # the modification time marks when a tile was last used
+        try:
+            os.utime(path, None)
+        except OSError:
+            pass
+        logger.debug("Read %s from the forecast store" % path)
+        return ds
+
+    def put(self, model, run, variable, tile, ds):
+        """
+        Stores the tile held in ds, then evicts any old tiles.
+        """
+        path = self.path(model, run, variable, tile)
+        try:
+            os.makedirs(os.path.dirname(path))
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        ds = ds.copy()
+        for name in ds:
+            v = ds[name].variable
+            v.encoding = dict((k, v.encoding[k]) for k in _encoding_keys
+                              if k in v.encoding)
+            if name in ds.vars:
+                v.encoding['zlib'] = True
+        # write to a temporary file first so readers never see part of
+        # a tile.
+        fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=os.path.dirname(path))
+        os.close(fd)
+        try:
+            ds.to_netcdf(tmp)
+            os.rename(tmp, path)
+        except:
+            os.remove(tmp)
+            raise
+        logger.debug("Wrote %s to the forecast store" % path)
+        self.evict()
+
+    def tiles(self):
+        """
+        Returns a list of (path, run, size, last used) for each
+        stored tile.
+        """
+        out = []
+        for root, _, files in os.walk(self.directory):
+            try:
+                run = datetime.datetime.strptime(os.path.basename(root),
+                                                 _run_format)
+            except ValueError:
+                continue
+            for f in files:
+                if not f.endswith('.nc'):
+                    continue
+                path = os.path.join(root, f)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    # another process evicted it
+                    continue
+                out.append((path, run, stat.st_size, stat.st_mtime))
+        return out
+
+    def evict(self, now=None):
+        """
+        Removes the tiles of runs older than max_age, then the least
+        recently used tiles until the store holds at most max_bytes.
+        """
+        now = now or datetime.datetime.utcnow()
+        tiles = []
+        for path, run, size, used in self.tiles():
+            if now - run > self.max_age:
+                self._remove(path)
+            else:
+                tiles.append((used, size, path))
+        total = sum(size for _, size, _ in tiles)
+        for _, size, path in sorted(tiles):
+            if total <= self.max_bytes:
+                break
+            self._remove(path)
+            total -= size
+
+    def _remove(self, path):
+        logger.debug("Evicting %s from the forecast store" % path)
+        try:
+            os.remove(path)
+        except OSError:
+            # another process got there first
+            pass
+        # remove the run and model directories once they're empty
+        run_dir = os.path.dirname(path)
+        for d in [run_dir, os.path.dirname(run_dir)]:
+            try:
+                os.rmdir(d)
+            except OSError:
+                break
+
+
+class RunCache(object):
+    """
+    Remembers the url of the latest run of each model on each server,
+    or None if the server didn't have one, until the entry expires.
+    If path is given the entries are also kept in that json file, so
+    they are shared between processes.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self._entries = {}
+
+    def _key(self, model, server):
+        return '%s %s' % (model, server)
+
+    def _read(self):
+        if self.path is None:
+            return {}
+        try:
+            with open(self.path) as f:
+                entries = json.load(f)
+        except (IOError, ValueError):
+            return {}
+        return dict((k, (url, datetime.datetime.strptime(expires,
+                                                         _expires_format)))
+                    for k, (url, expires) in entries.iteritems())
+
+    def get(self, model, server, now=None):
+        """
+        Returns the url held for model on server, raising a KeyError if
+        there isn't one or it has expired.
+        """
+        now = now or datetime.datetime.utcnow()
+        key = self._key(model, server)
+        if key not in self._entries or self._entries[key][1] <= now:
+            # another process may have looked it up since
+            self._entries.update(self._read())
+        url, expires = self._entries[key]
+        if expires <= now:
+            raise KeyError(key)
+        return url
+
+    def _write(self, entries):
+        _write_json(dict((k, (url, expires.strftime(_expires_format)))
+                         for k, (url, expires) in entries.iteritems()),
+                    self.path)
+
+    def put(self, model, server, url, expires):
+        """
+        Holds url (which may be None) for model on server until expires.
+        """
+        key = self._key(model, server)
+        self._entries[key] = (url, expires)
+        if self.path is not None:
+            with _locked(self.path):
+                entries = self._read()
+                entries[key] = (url, expires)
+                self._write(entries)
+
+    def forget(self, model, server):
+        """
+        Drops the entry for model on server.
+        """
+        key = self._key(model, server)
+        self._entries.pop(key, None)
+        if self.path is not None:
+            with _locked(self.path):
+                entries = self._read()
+                if entries.pop(key, None) is not None:
+                    self._write(entries)
+
+
+class MetadataCache(object):
+    """
+    Holds the metadata of forecast runs (see poseidon.forecast_metadata)
+    keyed by their url, in memory and, if directory is given, in json
+    files in directory so other processes can use it.  Only the
+    max_entries most recently stored runs are kept.
+    """
+
+    def __init__(self, directory=None, max_entries=32):
+        self.directory = directory
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+
+    def path(self, url):
+        return os.path.join(self.directory,
+                            '%s.json' % urllib.quote(url, safe=''))
+
+    def get(self, url):
+        """
+        Returns the metadata of the run at url, or None if it isn't held.
+        """
+        if url in self._entries or self.directory is None:
+            return self._entries.get(url)
+        try:
+            with open(self.path(url)) as f:
+                metadata = _from_json(json.load(f))
+        except (IOError, ValueError):
+            return None
+        self._remember(url, metadata)
+        return metadata
+
+    def _remember(self, url, metadata):
+        self._entries[url] = metadata
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def put(self, url, metadata):
+        """
+        Holds the metadata of the run at url, forgetting the oldest runs
+        if there are more than max_entries.
+        """
+        self._remember(url, metadata)
+        if self.directory is None:
+            return
+        try:
+            os.makedirs(self.directory)
+        except OSError, e:
+            if e.errno != errno.EEXIST:
+                raise
+        _write_json(_to_json(metadata), self.path(url))
+        paths = [os.path.join(self.directory, f)
+                 for f in os.listdir(self.directory) if f.endswith('.json')]
+        paths = sorted(paths, key=os.path.getmtime)
+        for path in paths[:max(0, len(paths) - self.max_entries)]:
+            try:
+                os.remove(path)
+            except OSError:
+                # another process got there first
+                pass
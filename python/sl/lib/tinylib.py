@@ -1,24 +1,22 @@
 import os
 import zlib
+import struct
 import logging
 import datetime
 import numpy as np
-import pandas as pd
 
 logger = logging.getLogger(os.path.basename(__file__))
 
-try:
-    import xray
-    _has_xray = True
-except:
-    logger.warn("xray not found, only spot forecasts will be available.")
-    _has_xray = False
+# pandas and xray are only imported by the functions which need them
+# (encoding and from_beaufort), beaufort_to_dict only needs numpy so
+# forecasts can be decoded on machines which don't have them (or which
+# are too slow to import them).
 
 from collections import OrderedDict
 
 import sl.lib.conventions as conv
 
-from sl.lib import objects, units
+from sl.lib import rangecoder, units
 
 # the beaufort scale in m/s
 _beaufort_knots = np.array([0., 1., 3., 6., 10., 16., 21., 27.,
@@ -88,7 +86,16 @@ _variables = {conv.WIND_SPEED: {'dtype': np.float32,
                           'dims': (conv.TIME, ),
                           'least_significant_digit': 0},
               conv.ENSEMBLE: {'dtype': np.int64,
-                              'dims': (conv.ENSEMBLE, )}
+                              'dims': (conv.ENSEMBLE, )},
+              conv.LAND: {'dtype': np.bool_,
+                          'dims': (conv.LAT, conv.LON)},
+              # wind speed and direction quantized jointly (see
+              # tiny_wind), which expand to complex numbers holding
+              # speed * exp(1j * direction)
+              conv.WIND: {'dtype': np.complex128,
+                          'dims': (conv.TIME, conv.ENSEMBLE,
+                                   conv.LAT, conv.LON),
+                          'divs': _beaufort_scale},
               }
 
 _units = {k: _variables[k]['attributes'][conv.UNITS] for k in _variables
@@ -99,7 +106,81 @@ _variable_order = [conv.TIME, conv.LAT, conv.LON,
                    conv.ENSEMBLE,
                    conv.WIND_SPEED, conv.WIND_DIR,
                    conv.ENS_SPREAD_WS,
-                   conv.PRECIP, conv.PRESSURE]
+                   conv.PRECIP, conv.PRESSURE,
+                   conv.LAND, conv.WIND]
+# the order in which variables are expanded, the coordinates and land
+# mask are needed before any of the binned variables.
+_expand_order = ([v for v in _variable_order if 'divs' not in _variables[v]] +
+                 [v for v in _variable_order if 'divs' in _variables[v]])
+
+# payloads written using to_beaufort(..., indexed=True) start with this
+# version byte, while the original payloads start with a zlib header.
+_INDEXED_VERSION = 2
+# payloads holding variables too large for the 16 bit lengths of the
+# original format start with this version byte (see _chunked_beaufort)
+_CHUNKED_VERSION = 3
+# progressive payloads, which hold a coarse grid followed by layers
+# which refine it, start with this version byte (see _progressive_beaufort)
+_PROGRESSIVE_VERSION = 4
+# payloads holding the changes from a previous payload start with this
+# version byte (see beaufort_diff)
+_DIFF_VERSION = 5
+# the largest record the original format can hold, in the chunked format
+# variables are split into chunks of whole forecast times of about this size
+_MAX_RECORD_SIZE = 0xffff
+# coordinates which are regularly spaced are stored as a sequence (see
+# small_sequence) starting with this byte, which can't start a zlib stream
+_SEQUENCE_MARKER = '\x00'
+# the time index used for chunks of an indexed payload holding all times
+_ALL_TIMES = 0xFFFF
+# the ways in which binned variables can be stored (see _encode_field),
+# a codec's position in this list is used to identify it in payloads.
+# The top bit of the codec id is used for _TABLE_FLAG, so there can be
+# at most eight codecs.
+_codecs = ['raw', 'zlib', 'range', 'delta', 'median', 'ensemble', 'sparse']
+# codecs which need all the times of a variable at once
+_whole_variable_codecs = ['delta', 'ensemble']
+# variables are only considered for the 'sparse' codec when less than
+# this fraction of their bins are non zero (see _default_codec)
+_SPARSE_FRACTION = 0.1
+# set in the codec id of variables which carry their own divs, rather
+# than using those in _variables (see to_beaufort's adaptive argument)
+_TABLE_FLAG = 0x08
+# the variables for which adaptive divs are computed when to_beaufort is
+# called with adaptive=True, and the precision with which the divs of
+# each variable are stored.  The precipitation divs are left out since
+# the first of them separates dry cells from wet ones.  Wind directions
+# can use a compass with any power of two points (see compass_divs).
+_adaptive_variables = [conv.PRESSURE]
+_table_resolution = {conv.WIND_SPEED: 0.05,
+                     conv.ENS_SPREAD_WS: 0.05,
+                     conv.PRESSURE: 10.}
+# tables hold the number of divs in a single byte, so adaptive divs can
+# use at most this many bits (see _adaptive_tables)
+_MAX_TABLE_BITS = 7
+# the number of compass points used for the wind directions of each
+# beaufort force in each version of the joint wind codebook (see
+# wind_codebook).  The direction of a calm carries no information and
+# that of light air very little.  Payloads hold the version they were
+# written with, so rather than changing a codebook add a new version.
+_wind_codebooks = {1: [1, 8] + [16] * 12}
+_WIND_CODEBOOK = 1
+
+
+def _bit_layout(bits):
+    """
+    Values which are 'bits' wide line back up with byte boundaries
+    every 8 / gcd(bits, 8) values, this returns the number of values in
+    each of these blocks, the number of bytes they take and the size of
+    the smallest unsigned integer that can hold a block (or None if a
+    block is larger than 8 bytes).
+    """
+    # the largest power of two dividing bits (which is gcd(bits, 8)
+    # without importing fractions)
+    per_block = 8 // min(bits & -bits, 8)
+    block_bytes = bits * per_block // 8
+    itemsize = [n for n in [1, 2, 4, 8] if n >= block_bytes]
+    return per_block, block_bytes, itemsize[0] if itemsize else None
 
 
 def pack_ints(arr, req_bits=None):
@@ -107,6 +188,13 @@ def pack_ints(arr, req_bits=None):
     Takes an array of integers and returns a dictionary
     holding the packed data.
 
+    The values are written as a stream of bits, most significant first,
+    and may be anywhere from 1 to 16 bits wide, in which case values can
+    straddle bytes.  If the values don't fill the last byte they are
+    right aligned in it.  The packing is done with whole array
+    operations, a block of values at a time (see _bit_layout), so it
+    scales to grids with millions of cells.
+
     Parameters
     ----------
     arr : np.ndarray
@@ -136,30 +224,40 @@ def pack_ints(arr, req_bits=None):
     # we assume that these integer arrays are unsigned.
     assert np.min(arr) >= 0
     # the number of bits required to store the largest number in arr
-    # TODO: we could think of better packing schemes ... but not now.
-    req_bits = req_bits or np.ceil(np.log2(np.max(arr) + 1))
+    req_bits = req_bits or max(1, np.ceil(np.log2(np.max(arr) + 1)))
     assert int(req_bits) == req_bits
     req_bits = int(req_bits)
-    if req_bits >= 8:
-        raise ValueError("why not just use uint8 or bigger?")
-    # we pack several sub 8 bit into one 'out_bits' bit integer.
-    # will it ever make sense to use more than 8?
-    out_bits = 8
-    if np.mod(out_bits, req_bits):
-        print "output: %d    required: %d" % (out_bits, req_bits)
-        raise ValueError("bit size in the output type must be a " +
-                         "multiple of the num bits")
-    vals_per_int = out_bits / req_bits
-    # packed_size is the number of required elements in the output array
-    packed_size = np.ceil(float(arr.size) * req_bits / out_bits)
-    output = np.zeros(shape=(packed_size,), dtype=np.uint8)
-    # iterate over each input element
-    for i, x in enumerate(arr.flatten()):
-        # determine which index
-        ind = np.floor(i / vals_per_int)
-        if np.mod(i, vals_per_int):
-            output[ind] = output[ind] << req_bits
-        output[ind] += x
+    if req_bits > 16:
+        raise ValueError("pack_ints can only pack values up to 16 bits")
+    if np.any(arr >= 2 ** req_bits):
+        raise ValueError("arr holds values larger than %d bits" % req_bits)
+    flat = arr.reshape(-1)
+    # packed_size is the number of bytes in the output
+    packed_size = int(np.ceil(float(arr.size) * req_bits / 8))
+    per_block, block_bytes, itemsize = _bit_layout(req_bits)
+    nblocks = -(-arr.size // per_block)
+    if itemsize:
+        # shift each value into its position within its block, then
+        # write the blocks out as big endian integers.
+        dtype = np.dtype('u%d' % itemsize)
+        vals = np.zeros(nblocks * per_block, dtype=dtype)
+        vals[:arr.size] = flat
+        shifts = (req_bits * np.arange(per_block - 1, -1, -1)).astype(dtype)
+        blocks = np.bitwise_or.reduce(vals.reshape(nblocks, per_block)
+                                      << shifts, axis=1)
+        output = blocks.astype(dtype.newbyteorder('>')).view(np.uint8)
+        output = output.reshape(nblocks, itemsize)[:, itemsize - block_bytes:]
+    else:
+        # the blocks of odd widths over 8 bits don't fit in a 64 bit
+        # integer, so these are split into individual bits instead.
+        shifts = np.arange(req_bits - 1, -1, -1, dtype=np.uint16)
+        bits = (flat.astype(np.uint16)[:, np.newaxis] >> shifts) & 1
+        output = np.packbits(bits.astype(np.uint8))
+    output = output.reshape(-1)[:packed_size]
+    # the values in a partially filled last byte are right aligned
+    remainder = (arr.size * req_bits) % 8
+    if remainder:
+        output[-1] >>= 8 - remainder
     packed_array = {'packed_array': output.tostring(),
                     'bits': req_bits,
                     'shape': arr.shape,
@@ -191,34 +289,37 @@ def unpack_ints(packed_array, bits, shape, dtype=None):
     """
     # the dtype here is different than the final one.  At this point
     # all the data is stored in packed bytes.
-    packed_array = np.fromstring(packed_array, dtype=np.uint8)
-    info = np.iinfo(packed_array.dtype)
-    enc_bits = info.bits
-    if np.mod(enc_bits, bits):
-        raise ValueError("the bit encoding doesn't line up")
-    # how many values are in each int?
-    vals_per_int = enc_bits / bits
-    size = reduce(lambda x, y: x * y, shape)
-    # the masks are used for logical AND comparisons to retrieve the values
-    masks = [(2 ** bits - 1) << i * bits for i in range(vals_per_int)]
-
-    def iter_vals():
-        # iterate over array values until we've generated enough values to
-        # fill the original array
-        cnt = 0
-        for x in packed_array:
-            # nvals is the number of values contained in the next packed int
-            nvals = min(size - cnt, vals_per_int)
-            # by comparing the int x to each of the masks and shifting we
-            # recover the packed values.  Note that this will always generate
-            # 'vals_per_int' values but sometimes we only need a few which is
-            # why we select out the first nvals
-            reversed_vals = [(x & y) >> j * bits for j, y in enumerate(masks)]
-            for v in reversed(reversed_vals[:nvals]):
-                yield v
-            cnt += nvals
+    packed_array = np.frombuffer(packed_array, dtype=np.uint8)
+    if not 1 <= bits <= 16:
+        raise ValueError("bits must be between 1 and 16")
+    size = int(np.prod(shape))
+    per_block, block_bytes, itemsize = _bit_layout(bits)
+    nblocks = -(-size // per_block)
+    data = np.zeros(nblocks * block_bytes, dtype=np.uint8)
+    data[:packed_array.size] = packed_array
+    # a partially filled last byte holds its values right aligned,
+    # shifting it left lines it up with all the full bytes.
+    remainder = (size * bits) % 8
+    if remainder and packed_array.size:
+        data[packed_array.size - 1] <<= 8 - remainder
+    if itemsize:
+        # read the blocks as big endian integers and shift the
+        # values back out of them.
+        block_dtype = np.dtype('u%d' % itemsize)
+        padded = np.zeros((nblocks, itemsize), dtype=np.uint8)
+        padded[:, itemsize - block_bytes:] = data.reshape(nblocks,
+                                                          block_bytes)
+        blocks = padded.view(block_dtype.newbyteorder('>'))
+        blocks = blocks.astype(block_dtype)
+        shifts = (bits * np.arange(per_block - 1, -1, -1)).astype(block_dtype)
+        vals = (blocks >> shifts) & block_dtype.type(2 ** bits - 1)
+    else:
+        shifts = np.arange(bits - 1, -1, -1, dtype=np.uint16)
+        unpacked = np.unpackbits(data)[:nblocks * per_block * bits]
+        vals = np.bitwise_or.reduce(unpacked.reshape(-1, bits)
+                                    .astype(np.uint16) << shifts, axis=1)
     # recreate the original array
-    return np.array([x for x in iter_vals()], dtype=dtype).reshape(shape)
+    return vals.reshape(-1)[:size].astype(dtype or np.int64).reshape(shape)
 
 
 def tiny_array(arr, bits=None, divs=None, mask=None, wrap=False):
@@ -241,7 +342,7 @@ def tiny_unmasked(arr, bits=None, divs=None, wrap=False):
     Bins the values in arr by using dividers (divs).  The result
     is a set of integers indicating which bin each value in arr belongs
     to.  These bin indicators are then stored as packed integers (provided
-    the number of bins can be stored in 4 or less bits.
+    the number of bins can be stored in 16 or less bits).
 
     Parameters
     ----------
@@ -269,19 +370,10 @@ def tiny_unmasked(arr, bits=None, divs=None, wrap=False):
         # n is the number of 'levels' that can be represented'
         divs = np.linspace(lower, upper, n).astype(np.float)
     else:
-        bits = bits or np.ceil(np.log2(divs.size))
-    if int(np.log2(bits)) != np.log2(bits):
-        raise ValueError("bits must be a power of two")
-    # it doesn't make sense to store anything larger than this
-    assert bits <= 4
-    n = np.power(2., bits)
-    # for each element of the array, count how many divs are less than the elem
-    # note that a zero after shifting means that the value was less than all div
-    # and a value of n means it was larger than the nth div.
-    if not wrap:
-        bins = np.maximum(0, np.digitize(arr.reshape(-1), divs) - 1)
-    else:
-        bins = np.digitize(arr.reshape(-1), divs) % len(divs)
+        bits = bits or _bits_for(divs.size)
+    if not 1 <= bits <= 16:
+        raise ValueError("bits must be between 1 and 16")
+    bins = bin_array(arr, divs, wrap=wrap).reshape(-1)
     tiny = pack_ints(bins, bits)
     tiny['divs'] = divs
     tiny['shape'] = arr.shape
@@ -374,23 +466,111 @@ def expand_unmasked(packed_array, bits, shape, divs, dtype=None,
     original_array = np.random.normal(size=(30, 3))
     tiny = tiny_array(original_array)
     recovered = expand_unmasked(**tiny)
+
+    When bits divides 8 each packed byte is expanded directly into the
+    values it holds using a lookup table (see _byte_values).
+    """
+    size = int(np.prod(shape))
+    if 8 % bits or len(packed_array) != -(-size * bits // 8):
+        bins = unpack_ints(packed_array, bits, shape)
+        return expand_bins(bins, divs, dtype, wrap_val=wrap_val)
+    packed = np.frombuffer(packed_array, dtype=np.uint8)
+    # a partially filled last byte holds its values right aligned
+    remainder = (size * bits) % 8
+    if remainder:
+        packed = packed.copy()
+        packed[-1] <<= 8 - remainder
+    table = _byte_values(divs, bits, dtype, wrap_val)
+    return table.take(packed, axis=0).reshape(-1)[:size].reshape(shape)
+
+
+def bin_array(arr, divs, wrap=False):
     """
-    dtype = dtype or divs.dtype
-    ndivs = divs.size
-    bins = unpack_ints(packed_array, bits, shape)
-    if dtype == np.dtype('bool'):
-        return bins.astype('bool')
-    if wrap_val:
-        upper = bins
-        lower = (bins-1) % len(divs)
-        averages = np.where(bins > 0, 0.5 * (divs[lower] + divs[upper]),
-                            wrap_val)
+    Returns an integer array, the same shape as arr, indicating which
+    of the bins defined by the dividers (divs) each value of arr falls in.
+    If wrap == True it is assumed that the binning continues from the last
+    back to the first bin, in which case the '0' bin sits between the last
+    and first bounding value in divs.
+    """
+    arr = np.asarray(arr)
+    # for each element of the array, count how many divs are less than the elem
+    # note that a zero after shifting means that the value was less than all div
+    # and a value of n means it was larger than the nth div.
+    if not wrap:
+        bins = np.maximum(0, np.digitize(arr.reshape(-1), divs) - 1)
     else:
-        lower_bins = bins
-        upper_bins = np.minimum(lower_bins + 1, ndivs - 1)
-        averages = 0.5 * (divs[lower_bins] + divs[upper_bins])
+        bins = np.digitize(arr.reshape(-1), divs) % len(divs)
+    return bins.reshape(arr.shape)
 
-    return averages.astype(dtype).reshape(shape)
+
+def expand_bins(bins, divs, dtype=None, wrap_val=None):
+    """
+    Inverse of bin_array, returns the value at the middle of each bin.
+    If wrap_val != None it is assumed that the binning wraps and that
+    wrap_val is the center value between the last and first bounding
+    value in divs.
+    """
+    return _bin_values(divs, divs.size, dtype, wrap_val).take(bins)
+
+
+# lookup tables of the values of each bin (or each packed byte) for
+# each set of divs seen by expand_bins and expand_unmasked.  There are
+# only a handful of distinct divs, but adaptive tables (see
+# adaptive_divs) can add more, so the cache is cleared once it's full.
+_expansion_tables = {}
+_max_expansion_tables = 256
+
+
+def _cached_table(key, compute):
+    """
+    Returns the table stored under key, computing it if needed.
+    """
+    if key not in _expansion_tables:
+        if len(_expansion_tables) >= _max_expansion_tables:
+            _expansion_tables.clear()
+        _expansion_tables[key] = compute()
+    return _expansion_tables[key]
+
+
+def _bin_values(divs, nbins, dtype=None, wrap_val=None):
+    """
+    Returns the value expand_bins gives each of the first nbins bins of
+    divs, bins past the last div take the value of the last bin.
+    """
+    dtype = np.dtype(dtype or divs.dtype)
+
+    def compute():
+        bins = np.arange(nbins)
+        if dtype == np.dtype('bool'):
+            return bins.astype('bool')
+        bins = np.minimum(bins, divs.size - 1)
+        if wrap_val:
+            upper = bins
+            lower = (bins - 1) % len(divs)
+            averages = np.where(bins > 0, 0.5 * (divs[lower] + divs[upper]),
+                                wrap_val)
+        else:
+            upper = np.minimum(bins + 1, divs.size - 1)
+            averages = 0.5 * (divs[bins] + divs[upper])
+        return averages.astype(dtype)
+    key = ('bins', divs.tostring(), divs.dtype.str, nbins, dtype.str,
+           wrap_val)
+    return _cached_table(key, compute)
+
+
+def _byte_values(divs, bits, dtype=None, wrap_val=None):
+    """
+    Returns a (256, 8 / bits) table holding the values of the bins
+    packed (see pack_ints) in each possible byte.
+    """
+    def compute():
+        values = _bin_values(divs, 2 ** bits, dtype, wrap_val)
+        shifts = bits * np.arange(8 // bits - 1, -1, -1)
+        bins = (np.arange(256)[:, np.newaxis] >> shifts) & (2 ** bits - 1)
+        return values.take(bins)
+    key = ('bytes', divs.tostring(), divs.dtype.str, bits,
+           np.dtype(dtype or divs.dtype).str, wrap_val)
+    return _cached_table(key, compute)
 
 
 def expand_masked(mask, packed_array, bits, shape, divs, dtype=None,
@@ -407,16 +587,73 @@ def expand_masked(mask, packed_array, bits, shape, divs, dtype=None,
     return ret
 
 
-def small_array(arr, least_significant_digit):
+def _zigzag(v):
+    """
+    Maps signed integers to non negative ones (0, -1, 1, -2 ...
+    become 0, 1, 2, 3 ...) so they can be stored as varints.
+    """
+    v = int(v)
+    return (v << 1) if v >= 0 else ((-v << 1) - 1)
+
+
+def _unzigzag(v):
+    """
+    Inverse of _zigzag.
+    """
+    return v >> 1 if not v & 1 else -((v + 1) >> 1)
+
+
+def small_sequence(values, head=0):
+    """
+    Stores an array of integers, of which all but the first 'head' values
+    form an arithmetic sequence, in a few bytes.  The result holds the
+    _SEQUENCE_MARKER followed by varints holding head, the head values
+    and the start, step and length of the sequence.  If the values
+    aren't a sequence None is returned.
+
+    See Also: expand_small_sequence
+    """
+    values = np.asarray(values).astype(np.int64)
+    tail = values[head:]
+    start = tail[0] if tail.size else 0
+    step = tail[1] - tail[0] if tail.size > 1 else 0
+    if np.any(np.diff(tail) != step):
+        return None
+    signed = list(values[:head]) + [start, step]
+    return _SEQUENCE_MARKER + _pack_varints([head] +
+                                            [_zigzag(v) for v in signed] +
+                                            [tail.size])
+
+
+def expand_small_sequence(packed_array):
+    """
+    Inverse of small_sequence, returns the head values and the sequence.
+    """
+    assert packed_array[0] == _SEQUENCE_MARKER
+    (head, ), offset = _unpack_varints(packed_array, 1, 1)
+    values, offset = _unpack_varints(packed_array, head + 3, offset)
+    signed = [_unzigzag(v) for v in values[:-1]]
+    start, step = signed[head:]
+    sequence = start + step * np.arange(values[-1], dtype=np.int64)
+    return np.array(signed[:head], dtype=np.int64), sequence
+
+
+def small_array(arr, least_significant_digit, sequence=False):
     """
     Creates a small array.  This is done by rounding to a least
-    significant digit and then zlib compressing te array.
+    significant digit and then zlib compressing te array.  If sequence
+    is True and the rounded values are regularly spaced, only the start,
+    step and size are stored instead (see small_sequence), which the
+    original format (version 1) can't hold.
 
     See Also: expand_small_array
     """
     assert np.all(np.isfinite(arr))
     data = np.round(arr * np.power(10, least_significant_digit))
-    return {'packed_array': zlib.compress(data.tostring(), 9),
+    packed = small_sequence(data) if sequence else None
+    if packed is None:
+        packed = zlib.compress(data.tostring(), 9)
+    return {'packed_array': packed,
             'dtype': arr.dtype,
             'least_significant_digit': least_significant_digit}
 
@@ -426,18 +663,26 @@ def expand_small_array(packed_array, dtype, least_significant_digit):
     Takes a the output from small_array and reconstructs a the original
     (rounded) array
     """
-    arr = np.fromstring(zlib.decompress(packed_array), dtype=dtype)
+    if packed_array[0] == _SEQUENCE_MARKER:
+        _, arr = expand_small_sequence(packed_array)
+        arr = arr.astype(dtype)
+    else:
+        arr = np.fromstring(zlib.decompress(packed_array), dtype=dtype)
     arr = arr / np.power(10, least_significant_digit)
     return arr
 
 
-def small_time(time_var):
+def small_time(time_var, sequence=False):
     """
     This packs the time variable by taking advantage of the fact that
     time is monotonically increasing.  It first converts the starting
     time to ordinal + seconds, then stores the incremental differences
-    using small_array()
+    using small_array().  If sequence is True regularly spaced times are
+    instead stored as a sequence following the ordinal and seconds (see
+    small_sequence).
     """
+    import xray
+    import pandas as pd
     time_var = xray.conventions.encode_cf_variable(time_var)
     assert time_var.attrs[conv.UNITS].lower().startswith('hour')
     origin = xray.conventions.decode_cf_datetime([0],
@@ -448,6 +693,13 @@ def small_time(time_var):
     np.testing.assert_array_equal(diffs.astype('int'), diffs)
     fromordinal = datetime.datetime.fromordinal(origin.toordinal())
     seconds = int(datetime.timedelta.total_seconds(origin - fromordinal))
+    if sequence:
+        packed = small_sequence(np.concatenate([[origin.toordinal(), seconds],
+                                                time_var.values]), head=2)
+        if packed is not None:
+            return {'packed_array': packed,
+                    'dtype': _variables[conv.TIME]['dtype'],
+                    'least_significant_digit': 0}
     augmented = np.concatenate([[origin.toordinal(), seconds],
                                 diffs.astype(_variables[conv.TIME]['dtype'])])
     return small_array(augmented, least_significant_digit=0)
@@ -457,11 +709,18 @@ def expand_small_time(packed_array, dtype, least_significant_digit):
     """
     Expands a small_time encoded time array.
     """
-    augmented = expand_small_array(packed_array, dtype,
-                                   least_significant_digit)
-    origin = datetime.datetime.fromordinal(augmented[0])
-    origin += datetime.timedelta(seconds=int(augmented[1]))
-    times = np.cumsum(augmented[2:])
+    head = None
+    if packed_array[0] == _SEQUENCE_MARKER:
+        head, times = expand_small_sequence(packed_array)
+    if head is not None and head.size == 2:
+        times = times.astype(dtype)
+    else:
+        augmented = expand_small_array(packed_array, dtype,
+                                       least_significant_digit)
+        head = augmented[:2]
+        times = np.cumsum(augmented[2:])
+    origin = datetime.datetime.fromordinal(head[0])
+    origin += datetime.timedelta(seconds=int(head[1]))
     units = origin.strftime('hours since %Y-%m-%d %H:%M:%S')
     return times, units
 
@@ -477,6 +736,151 @@ def small_ensemble(ens_var):
     return np.array(ens_var.size, np.int8).tostring()
 
 
+def small_land(land):
+    """
+    Range codes a boolean (lat, lon) land mask.  Coastlines are long
+    contiguous runs so even large masks take only a few bytes.
+    """
+    return rangecoder.encode_grid(np.asarray(land, dtype=np.int64), 2)
+
+
+def expand_small_land(packed_array, shape):
+    """
+    Inverse of small_land.
+    """
+    return rangecoder.decode_grid(packed_array, shape, 2).astype(np.bool_)
+
+
+def land_mask(obj, land=None):
+    """
+    Returns the boolean (lat, lon) mask of land cells that to_beaufort
+    should leave out of the binned variables, which is either 'land' or
+    (if land is None) the conv.LAND variable in obj.  None is returned
+    if there is no mask or the mask doesn't hold any land.
+    """
+    if land is None:
+        if conv.LAND not in obj:
+            return None
+        land = obj[conv.LAND].values
+    land = np.asarray(land).astype(np.bool_)
+    shape = (obj[conv.LAT].size, obj[conv.LON].size)
+    if land.shape != shape:
+        raise ValueError("expected a land mask with shape %s, not %s"
+                         % (str(shape), str(land.shape)))
+    if np.all(land):
+        raise ValueError("the forecast domain is entirely land")
+    if not np.any(land):
+        return None
+    return land
+
+
+def sea_cells(values, land):
+    """
+    Removes the land cells from the grid (the last two dimensions) of
+    values, the remaining sea cells of each grid are returned as a
+    single row so the number of dimensions is unchanged.
+    """
+    sea = np.asarray(values)[..., ~land]
+    return sea.reshape(sea.shape[:-1] + (1, sea.shape[-1]))
+
+
+def fill_land(sea, land):
+    """
+    Inverse of sea_cells, the land cells are filled with nans.
+    """
+    out = np.empty(sea.shape[:-2] + land.shape, dtype=sea.dtype)
+    out.fill(np.nan)
+    out[..., ~land] = sea[..., 0, :]
+    return out
+
+
+def _sea_shape(shape, land):
+    """
+    The shape of a variable with shape 'shape' once sea_cells is applied.
+    """
+    return list(shape[:-2]) + [1, int(np.sum(~land))]
+
+
+def wind_speed_and_direction(uwnd, vwnd):
+    """
+    Takes arrays of zonal (uwnd) and meridional (vwnd) wind and returns
+    arrays holding the wind speed and the direction the wind is coming
+    from (in radians).  This is the whole array equivalent of building
+    an objects.Wind for every element, and gives identical values.
+    """
+    uwnd = np.asarray(uwnd)
+    vwnd = np.asarray(vwnd)
+    # objects.Wind squares the (scalar) components in double precision
+    speeds = np.square(uwnd.astype(np.float64))
+    speeds += np.square(vwnd.astype(np.float64))
+    np.sqrt(speeds, out=speeds)
+    # negative signs since we want to know where the wind is coming from
+    directions = np.arctan2(-uwnd, -vwnd)
+    return speeds, directions
+
+
+def compass_divs(npoints):
+    """
+    The divs between the directions of an npoints compass, with the
+    first bin (which wraps around) centered on 'S'.  compass_divs(16)
+    gives _direction_bins.
+    """
+    return np.linspace(-(npoints - 1) * np.pi / npoints,
+                       (npoints - 1) * np.pi / npoints, npoints)
+
+
+def wind_codebook(version=_WIND_CODEBOOK):
+    """
+    Returns the speeds and directions (in radians) of the code words of
+    a joint wind codebook, one for each compass point of each beaufort
+    force.  tiny_wind stores each wind as one of these.
+    """
+    points = _wind_codebooks[version]
+    speed_bins = np.repeat(np.arange(len(points)), points)
+    direction_bins = np.concatenate([np.arange(n) * (max(points) // n)
+                                     for n in points])
+    return (expand_bins(speed_bins, _beaufort_scale, np.float64),
+            expand_bins(direction_bins, _direction_bins, np.float64,
+                        wrap_val=np.pi))
+
+
+def tiny_wind(speeds, directions, version=_WIND_CODEBOOK):
+    """
+    Quantizes winds to the closest code word of a joint wind codebook
+    (see wind_codebook) and range codes them, returning a string which
+    starts with the version of the codebook.  The speeds are binned on
+    the beaufort scale, and the directions on a compass with as many
+    points as the codebook uses for that force.  Each direction is coded
+    as the matching point of the 16 point compass, which is how they are
+    compared with those of neighbouring cells.
+    """
+    points = np.array(_wind_codebooks[version])
+    speed_bins = bin_array(speeds, _beaufort_scale)
+    npoints = points[speed_bins]
+    direction_bins = np.zeros(speed_bins.shape, dtype=np.int64)
+    for n in np.unique(npoints):
+        force = npoints == n
+        direction_bins[force] = (bin_array(directions[force],
+                                           compass_divs(n), wrap=True) *
+                                 (points.max() // n))
+    return chr(version) + rangecoder.encode_joint_grid(
+        speed_bins, direction_bins, list(points))
+
+
+def expand_wind(packed_array, shape):
+    """
+    Inverse of tiny_wind, returns the speeds and directions.
+    """
+    version = ord(packed_array[0])
+    if version not in _wind_codebooks:
+        raise ValueError("unknown wind codebook version %d" % version)
+    speed_bins, direction_bins = rangecoder.decode_joint_grid(
+        buffer(packed_array, 1), shape, _wind_codebooks[version])
+    return (expand_bins(speed_bins, _beaufort_scale, np.float64),
+            expand_bins(direction_bins, _direction_bins, np.float64,
+                        wrap_val=np.pi))
+
+
 def check_beaufort(obj):
 
     if conv.UWND in obj:
@@ -508,184 +912,1561 @@ def check_beaufort(obj):
         units.convert_units(obj[conv.PRECIP], _units[conv.PRECIP])
 
 
-def to_beaufort(obj):
+def _beaufort_coordinates(obj, sequences=False):
+    """
+    Encodes the coordinates of obj, returning an ordered dictionary
+    which maps from the coordinate name to its packed string.  Regularly
+    spaced coordinates are only stored as sequences if sequences is
+    True, which the original format (version 1) can't hold.
+    """
+    coordinates = OrderedDict()
+    coordinates[conv.TIME] = small_time(obj[conv.TIME],
+                                        sequences)['packed_array']
+    for v in [conv.LAT, conv.LON]:
+        small = small_array(np.asarray(obj[v].values).astype(_variables[v]['dtype']),
+                            _variables[v]['least_significant_digit'],
+                            sequences)
+        coordinates[v] = small['packed_array']
+    if conv.ENSEMBLE in obj:
+        coordinates[conv.ENSEMBLE] = small_ensemble(obj[conv.ENSEMBLE])
+    return coordinates
+
+
+def _beaufort_fields(obj):
+    """
+    Returns an ordered dictionary mapping from the name of each of
+    the variables in obj which are binned to its full precision values.
+    Zonal and meridional winds are converted to wind speed and direction.
+    """
+    fields = OrderedDict()
+    uwnd = obj[conv.UWND].values
+    vwnd = obj[conv.VWND].values
+    assert obj[conv.UWND].attrs[conv.UNITS] == _units[conv.WIND_SPEED]
+    assert obj[conv.VWND].attrs[conv.UNITS] == _units[conv.WIND_SPEED]
+    speeds, directions = wind_speed_and_direction(uwnd, vwnd)
+    fields[conv.WIND_SPEED] = speeds.astype(_variables[conv.WIND_SPEED]['dtype'])
+    fields[conv.WIND_DIR] = directions
+    for v in [conv.ENS_SPREAD_WS, conv.PRECIP, conv.PRESSURE]:
+        if v in obj:
+            fields[v] = obj[v].values
+    return fields
+
+
+def _joint_wind_fields(fields):
+    """
+    Replaces the wind speed and direction in fields with a single joint
+    wind field, which holds speed * exp(1j * direction).
+    """
+    joint = OrderedDict()
+    joint[conv.WIND] = (fields[conv.WIND_SPEED] *
+                        np.exp(1j * fields[conv.WIND_DIR]))
+    for vname, values in fields.iteritems():
+        if vname not in [conv.WIND_SPEED, conv.WIND_DIR]:
+            joint[vname] = values
+    return joint
+
+
+def _encode_field(vname, values, codec='raw', divs=None):
+    """
+    Bins the values of a field using the divs from the _variables lookup
+    table, or 'divs' if given (wind directions wrap around), and then
+    encodes the bins using one of the _codecs:
+
+        'raw' : the bins are packed several to a byte (see pack_ints).
+        'zlib' : the packed bins are compressed with zlib.
+        'range' : the bins are range coded (see rangecoder.encode_grid).
+        'delta' : the difference between the bins at each time and the
+            bins at the previous time are range coded.  The first
+            dimension of values must be time.
+        'median' : the difference between each bin and the bin predicted
+            from its neighbours is range coded (see
+            rangecoder.encode_predicted_grid), which suits smooth
+            fields such as pressure.  It suffers when land cells are
+            left out (see to_beaufort).
+        'ensemble' : the bins of the first (control) ensemble member and
+            the difference between the bins of every other member and
+            the control are range coded.  Variables without an ensemble
+            dimension are range coded as is.
+        'sparse' : only the positions and values of the non zero bins
+            are stored (see sparse_bins), which suits precipitation.
+
+    The joint wind field is always stored using tiny_wind.
+    """
+    if vname == conv.WIND:
+        return tiny_wind(np.abs(values), np.angle(values))
+    bins, nbins, bits = _bin_field(vname, values, divs)
+    return _encode_bins(bins, nbins, bits, codec)
+
+
+def _bin_field(vname, values, divs=None):
+    """
+    Bins the values of a field as _encode_field does, returning the
+    bins, the number of bins and the number of bits used by 'raw'.
+    """
+    info = _variables[vname]
+    if divs is None:
+        divs, bits = info['divs'], info['bits']
+    else:
+        bits = _bits_for(divs.size)
+    bins = bin_array(values, divs, wrap=vname == conv.WIND_DIR)
+    return bins, divs.size, bits
+
+
+def _encode_bins(bins, nbins, bits, codec='raw'):
+    """
+    Encodes bins, integers in [0, nbins), using one of the _codecs
+    (see _encode_field).  bits is the number of bits used by 'raw'.
+    """
+    if codec == 'range':
+        return rangecoder.encode_grid(bins, nbins)
+    if codec == 'delta':
+        residuals = time_residuals(bins, nbins)
+        return rangecoder.encode_grid(residuals, nbins)
+    if codec == 'median':
+        return rangecoder.encode_predicted_grid(bins, nbins)
+    if codec == 'ensemble':
+        if _has_ensemble(bins):
+            bins = ensemble_residuals(bins, nbins)
+        return rangecoder.encode_grid(bins, nbins)
+    if codec == 'sparse':
+        return sparse_bins(bins, nbins)
+    packed = pack_ints(bins.reshape(-1), bits)['packed_array']
+    if codec == 'zlib':
+        return zlib.compress(packed, 9)
+    assert codec == 'raw'
+    return packed
+
+
+def time_residuals(bins, nbins):
+    """
+    Replaces the bins at each time (the first dimension of bins) with
+    their difference from the bins at the previous time, modulo nbins.
+    Consecutive forecast times are similar so most of these are zero.
+    """
+    bins = np.asarray(bins)
+    residuals = bins.copy()
+    residuals[1:] = np.mod(bins[1:] - bins[:-1], nbins)
+    return residuals
+
+
+def undo_time_residuals(residuals, nbins):
+    """
+    Inverse of time_residuals.
+    """
+    return np.mod(np.cumsum(residuals, axis=0), nbins)
+
+
+def sparse_bins(bins, nbins):
+    """
+    Stores the non zero values of bins, which hold integers in
+    [0, nbins).  The result is a varint holding the number of non zero
+    bins, varints holding the number of zeros before each of them (the
+    run lengths) and then their values (less one) packed using
+    pack_ints.
+
+    See Also: expand_sparse_bins
+    """
+    flat = np.asarray(bins).reshape(-1)
+    nonzero = np.flatnonzero(flat)
+    runs = np.diff(np.concatenate([[-1], nonzero])) - 1
+    out = [_pack_varints([nonzero.size]), _pack_varints(runs)]
+    if nonzero.size:
+        out.append(pack_ints(flat[nonzero] - 1,
+                             _bits_for(max(nbins - 1, 1)))['packed_array'])
+    return ''.join(out)
+
+
+def expand_sparse_bins(packed_array, shape, nbins):
+    """
+    Inverse of sparse_bins.
+    """
+    (count, ), offset = _unpack_varints(packed_array, 1)
+    runs, offset = _unpack_varint_array(packed_array, count, offset)
+    bins = np.zeros(int(np.prod(shape)), dtype=np.int64)
+    if count:
+        values = unpack_ints(buffer(packed_array, offset),
+                             _bits_for(max(nbins - 1, 1)), (count, ))
+        bins[np.cumsum(runs + 1) - 1] = values + 1
+    return bins.reshape(shape)
+
+
+def _default_codec(vname, values, divs=None, compressed=True):
+    """
+    Picks the codec used for a variable in one of the newer formats when
+    none was requested, returning the codec and packed data.  The
+    original format (version 1) always uses 'raw'.  Mostly dry
+    precipitation is much smaller when stored sparsely, so variables
+    with less than _SPARSE_FRACTION of their bins non zero can be stored
+    using 'sparse'.  If compressed is True the payload compresses the
+    variable later on and 'sparse' is chosen if it's smaller than 'raw',
+    otherwise the smallest of 'raw', 'zlib' and 'sparse' is chosen.
+    """
+    bins, nbins, bits = _bin_field(vname, values, divs)
+    codecs = ['raw'] if compressed else ['raw', 'zlib']
+    if np.count_nonzero(bins) < _SPARSE_FRACTION * bins.size:
+        codecs.append('sparse')
+    candidates = [(c, _encode_bins(bins, nbins, bits, c)) for c in codecs]
+    return min(candidates, key=lambda x: len(x[1]))
+
+
+def _has_ensemble(bins):
+    """
+    Binned variables only have four dimensions when they hold an
+    ensemble, which is then the second (see _variables).
+    """
+    return np.ndim(bins) == 4
+
+
+def ensemble_residuals(bins, nbins):
+    """
+    Replaces the bins of each ensemble member (the second dimension of
+    bins) other than the first, which is the control, with their
+    difference from the bins of the control modulo nbins.  Members which
+    agree with the control are stored as zeros.
+    """
+    bins = np.asarray(bins)
+    residuals = bins.copy()
+    residuals[:, 1:] = np.mod(bins[:, 1:] - bins[:, :1], nbins)
+    return residuals
+
+
+def undo_ensemble_residuals(residuals, nbins):
+    """
+    Inverse of ensemble_residuals.
+    """
+    bins = np.asarray(residuals).copy()
+    bins[:, 1:] = np.mod(bins[:, 1:] + bins[:, :1], nbins)
+    return bins
+
+
+def _field_codec(codec, vname):
+    """
+    The codec argument to to_beaufort can either be the name of a codec
+    or a dictionary mapping from variable name to codec.  This returns
+    the codec to use for vname, or None if it wasn't specified.
+    The joint wind field is always range coded (see tiny_wind).
+    """
+    if vname == conv.WIND:
+        return 'range'
+    if isinstance(codec, dict):
+        codec = codec.get(vname, None)
+    if codec is not None and codec not in _codecs:
+        raise ValueError("unknown codec %s" % codec)
+    return codec
+
+
+def _pack_varints(values):
+    """
+    Packs non negative integers seven bits to a byte, least significant
+    first, with the top bit of each byte set if more bytes follow.
+    """
+    values = np.asarray(values, dtype=np.int64).reshape(-1)
+    assert np.all(values >= 0)
+    # the number of bytes each value takes
+    sizes = np.ones(values.size, dtype=np.int64)
+    for i in range(1, 9):
+        sizes += values >= 2 ** (7 * i)
+    # the index of the value each byte belongs to and which of its
+    # bytes it is.
+    owner = np.repeat(np.arange(values.size), sizes)
+    position = np.arange(owner.size) - np.repeat(np.cumsum(sizes) - sizes,
+                                                 sizes)
+    out = (values[owner] >> (7 * position)) & 0x7f
+    out |= (position < sizes[owner] - 1) << 7
+    return out.astype(np.uint8).tostring()
+
+
+def _unpack_varints(data, count, offset=0):
+    """
+    Inverse of _pack_varints, reads count integers from data starting
+    at offset and returns them along with the offset of the next byte.
+    """
+    values = []
+    for _ in range(count):
+        v = 0
+        shift = 0
+        while True:
+            byte = ord(data[offset])
+            offset += 1
+            v |= (byte & 0x7f) << shift
+            shift += 7
+            if not byte & 0x80:
+                break
+        values.append(v)
+    return values, offset
+
+
+def _unpack_varint_array(data, count, offset=0):
+    """
+    A whole array version of _unpack_varints, which returns an array.
+    """
+    data = np.frombuffer(data, dtype=np.uint8, offset=offset)
+    ends = np.flatnonzero(data < 0x80)[:count]
+    if ends.size < count:
+        raise ValueError("data ended part way through the varints")
+    size = ends[-1] + 1 if count else 0
+    data = data[:size].astype(np.int64)
+    # the index of the value each byte belongs to and which of its
+    # bytes it is.
+    owner = np.zeros(size, dtype=np.int64)
+    owner[ends[:-1] + 1] = 1
+    owner = np.cumsum(owner)
+    starts = np.concatenate([[0], ends[:-1] + 1]).astype(np.int64)
+    position = np.arange(size) - starts[owner]
+    values = np.zeros(count, dtype=np.int64)
+    np.add.at(values, owner, (data & 0x7f) << (7 * position))
+    return values, offset + size
+
+
+def _bits_for(nbins):
+    """
+    The number of bits pack_ints should use for values in [0, nbins).
+    """
+    return int(max(1, np.ceil(np.log2(nbins))))
+
+
+def adaptive_divs(values, nbins, resolution):
+    """
+    Computes (at most) nbins divs which are evenly spaced between the
+    0.5 and 99.5 percentiles of values.  Since expand_bins returns the
+    middle of each bin this does better than placing the divs at the
+    quantiles of values, which leaves wide bins in the tails.  The divs
+    are rounded to a multiple of resolution so they can be stored
+    compactly, and any which end up the same after rounding are dropped.
+    If none of the values are finite None is returned.
+    """
+    values = np.asarray(values)
+    values = values[np.isfinite(values)]
+    if not values.size:
+        return None
+    lower, upper = np.percentile(values, [0.5, 99.5])
+    divs = np.linspace(lower, upper, nbins)
+    steps = np.unique(np.round(divs / resolution).astype(np.int64))
+    return steps * resolution
+
+
+def _pack_table(vname, divs):
+    """
+    Packs a set of adaptive divs as the number of divs followed by
+    varints holding the (zigzag encoded) first div and the increments
+    between the divs, all in units of the variable's _table_resolution.
+    Wind directions are always compass_divs, so only the number of
+    points is stored.
+    """
+    if np.size(divs) >= 2 ** (_MAX_TABLE_BITS + 1):
+        raise ValueError("tables can hold at most %d divs, not %d"
+                         % (2 ** (_MAX_TABLE_BITS + 1) - 1, np.size(divs)))
+    if vname == conv.WIND_DIR:
+        return chr(divs.size)
+    resolution = _table_resolution[vname]
+    steps = np.round(np.asarray(divs) / resolution).astype(np.int64)
+    return chr(steps.size) + _pack_varints([_zigzag(steps[0])] +
+                                           list(np.diff(steps)))
+
+
+def _unpack_table(vname, data):
+    """
+    Inverse of _pack_table, returns the divs and the number of bytes
+    the table took up.
+    """
+    count = ord(data[0])
+    if vname == conv.WIND_DIR:
+        return compass_divs(count), 1
+    resolution = _table_resolution[vname]
+    values, offset = _unpack_varints(data, count, 1)
+    steps = np.cumsum([_unzigzag(values[0])] + values[1:]).astype(np.int64)
+    return steps * resolution, offset
+
+
+def _adaptive_tables(fields, adaptive):
+    """
+    Computes adaptive divs for the fields listed in adaptive, which is
+    either True (for all the _adaptive_variables), a list of variable
+    names, or a dictionary mapping from variable name to the number of
+    bits that should be used, from 1 to _MAX_TABLE_BITS.  Variables
+    without any finite values keep the fixed divs.
+    """
+    if not adaptive:
+        return {}
+    if adaptive is True:
+        adaptive = _adaptive_variables
+    if not isinstance(adaptive, dict):
+        adaptive = dict((v, _variables[v]['bits']) for v in adaptive)
+    tables = {}
+    for vname, bits in adaptive.iteritems():
+        if bits not in range(1, _MAX_TABLE_BITS + 1):
+            raise ValueError("adaptive divs for %s must use from 1 to %d "
+                             "bits, not %s" % (vname, _MAX_TABLE_BITS, bits))
+        if vname == conv.WIND_DIR:
+            if vname in fields:
+                tables[vname] = compass_divs(2 ** bits)
+            continue
+        if vname not in _table_resolution:
+            raise ValueError("%s can't use adaptive divs" % vname)
+        if vname in fields:
+            divs = adaptive_divs(fields[vname], 2 ** bits,
+                                 _table_resolution[vname])
+            if divs is not None:
+                tables[vname] = divs
+    return tables
+
+
+def _codec_id(codec, table=None):
+    """
+    The number used to identify codec in payloads, with the _TABLE_FLAG
+    set if the variable has its own divs.
+    """
+    return _codecs.index(codec) | (_TABLE_FLAG if table is not None else 0)
+
+
+def _stringify(vname, packed, codec='raw', table=None):
+    """
+    Prefixes a packed variable with its id and length.  The upper
+    four bits of the id byte hold the codec.  If the variable uses
+    adaptive divs the packed table (see _pack_table) is held at the
+    start of the data.
+    """
+    if table is not None:
+        packed = table + packed
+    vid = _variable_order.index(vname) | (_codec_id(codec, table) << 4)
+    l = np.array(len(packed), dtype=np.uint16)
+    # make sure the length fits in 16 bits
+    assert len(packed) == l
+    return ''.join([struct.pack('>BH', vid, l), packed])
+
+
+def _indexed_beaufort(obj, coordinates, fields, codec=None, tables=None):
+    """
+    Writes the indexed container format.  This consists of a version
+    byte and the length of the (compressed) index, followed by the
+    index and then each of the independently compressed variables.
+    Each entry in the index holds the variable id, codec, time index
+    (or _ALL_TIMES), offset, length and shape of a chunk of data.  The
+    dimensions of the shape are 32 bit, since the sea cells of a masked
+    grid (see sea_cells) form a single row which can be long.
+    Variables with a time dimension are split into one chunk per time,
+    unless they are stored with one of the _whole_variable_codecs.
+    Variables with adaptive divs have an additional chunk holding the
+    packed table, which is marked with the _TABLE_FLAG.
+    """
+    tables = tables or {}
+    entries = []
+    chunks = []
+    offset = [0]
+
+    def add(vname, codec_id, time_index, shape, packed):
+        entries.append(struct.pack('>BBHIIB', _variable_order.index(vname),
+                                   codec_id, time_index,
+                                   offset[0], len(packed), len(shape)))
+        entries.append(struct.pack('>%dI' % len(shape), *shape))
+        chunks.append(packed)
+        offset[0] += len(packed)
+
+    # the coordinates are already compressed
+    for vname, packed in coordinates.iteritems():
+        if vname == conv.LAND:
+            shape = (obj[conv.LAT].size, obj[conv.LON].size)
+        else:
+            shape = obj[vname].shape
+        add(vname, _codec_id('raw'), _ALL_TIMES, shape, packed)
+
+    def encode(vname, values):
+        divs = tables.get(vname, None)
+        field_codec = _field_codec(codec, vname)
+        if field_codec is not None:
+            return field_codec, _encode_field(vname, values, field_codec,
+                                              divs)
+        # the chunks of an indexed payload are stored as is
+        return _default_codec(vname, values, divs, compressed=False)
+
+    for vname, values in fields.iteritems():
+        if vname in tables:
+            table = _pack_table(vname, tables[vname])
+            add(vname, _codec_id('raw', table), _ALL_TIMES,
+                tables[vname].shape, table)
+        if (_variables[vname]['dims'][0] == conv.TIME and
+                _field_codec(codec, vname) not in _whole_variable_codecs):
+            for i, x in enumerate(values):
+                field_codec, packed = encode(vname, x)
+                add(vname, _codec_id(field_codec), i, x.shape, packed)
+        else:
+            field_codec, packed = encode(vname, values)
+            add(vname, _codec_id(field_codec), _ALL_TIMES, values.shape,
+                packed)
+
+    index = zlib.compress(''.join(entries), 9)
+    header = struct.pack('>BI', _INDEXED_VERSION, len(index))
+    return ''.join([header, index] + chunks)
+
+
+def to_beaufort(obj, indexed=False, codec=None, adaptive=None, land=None,
+                joint_wind=False, progressive=None):
     """
     Takes an object holding wind and precip, cloud or pressure
     variables and compresses it by converting zonal and meridional
     winds to wind speed and direction, then compressing to
     beaufort scales and second order cardinal directions.
+
+    By default the entire payload is compressed in one go.  If indexed
+    is True the indexed container format is used instead, in which each
+    variable (and forecast time) is compressed separately so that
+    from_beaufort can expand only the parts it is asked for, at the cost
+    of a slightly larger payload.
+
+    The codec used to store the binned variables can be chosen using
+    'codec', which is either one of _codecs or a dictionary mapping from
+    variable name to codec (see _encode_field).  'range' usually results
+    in the smallest payloads but is slower to encode and decode.
+
+    By default the binned variables use the fixed divs in _variables.
+    If adaptive is True, divs are instead evenly spaced between the 0.5
+    and 99.5 percentiles of each of the _adaptive_variables in obj (see
+    adaptive_divs) and stored in the payload, which gives more precision
+    when a forecast only spans a few of the fixed bins (pressure in the
+    tropics for example).  adaptive can also be a list of variables, or
+    a dictionary mapping from variables to the number of bits to use for
+    each (see _adaptive_tables).
+
+    Cells which are land can be left out of the binned variables by
+    passing a boolean (lat, lon) array, land, which is True over land.
+    If land is None the conv.LAND variable in obj is used if there is
+    one, which poseidon adds from the model's land cover if the query
+    asks for it (see poseidon.gridded_forecast).  The mask itself is
+    stored in the payload (see small_land) and the land cells are
+    filled with nans when the payload is expanded.  The sea cells
+    are stored as a single row, so the 'median' codec can only predict
+    each cell from its west neighbour, which costs it most of its
+    advantage over 'range'.
+
+    If joint_wind is True the wind speeds and directions are quantized
+    together using the current wind codebook, which uses fewer compass
+    points at low speeds, and range coded (see tiny_wind).
+
+    If progressive is given the payload starts with a grid no finer than
+    'progressive' degrees, followed by layers which each double the
+    resolution up to that of obj (see _progressive_beaufort).  If the
+    payload is cut short from_beaufort expands the layers which arrived.
     """
     # first we make sure all the data is in the expected units
     check_beaufort(obj)
-    uwnd = obj[conv.UWND].values
-    vwnd = obj[conv.VWND].values
-    # keep this ordered so the coordinates get written (and read) first
-    encoded_variables = OrderedDict()
-    encoded_variables[conv.TIME] = small_time(obj[conv.TIME])['packed_array']
-    for v in [conv.LAT, conv.LON]:
-        small = small_array(np.asarray(obj[v].values).astype(_variables[v]['dtype']),
-                            _variables[v]['least_significant_digit'])
-        encoded_variables[v] = small['packed_array']
-    # convert the wind speeds to a beaufort scale and store them
-    # TODO: this would be a lot faster if we used numpy directly
-    wind = [objects.Wind(*x) for x in zip(uwnd[:].flatten(), vwnd[:].flatten())]
-    speeds = np.array([x.speed for x in wind]).reshape(uwnd.shape)
-    assert obj[conv.UWND].attrs[conv.UNITS] == _units[conv.WIND_SPEED]
-    assert obj[conv.VWND].attrs[conv.UNITS] == _units[conv.WIND_SPEED]
-    speeds = speeds.astype(_variables[conv.WIND_SPEED]['dtype'])
-    tiny_wind = tiny_array(speeds, bits=_variables[conv.WIND_SPEED]['bits'],
-            divs=_beaufort_scale)
-    encoded_variables[conv.WIND_SPEED] = tiny_wind['packed_array']
-
-    # convert the direction to cardinal directions and store them
-    directions = np.array([x.dir for x in wind]).reshape(uwnd.shape)
-    directions.astype(_variables[conv.WIND_DIR]['dtype'])
-    tiny_direction = tiny_array(directions,
-            bits=_variables[conv.WIND_DIR]['bits'], divs=_direction_bins,
-            wrap=True)
-    encoded_variables[conv.WIND_DIR] = tiny_direction['packed_array']
+    land = land_mask(obj, land)
+    # keep this ordered so the coordinates get written (and read) first,
+    # regularly spaced coordinates are only stored as sequences in the
+    # newer formats
+    coordinates = _beaufort_coordinates(obj, sequences=indexed or
+                                        progressive is not None)
+    fields = _beaufort_fields(obj)
+    if joint_wind:
+        fields = _joint_wind_fields(fields)
+    if land is not None:
+        coordinates[conv.LAND] = small_land(land)
+        sea = OrderedDict((k, sea_cells(v, land))
+                          for k, v in fields.iteritems())
+    else:
+        sea = fields
+    tables = _adaptive_tables(sea, adaptive)
+    if progressive is not None:
+        if indexed:
+            raise ValueError("progressive payloads can't be indexed")
+        strides = progressive_strides(obj[conv.LAT].values,
+                                      obj[conv.LON].values, progressive)
+        return _progressive_beaufort(coordinates, fields, strides, codec,
+                                     tables, land)
+    fields = sea
+    if indexed:
+        return _indexed_beaufort(obj, coordinates, fields, codec, tables)
+
+    encoded = []
+    for vname, values in fields.iteritems():
+        field_codec = _field_codec(codec, vname)
+        divs = tables.get(vname, None)
+        table = None
+        if divs is not None:
+            table = _pack_table(vname, divs)
+        if field_codec is None:
+            # the original format has no other codecs
+            field_codec = 'raw'
+        packed = _encode_field(vname, values, field_codec, divs)
+        if len(packed) + len(table or '') > _MAX_RECORD_SIZE:
+            # too big for the original format
+            coordinates.update(_beaufort_coordinates(obj, sequences=True))
+            return _chunked_beaufort(coordinates, fields, codec, tables)
+        encoded.append((vname, packed, field_codec, table))
+
+    records = [_stringify(k, v) for k, v in coordinates.iteritems()]
+    records.extend(_stringify(*x) for x in encoded)
+    return zlib.compress(''.join(records), 9)
+
+
+def _chunked_record(vname, packed, codec='raw', table=None, ntimes=None):
+    """
+    The chunked format version of _stringify.  The length of the record
+    is stored as a varint following the id byte, and the data of binned
+    variables starts with a varint holding the number of forecast times
+    in the chunk, followed by any adaptive table.
+    """
+    vid = _variable_order.index(vname) | (_codec_id(codec, table) << 4)
+    prefix = ''
+    if ntimes is not None:
+        prefix = _pack_varints([ntimes]) + (table or '')
+    return ''.join([chr(vid), _pack_varints([len(prefix) + len(packed)]),
+                    prefix, packed])
 
-    if conv.ENSEMBLE in obj:
-        encoded_variables[conv.ENSEMBLE] = small_ensemble(obj[conv.ENSEMBLE])
 
-    if conv.ENS_SPREAD_WS in obj:
-        tiny_ws_spread = tiny_array(obj[conv.ENS_SPREAD_WS].values,
-                bits=_variables[conv.ENS_SPREAD_WS]['bits'],
-                divs=_ws_spread_scale)
-        encoded_variables[conv.ENS_SPREAD_WS] = tiny_ws_spread['packed_array']
+def _chunked_beaufort(coordinates, fields, codec=None, tables=None):
+    """
+    Writes the chunked format, which is used for forecasts with variables
+    that are too large for the 16 bit lengths of the original format.
+    This is a version byte followed by a zlib compressed sequence of
+    records (see _chunked_record).  Each binned variable is split into
+    chunks holding as many whole forecast times as fit in about
+    _MAX_RECORD_SIZE bytes, each of which is encoded on its own.
+    """
+    records = [_chunked_record(k, v) for k, v in coordinates.iteritems()]
+    for vname, values in fields.iteritems():
+        records.extend(_chunked_field_records(vname, values, codec, tables))
+    return chr(_CHUNKED_VERSION) + zlib.compress(''.join(records), 9)
 
-    if conv.PRECIP in obj:
-        tiny_precip = tiny_array(obj[conv.PRECIP].values,
-                bits=_variables[conv.PRECIP]['bits'], divs=_precip_scale)
-        encoded_variables[conv.PRECIP] = tiny_precip['packed_array']
 
-    if conv.PRESSURE in obj:
-        tiny_pres = tiny_array(obj[conv.PRESSURE].values,
-                bits=_variables[conv.PRESSURE]['bits'], divs=_pressure_scale)
-        encoded_variables[conv.PRESSURE] = tiny_pres['packed_array']
+def _chunked_field_records(vname, values, codec=None, tables=None):
+    """
+    Returns the chunked format records holding a binned variable, each
+    of which holds as many whole forecast times as fit in about
+    _MAX_RECORD_SIZE bytes.  Each chunk is sized from its own encoded
+    length, so times which compress worse than others get smaller
+    chunks.  A single time which is larger still gets a record of its
+    own.
+    """
+    tables = tables or {}
+    field_codec = _field_codec(codec, vname)
+    divs = tables.get(vname, None)
+    table = None
+    if divs is not None:
+        table = _pack_table(vname, divs)
+
+    def encode(x):
+        if field_codec is None:
+            return _default_codec(vname, x, divs)
+        return field_codec, _encode_field(vname, x, field_codec, divs)
+    records = []
+    start = 0
+    step = values.shape[0]
+    while start < values.shape[0]:
+        chunk = values[start:start + step]
+        chunk_codec, packed = encode(chunk)
+        record = _chunked_record(vname, packed, chunk_codec, table,
+                                 chunk.shape[0])
+        if len(record) > _MAX_RECORD_SIZE and chunk.shape[0] > 1:
+            # try again with as many times as would have fit
+            step = min(chunk.shape[0] - 1,
+                       chunk.shape[0] * _MAX_RECORD_SIZE // len(record))
+            step = max(1, step)
+            continue
+        records.append(record)
+        start += chunk.shape[0]
+    return records
+
+
+def progressive_strides(lats, lons, coarsest):
+    """
+    Returns the strides of the layers of a progressive payload, starting
+    with the largest power of two which gives a grid no finer than
+    'coarsest' degrees and halving down to 1 (the full grid).
+    """
+    deltas = [np.max(np.abs(np.diff(x))) for x in [lats, lons]
+              if np.size(x) > 1]
+    delta = max(deltas) if len(deltas) else coarsest
+    stride = 1
+    while stride * 2 * delta <= coarsest + 1e-6 and stride < 128:
+        stride *= 2
+    strides = [stride]
+    while strides[-1] > 1:
+        strides.append(strides[-1] // 2)
+    return strides
+
+
+def _layer_skip(shape, land, stride, previous=None):
+    """
+    Returns a boolean mask of the cells of the grid at 'stride' which
+    are not stored in its layer of a progressive payload, which are the
+    land cells and those held by the layer at stride 'previous'.
+    """
+    if land is None:
+        skip = np.zeros(shape, dtype=np.bool_)[::stride, ::stride]
+    else:
+        skip = land[::stride, ::stride].copy()
+    if previous is not None:
+        ratio = previous // stride
+        skip[::ratio, ::ratio] = True
+    return skip
+
+
+def _progressive_beaufort(coordinates, fields, strides, codec=None,
+                          tables=None, land=None):
+    """
+    Writes the progressive format, which starts with a version byte and
+    the number of layers followed by the stride of each of them.  Each
+    layer is then held as a varint length and a zlib compressed sequence
+    of chunked format records (see _chunked_record).  The first layer
+    holds the coordinates of the full grid and the binned variables
+    subsampled at the first (largest) stride.  Every other layer holds
+    the cells of the grid at its stride which aren't in the previous
+    layer, stored a row at a time like sea cells (see sea_cells), so a
+    payload which is cut short can still be expanded at the resolution
+    of the last complete layer.
+    """
+    shape = fields.values()[0].shape[-2:]
+    layers = []
+    previous = None
+    for stride in strides:
+        skip = _layer_skip(shape, land, stride, previous)
+        if previous is None:
+            records = [_chunked_record(k, v)
+                       for k, v in coordinates.iteritems()]
+        else:
+            records = []
+        if not np.all(skip):
+            for vname, values in fields.iteritems():
+                values = values[..., ::stride, ::stride]
+                if np.any(skip):
+                    values = sea_cells(values, skip)
+                records.extend(_chunked_field_records(vname, values, codec,
+                                                      tables))
+        layer = zlib.compress(''.join(records), 9)
+        layers.append(_pack_varints([len(layer)]) + layer)
+        previous = stride
+    header = [chr(_PROGRESSIVE_VERSION), chr(len(strides))]
+    header.extend(chr(x) for x in strides)
+    return ''.join(header + layers)
+
+
+def _record_header(payload, offset, chunked=False):
+    """
+    Parses the header of the variable record starting at offset and
+    returns a tuple (vid, start, end) such that payload[start:end] holds
+    the packed array, or None if payload doesn't (yet) hold the header.
+    """
+    if chunked:
+        # the first byte is the variable id, followed by a varint length
+        end = offset + 1
+        while end < len(payload) and ord(payload[end]) & 0x80:
+            end += 1
+        if end >= len(payload):
+            return None
+        (vlen, ), start = _unpack_varints(payload, 1, offset + 1)
+        return ord(payload[offset]), start, start + vlen
+    if len(payload) - offset < 3:
+        return None
+    # the first byte is the variable id,
+    # the second and third bytes store the length of the array
+    vid, vlen = struct.unpack_from('>BH', payload, offset)
+    start = offset + 3
+    return vid, start, start + vlen
+
+
+def _next_record(payload, offset, chunked=False):
+    """
+    Like _record_header, but returns None unless payload holds the
+    entire record.
+    """
+    record = _record_header(payload, offset, chunked)
+    if record is None or record[2] > len(payload):
+        return None
+    return record
 
-    def stringify(vname, packed):
-        vid = _variable_order.index(vname)
-        l = np.array(len(packed), dtype=np.uint16)
-        # make sure the length fits in 16 bits
-        assert len(packed) == l
-        l0 = (l >> 8) & 0xff
-        l1 = l & 0xff
-        header = np.array([vid, l0, l1], dtype=np.uint8).tostring()
-        return ''.join([header, packed])
 
-    payload = ''.join(stringify(k, v) for k, v in encoded_variables.iteritems())
-    return zlib.compress(payload, 9)
+def _record_info(vid, packed, chunked=False):
+    """
+    Uses the _variables lookup table to infer dimensions etc ...
+    for the variable with id vid and attaches the packed data.
+    Records of binned variables in chunked payloads also hold the
+    number of forecast times in the chunk, which is put in 'ntimes'.
+    """
+    # the lower four bits of the id byte identify the variable
+    # and the upper four bits the codec.
+    vname = _variable_order[vid & 0x0f]
+    info = _variables[vname].copy()
+    codec_id = vid >> 4
+    info['codec'] = _codecs[codec_id & ~_TABLE_FLAG]
+    if chunked and 'divs' in info:
+        (info['ntimes'], ), offset = _unpack_varints(packed, 1)
+        packed = buffer(packed, offset)
+    info['table'] = bool(codec_id & _TABLE_FLAG)
+    if info['table']:
+        packed = buffer(packed, _use_table(vname, info, packed))
+    info['packed_array'] = packed
+    return vname, info
+
+
+def _use_table(vname, info, table):
+    """
+    Replaces the divs (and bits) in info with those in a packed table,
+    returning the number of bytes the table took up.
+    """
+    divs, size = _unpack_table(vname, table)
+    info['divs'] = divs
+    info['bits'] = _bits_for(divs.size)
+    return size
 
 
-def unstring_beaufort(payload):
+def unstring_beaufort(payload, chunked=False):
     """
     This takes an encoded set of variables and decodes them.
     The payload starts with a variable id, followed by the
     length of the data.  This can be later used, along with the
     _variables lookup table, to rebuild a full xray object.
+    If chunked is True the (decompressed) payload holds the records
+    of the chunked format, in which case a variable may be yielded
+    several times, once for each of its chunks.
+
+    The payload is walked using an offset and the packed arrays
+    that are yielded are read only buffers into payload, so
+    no data is copied.
     """
-    while len(payload):
-        # the first bit is the variable id,
-        # the second and third bits store the length of the array
-        vid, l0, l1 = np.fromstring(payload[:3], dtype=np.uint8)
-        # convert the two single bit lengths to the full length
-        vlen = (l0 << 8) + l1
-        # the packed array resides in the rest of the payload
-        packed = payload[3:(vlen + 3)]
-        # determine the variable name
-        vname = _variable_order[vid]
-        # use the _variable lookup table to infer dimensions etc ...
-        info = _variables[vname]
-        # the resulting info should be unpackable
-        info['packed_array'] = packed
-        # discard the now parsed variable
-        payload = payload[(vlen + 3):]
-        yield vname, info
+    offset = 0
+    while offset < len(payload):
+        record = _next_record(payload, offset, chunked)
+        if record is None:
+            raise ValueError("payload ended part way through a variable")
+        vid, start, end = record
+        yield _record_info(vid, buffer(payload, start, end - start), chunked)
+        offset = end
+
+
+class BeaufortParser(object):
+    """
+    An incremental version of unstring_beaufort for payloads that
+    arrive in pieces, for example when read in chunks from a file
+    or socket.  Compressed data is passed to feed() and each call
+    returns the (vname, info) pairs for any variables which have
+    been completed.
+
+    Typical usage:
+
+    parser = BeaufortParser()
+    for chunk in iter(lambda: f.read(4096), ''):
+        for vname, info in parser.feed(chunk):
+            ...
+    for vname, info in parser.close():
+        ...
+
+    Both the original and the chunked payloads can be parsed, which is
+    decided from the first byte of compressed data.  Uncompressed data
+    is assumed to hold records of the original format unless chunked
+    is True.
+    """
+    def __init__(self, compressed=True, chunked=False):
+        self._decompressor = zlib.decompressobj() if compressed else None
+        # compressed payloads start with a zlib header or a version byte
+        self._chunked = None if compressed else chunked
+        # the pieces of not yet parsed payload and the number of bytes
+        # required before the next variable can be parsed.
+        self._pending = []
+        self._pending_size = 0
+        self._required = 3
+
+    def feed(self, data):
+        if self._chunked is None and len(data):
+            version = payload_version(data)
+            self._chunked = version == _CHUNKED_VERSION
+            if self._chunked:
+                data = data[1:]
+            elif version != 1:
+                raise ValueError("unsupported payload version %d" % version)
+        if self._decompressor is not None:
+            data = self._decompressor.decompress(data)
+        return self._parse(data)
+
+    def _parse(self, data):
+        """
+        Adds decompressed data to the pending payload, returning the
+        (vname, info) pairs of any variables it completes.
+        """
+        if len(data):
+            self._pending.append(data)
+            self._pending_size += len(data)
+        # avoid joining the pieces until there is something to parse,
+        # this way large variables which arrive in many chunks are
+        # only copied once.
+        if self._pending_size < self._required:
+            return []
+        payload = ''.join(self._pending)
+        variables = []
+        offset = 0
+        while True:
+            record = _next_record(payload, offset, self._chunked)
+            if record is None:
+                break
+            vid, start, end = record
+            variables.append(_record_info(vid, buffer(payload, start,
+                                                      end - start),
+                                          self._chunked))
+            offset = end
+        # hold on to the start of any partial variable
+        self._pending = [payload[offset:]] if offset < len(payload) else []
+        self._pending_size = len(payload) - offset
+        header = _record_header(payload, offset, self._chunked)
+        if header is not None:
+            self._required = header[2] - offset
+        else:
+            self._required = self._pending_size + 1
+        return variables
+
+    def close(self):
+        """
+        Signals that all the data has been fed, returning the (vname,
+        info) pairs of any variables completed by the data still held
+        by the decompressor, and raising a ValueError if the payload
+        ended part way through a variable.
+        """
+        variables = []
+        if self._decompressor is not None:
+            variables = self._parse(self._decompressor.flush())
+        if self._pending_size:
+            raise ValueError("payload ended part way through a variable")
+        return variables
+
+
+def read_beaufort(fileobj, chunk_size=4096):
+    """
+    Reads a compressed payload from a file-like object chunk_size bytes
+    at a time, yielding (vname, info) pairs as each variable is completed.
+    """
+    parser = BeaufortParser()
+    for chunk in iter(lambda: fileobj.read(chunk_size), ''):
+        for variable in parser.feed(chunk):
+            yield variable
+    for variable in parser.close():
+        yield variable
 
 
-def beaufort_to_dict(payload):
+def payload_version(payload):
+    """
+    Returns the version of the format used to write a payload.  The
+    original format (version 1) is a single zlib stream, so starts with
+    a zlib header, other formats start with a version byte
+    (_INDEXED_VERSION, _CHUNKED_VERSION, _PROGRESSIVE_VERSION or, for
+    diffs, _DIFF_VERSION).
+    """
+    first = ord(payload[0])
+    # the lower four bits of a zlib header hold the compression
+    # method, which is always 8 (deflate).
+    if first & 0x0f == 8:
+        return 1
+    return first
+
+
+def _infer_shape(dims, cur_vars):
+    """
+    Takes the dimensions of a variable and the current set of (expanded)
+    variables and returns a list of the dims and their sizes.
+    """
+    def iter_dims():
+        for d in dims:
+            if d == conv.ENSEMBLE and conv.ENSEMBLE not in cur_vars:
+                # skip ensemble dimension if it doesn't exist
+                continue
+            yield d, cur_vars[d][1].size
+    dims = list(iter_dims())
+    # returns a list of dims and the shapes
+    return [x for x, _ in dims], [y for _, y in dims]
+
+
+def _expand_coordinate(vname, info):
+    """
+    Expands one of the coordinates (time, lat, lon or ensemble) returning
+    a (dims, data, attributes) tuple.
+    """
+    if vname == conv.TIME:
+        # expand time
+        data, time_units = expand_small_time(
+                info['packed_array'], info['dtype'],
+                info['least_significant_digit'])
+        return (vname, data, {conv.UNITS: time_units})
+    elif vname in [conv.LAT, conv.LON]:
+        # expand latitude and longitude
+        data = expand_small_array(info['packed_array'],
+                                 info['dtype'],
+                                 info['least_significant_digit'])
+        return (vname, data, info.get('attributes', None))
+    elif vname == conv.ENSEMBLE:
+        # expand ensemble numbers
+        data = info['packed_array']
+        n = np.asscalar(np.fromstring(data, dtype=np.int8))
+        return (conv.ENSEMBLE, np.arange(n))
+    raise ValueError("%s is not a coordinate" % vname)
+
+
+def _expand_land(info, cur_vars):
+    """
+    Expands the land mask, returning a (dims, data) tuple.  The latitudes
+    and longitudes must already be in cur_vars.
+    """
+    dims, shape = _infer_shape(info['dims'], cur_vars)
+    return (dims, expand_small_land(info['packed_array'], shape))
+
+
+def _fill_land(data, cur_vars):
+    """
+    Fills the land cells of an expanded variable with nans if the
+    payload held a land mask (which is in cur_vars).
+    """
+    if conv.LAND not in cur_vars:
+        return data
+    return fill_land(data, cur_vars[conv.LAND][1])
+
+
+def _stored_shape(shape, cur_vars):
+    """
+    The shape a binned variable was stored with, which only holds the
+    sea cells if the payload held a land mask.
+    """
+    if conv.LAND not in cur_vars:
+        return shape
+    return _sea_shape(shape, cur_vars[conv.LAND][1])
+
+
+def _expand_field(vname, info, shape):
+    """
+    Expands one of the binned variables to an array with shape 'shape',
+    undoing the codec it was stored with (see _encode_field).
+    """
+    if vname == conv.WIND:
+        speeds, directions = expand_wind(info['packed_array'], shape)
+        return speeds * np.exp(1j * directions)
+    # the wind direction bins wrap around
+    wrap_val = np.pi if vname == conv.WIND_DIR else None
+    if info.get('codec', 'raw') in ['raw', 'zlib']:
+        packed = info['packed_array']
+        if info.get('codec') == 'zlib':
+            packed = zlib.decompress(packed)
+        return expand_unmasked(packed, info['bits'], shape, info['divs'],
+                               info['dtype'], wrap_val=wrap_val)
+    return expand_bins(_field_bins(info, shape), info['divs'],
+                       info['dtype'], wrap_val=wrap_val)
+
+
+def _field_bins(info, shape):
+    """
+    Inverse of _encode_bins, returns the bins of a binned variable with
+    shape 'shape'.
+    """
+    codec = info.get('codec', 'raw')
+    packed = info['packed_array']
+    nbins = info['divs'].size
+    if codec in ['range', 'delta', 'median', 'ensemble', 'sparse']:
+        if codec == 'median':
+            bins = rangecoder.decode_predicted_grid(packed, shape, nbins)
+        elif codec == 'sparse':
+            bins = expand_sparse_bins(packed, shape, nbins)
+        else:
+            bins = rangecoder.decode_grid(packed, shape, nbins)
+        if codec == 'delta':
+            bins = undo_time_residuals(bins, nbins)
+        elif codec == 'ensemble' and _has_ensemble(bins):
+            bins = undo_ensemble_residuals(bins, nbins)
+        return bins
+    if codec == 'zlib':
+        packed = zlib.decompress(packed)
+    return unpack_ints(packed, info['bits'], shape)
+
+
+def _expand_chunks(vname, chunks, shape):
+    """
+    Expands a binned variable which may have been split into several
+    chunks of forecast times, each of which is expanded directly into
+    its slice of the output.
+    """
+    if len(chunks) == 1 and 'ntimes' not in chunks[0]:
+        return _expand_field(vname, chunks[0], shape)
+    data = np.empty(shape, dtype=chunks[0]['dtype'])
+    start = 0
+    for info in chunks:
+        end = start + info['ntimes']
+        data[start:end] = _expand_field(vname, info,
+                                        [info['ntimes']] + list(shape[1:]))
+        start = end
+    if start != shape[0]:
+        raise ValueError("the chunks of %s hold %d of %d times"
+                         % (vname, start, shape[0]))
+    return data
+
+
+def _requested_fields(variables=None):
+    """
+    Takes a list of the variables that are wanted from a payload and
+    returns the set of binned variables which are required to produce
+    them.  If variables is None all of them are required.
+    """
+    fields = [v for v in _variable_order if 'divs' in _variables[v]]
+    if variables is None:
+        return set(fields)
+    required = set()
+    for v in variables:
+        if v in [conv.WIND, conv.UWND, conv.VWND]:
+            required.update([conv.WIND, conv.WIND_SPEED, conv.WIND_DIR])
+        elif v in fields:
+            required.add(v)
+        elif v not in _variable_order:
+            raise ValueError("unknown variable %s" % v)
+    return required
+
+
+def _time_indices(times, hours=None):
+    """
+    Returns the indices of the forecast times which correspond to
+    'hours', where hours are measured in the units of the time
+    coordinate.  If hours is None all the indices are returned.
+    """
+    if hours is None:
+        return np.arange(times.size)
+    inds = []
+    for h in np.atleast_1d(hours):
+        match = np.nonzero(times == h)[0]
+        if not match.size:
+            raise ValueError("hour %s is not in the forecast" % str(h))
+        inds.append(match[0])
+    return np.array(inds)
+
+
+def _add_vector_wind(out):
+    """
+    Adds the zonal and meridional winds to a dictionary holding
+    expanded wind speeds and directions.  Joint winds are first split
+    into speeds and directions.
+    """
+    if conv.WIND in out:
+        dims, joint = out.pop(conv.WIND)[:2]
+        for vname, values in [(conv.WIND_SPEED, np.abs(joint)),
+                              (conv.WIND_DIR, np.angle(joint))]:
+            info = _variables[vname]
+            out[vname] = (dims, values.astype(info['dtype']),
+                          info['attributes'])
+    if conv.WIND_SPEED in out and conv.WIND_DIR in out:
+        dims = out[conv.WIND_SPEED][0]
+        vwnd = -np.cos(out[conv.WIND_DIR][1]) * out[conv.WIND_SPEED][1]
+        uwnd = -np.sin(out[conv.WIND_DIR][1]) * out[conv.WIND_SPEED][1]
+        out[conv.UWND] = (dims, uwnd, {conv.UNITS: 'm/s'})
+        out[conv.VWND] = (dims, vwnd, {conv.UNITS: 'm/s'})
+    return out
+
+
+def beaufort_to_dict(payload, variables=None, hours=None):
     """
     Unpacks a tiny forecast and fills in dimensions and attributes
     using the _variables lookup table.  This can be used directly
-    with xray.Dataset to build a new dataset.
+    with xray.Dataset to build a new dataset.  Unlike from_beaufort it
+    only needs numpy, the variables are returned as (dims, data, attrs)
+    tuples of numpy arrays, with the times in the units held in attrs.
+
+    Parameters
+    ----------
+    payload : string
+        A payload created using to_beaufort.
+    variables : list of strings (optional)
+        The variables that should be expanded ('wind', 'precip' etc...).
+        By default all of them are.
+    hours : list of ints (optional)
+        The forecast hours (in the units of the time coordinate) that
+        should be expanded.  By default all of them are.
     """
-    payload = zlib.decompress(payload)
-    variables = dict(unstring_beaufort(payload))
+    version = payload_version(payload)
+    if version == _INDEXED_VERSION:
+        return _indexed_beaufort_to_dict(payload, variables, hours)
+    if version == _PROGRESSIVE_VERSION:
+        return _progressive_beaufort_to_dict(payload, variables, hours)
+    chunked = version == _CHUNKED_VERSION
+    if chunked:
+        payload = zlib.decompress(buffer(payload, 1))
+    elif version == 1:
+        payload = zlib.decompress(payload)
+    elif version == _DIFF_VERSION:
+        raise ValueError("the payload is a diff, it must first be applied "
+                         "to the previous payload (see apply_beaufort_diff)")
+    else:
+        raise ValueError("unsupported payload version %d" % version)
+    # chunked payloads can hold several records for each variable
+    packed = {}
+    for vname, info in unstring_beaufort(payload, chunked):
+        packed.setdefault(vname, []).append(info)
+    fields = _requested_fields(variables)
     out = {}
-
-    def infer_shape(dims, cur_vars):
-        def iter_dims():
-            # This takes the current set of variables and infers the
-            for d in dims:
-                if d == conv.ENSEMBLE and conv.ENSEMBLE not in cur_vars:
-                    # skip ensemble dimension if it doesn't exist
-                    continue
-                yield d, cur_vars[d][1].size
-        dims = list(iter_dims())
-        # returns a list of dims and the shapes
-        return [x for x, _ in dims], [y for _, y in dims]
-
-    # make sure we go in the variable order, otherwise
+    # make sure we go in the expand order, otherwise
     # some variables may require dimension that haven't been
     # updated yet
-    for vname in _variable_order:
-        if vname not in variables:
+    for vname in _expand_order:
+        if vname not in packed:
             continue
-        info = variables[vname]
-        if vname == conv.TIME:
-            # expand time
-            data, time_units = expand_small_time(
-                    info['packed_array'], info['dtype'],
-                    info['least_significant_digit'])
-            info['attributes'] = {conv.UNITS: time_units}
-            out[vname] = ((vname), data, info.get('attributes', None))
-        elif vname in [conv.LAT, conv.LON]:
-            # expand latitude and longitude
-            data = expand_small_array(info['packed_array'],
-                                     info['dtype'],
-                                     info['least_significant_digit'])
-            out[vname] = (vname, data, info.get('attributes', None))
-        elif vname == conv.ENSEMBLE:
-            # expand ensemble numbers
-            data = info['packed_array']
-            n = np.asscalar(np.fromstring(data, dtype=np.int8))
-            out[conv.ENSEMBLE] = (conv.ENSEMBLE, np.arange(n))
-        elif vname == conv.WIND_DIR:
-            # expand the wind directions
-            dims, shape = list(infer_shape(info['dims'], out))
-            data = expand_array(info['packed_array'],
-                                 bits=info['bits'],
-                                 shape=shape,
-                                 divs=info['divs'],
-                                 dtype=info['dtype'],
-                                 wrap_val=np.pi)
-            out[vname] = (dims, data,
-                          info.get('attributes', None))
-        else:
-            # all other variables
-            dims, shape = list(infer_shape(info['dims'], out))
-            data = expand_array(info['packed_array'],
-                                 bits=info['bits'],
-                                 shape=shape,
-                                 divs=info['divs'],
-                                 dtype=info['dtype'])
-            out[vname] = (dims, data,
+        info = packed[vname][0]
+        if vname == conv.LAND:
+            out[vname] = _expand_land(info, out)
+        elif 'divs' not in info:
+            out[vname] = _expand_coordinate(vname, info)
+        elif vname in fields:
+            dims, shape = _infer_shape(info['dims'], out)
+            data = _expand_chunks(vname, packed[vname],
+                                  _stored_shape(shape, out))
+            out[vname] = (dims, _fill_land(data, out),
                           info.get('attributes', None))
+
     # add vector wind speeds back to the object
-    dims = out[conv.WIND_SPEED][0]
-    vwnd = -np.cos(out[conv.WIND_DIR][1]) * out[conv.WIND_SPEED][1]
-    uwnd = -np.sin(out[conv.WIND_DIR][1]) * out[conv.WIND_SPEED][1]
-    out[conv.UWND] = (dims, uwnd, {conv.UNITS: 'm/s'})
-    out[conv.VWND] = (dims, vwnd, {conv.UNITS: 'm/s'})
+    return _add_vector_wind(_select_hours(out, hours))
+
+
+def _select_hours(out, hours=None):
+    """
+    Pulls the forecast 'hours' out of every variable in a dictionary of
+    expanded variables.
+    """
+    if hours is None:
+        return out
+    inds = _time_indices(out[conv.TIME][1], hours)
+    for k, v in out.items():
+        # coordinates hold the name of their dimension, not a tuple
+        dims = (v[0], ) if isinstance(v[0], basestring) else tuple(v[0])
+        if conv.TIME in dims:
+            axis = dims.index(conv.TIME)
+            out[k] = (v[0], np.take(v[1], inds, axis=axis)) + v[2:]
     return out
 
 
-def from_beaufort(payload):
+def _read_layers(payload):
+    """
+    Returns the strides of the layers of a progressive payload and the
+    (decompressed) records of each of the layers which are complete.
+    """
+    if len(payload) < 2 or len(payload) < 2 + ord(payload[1]):
+        raise ValueError("payload ended part way through its header")
+    nlayers = ord(payload[1])
+    offset = 2 + nlayers
+    strides = [ord(x) for x in payload[2:offset]]
+    layers = []
+    while len(layers) < nlayers:
+        # stop at the first layer which was cut short
+        end = offset
+        while end < len(payload) and ord(payload[end]) & 0x80:
+            end += 1
+        if end >= len(payload):
+            break
+        (size, ), start = _unpack_varints(payload, 1, offset)
+        if start + size > len(payload):
+            break
+        layers.append(zlib.decompress(buffer(payload, start, size)))
+        offset = start + size
+    if not len(layers):
+        raise ValueError("payload ended part way through the first layer")
+    if len(layers) < nlayers:
+        logger.warn("only %d of %d layers of the forecast arrived"
+                    % (len(layers), nlayers))
+    return strides[:len(layers)], layers
+
+
+def _progressive_beaufort_to_dict(payload, variables=None, hours=None):
+    """
+    The progressive payload version of beaufort_to_dict, which expands
+    the variables at the resolution of the last complete layer.
+    """
+    strides, layers = _read_layers(payload)
+    packed = []
+    for layer in layers:
+        records = {}
+        for vname, info in unstring_beaufort(layer, chunked=True):
+            records.setdefault(vname, []).append(info)
+        packed.append(records)
+    fields = _requested_fields(variables)
+    out = {}
+    for vname in _expand_order:
+        if vname not in packed[0]:
+            continue
+        info = packed[0][vname][0]
+        if vname == conv.LAND:
+            out[vname] = _expand_land(info, out)
+        elif 'divs' not in info:
+            out[vname] = _expand_coordinate(vname, info)
+    full_shape = (out[conv.LAT][1].size, out[conv.LON][1].size)
+    land = out[conv.LAND][1] if conv.LAND in out else None
+    for vname in _expand_order:
+        # a layer only lacks a variable if all its cells are land
+        if vname not in fields or not any(vname in x for x in packed):
+            continue
+        info = _variables[vname]
+        dims, shape = _infer_shape(info['dims'], out)
+        data = None
+        previous = None
+        for stride, records in zip(strides, packed):
+            skip = _layer_skip(full_shape, land, stride, previous)
+            layer = np.empty(shape[:-2] + list(skip.shape),
+                             dtype=info['dtype'])
+            layer.fill(np.nan)
+            if data is not None:
+                ratio = previous // stride
+                layer[..., ::ratio, ::ratio] = data
+            if np.all(skip):
+                pass
+            elif np.any(skip):
+                sea = _expand_chunks(vname, records[vname],
+                                     _sea_shape(layer.shape, skip))
+                layer[..., ~skip] = sea[..., 0, :]
+            else:
+                layer = _expand_chunks(vname, records[vname], layer.shape)
+            data = layer
+            previous = stride
+        out[vname] = (dims, data, info.get('attributes', None))
+    # the coordinates of the grid at the resolution of the last layer
+    stride = strides[-1]
+    for vname in [conv.LAT, conv.LON]:
+        out[vname] = (out[vname][0], out[vname][1][::stride]) + \
+            out[vname][2:]
+    if land is not None:
+        out[conv.LAND] = (out[conv.LAND][0], land[::stride, ::stride])
+    return _add_vector_wind(_select_hours(out, hours))
+
+
+def _read_index(payload):
+    """
+    Parses the index of an indexed payload, returning a list of
+    dictionaries each describing a chunk of the payload.  The
+    'packed_array' of each is a buffer into payload.
+    """
+    version, index_size = struct.unpack_from('>BI', payload, 0)
+    if version != _INDEXED_VERSION:
+        raise ValueError("unsupported payload version %d" % version)
+    start = struct.calcsize('>BI') + index_size
+    index = zlib.decompress(buffer(payload, struct.calcsize('>BI'),
+                                   index_size))
+    entries = []
+    offset = 0
+    while offset < len(index):
+        vid, codec, time_index, chunk_offset, size, ndim = \
+            struct.unpack_from('>BBHIIB', index, offset)
+        offset += struct.calcsize('>BBHIIB')
+        shape = struct.unpack_from('>%dI' % ndim, index, offset)
+        offset += struct.calcsize('>%dI' % ndim)
+        entries.append({'vname': _variable_order[vid],
+                        'codec': _codecs[codec & ~_TABLE_FLAG],
+                        'table': bool(codec & _TABLE_FLAG),
+                        'time': time_index,
+                        'shape': shape,
+                        'packed_array': buffer(payload, start + chunk_offset,
+                                               size)})
+    return entries
+
+
+def _indexed_beaufort_to_dict(payload, variables=None, hours=None):
+    """
+    The indexed payload version of beaufort_to_dict.  Only the chunks
+    holding the requested variables and hours are decompressed.
+    """
+    entries = _read_index(payload)
+    fields = _requested_fields(variables)
+    out = {}
+    for vname in _expand_order:
+        chunks = [e for e in entries if e['vname'] == vname]
+        if not len(chunks):
+            continue
+        info = _variables[vname].copy()
+        if vname == conv.LAND:
+            info['packed_array'] = chunks[0]['packed_array']
+            out[vname] = _expand_land(info, out)
+            continue
+        if 'divs' not in info:
+            # the coordinates are stored as is.
+            assert chunks[0]['codec'] == 'raw'
+            info['packed_array'] = chunks[0]['packed_array']
+            out[vname] = _expand_coordinate(vname, info)
+            if vname == conv.TIME:
+                inds = _time_indices(out[vname][1], hours)
+                out[vname] = (vname, out[vname][1][inds], out[vname][2])
+            continue
+        if vname not in fields:
+            continue
+        for table in [c for c in chunks if c['table']]:
+            _use_table(vname, info, table['packed_array'])
+            chunks.remove(table)
+        dims, shape = _infer_shape(info['dims'], out)
+        if chunks[0]['time'] == _ALL_TIMES:
+            info.update(codec=chunks[0]['codec'],
+                        packed_array=chunks[0]['packed_array'])
+            data = _expand_field(vname, info, chunks[0]['shape'])
+            if dims[0] == conv.TIME:
+                # some codecs store all the times in a single chunk
+                data = data[inds]
+        else:
+            by_time = dict((c['time'], c) for c in chunks)
+            data = np.empty(_stored_shape(shape, out), dtype=info['dtype'])
+            for i, t in enumerate(inds):
+                info.update(codec=by_time[t]['codec'],
+                            packed_array=by_time[t]['packed_array'])
+                data[i] = _expand_field(vname, info, by_time[t]['shape'])
+        out[vname] = (dims, _fill_land(data, out),
+                      info.get('attributes', None))
+    return _add_vector_wind(out)
+
+
+def from_beaufort(payload, variables=None, hours=None):
     """
-    Inverse function of to_beaufort()
+    Inverse function of to_beaufort().  Optionally only some of the
+    variables and hours are expanded, see beaufort_to_dict.
     """
-    variables = beaufort_to_dict(payload)
+    import xray
+    variables = beaufort_to_dict(payload, variables, hours)
     out = xray.Dataset(variables)
     out[conv.TIME] = xray.conventions.decode_cf_variable(out[conv.TIME])
     return units.normalize_variables(out)
+
+
+def _valid_times(info):
+    """
+    Returns the valid times held in the packed time coordinate info.
+    """
+    import pandas as pd
+    hours, time_units = expand_small_time(info['packed_array'],
+                                          info['dtype'],
+                                          info['least_significant_digit'])
+    origin = pd.to_datetime(time_units.split('since')[1].strip())
+    return (origin + pd.to_timedelta(hours, unit='h')).values
+
+
+def _payload_bins(payload):
+    """
+    Reads a payload in the original or chunked format, returning an
+    ordered dictionary mapping from the name of each coordinate (and
+    the land mask) to its packed string, the valid times, and an
+    ordered dictionary mapping from the name of each binned variable
+    to a tuple holding its bins and the info of its first record.
+    """
+    version = payload_version(payload)
+    if version == _CHUNKED_VERSION:
+        records = zlib.decompress(buffer(payload, 1))
+    elif version == 1:
+        records = zlib.decompress(payload)
+    else:
+        raise ValueError("can't diff payloads of version %d" % version)
+    packed = OrderedDict()
+    for vname, info in unstring_beaufort(records, version != 1):
+        packed.setdefault(vname, []).append(info)
+    if conv.WIND in packed:
+        raise ValueError("can't diff payloads holding joint winds")
+    coordinates = OrderedDict()
+    out = {}
+    for vname in _expand_order:
+        if vname not in packed or 'divs' in packed[vname][0]:
+            continue
+        info = packed[vname][0]
+        coordinates[vname] = str(info['packed_array'])
+        if vname == conv.LAND:
+            out[vname] = _expand_land(info, out)
+        else:
+            out[vname] = _expand_coordinate(vname, info)
+    bins = OrderedDict()
+    for vname, chunks in packed.iteritems():
+        if vname in coordinates:
+            continue
+        _, shape = _infer_shape(chunks[0]['dims'], out)
+        shape = _stored_shape(shape, out)
+        if len(chunks) == 1 and 'ntimes' not in chunks[0]:
+            bins[vname] = (_field_bins(chunks[0], shape), chunks[0])
+            continue
+        bins[vname] = (np.concatenate([
+            _field_bins(c, [c['ntimes']] + list(shape[1:]))
+            for c in chunks]), chunks[0])
+    return coordinates, _valid_times(packed[conv.TIME][0]), bins
+
+
+def _previous_bins(vname, info, shape, previous, times, previous_times):
+    """
+    Returns the bins of vname in the previous payload at the valid times
+    of the new one, using the latest earlier time for any new times, or
+    zeros if the previous payload doesn't hold comparable bins.
+    """
+    if vname not in previous:
+        return np.zeros(shape, dtype=np.int64)
+    bins, previous_info = previous[vname]
+    if (bins.shape[1:] != tuple(shape[1:]) or
+            previous_info['divs'].size != info['divs'].size):
+        return np.zeros(shape, dtype=np.int64)
+    inds = np.searchsorted(previous_times, times, side='right') - 1
+    return bins[np.clip(inds, 0, previous_times.size - 1)]
+
+
+def _diff_record(vname, bins, info, codecs):
+    """
+    Encodes the bins of a binned variable as a chunked format record,
+    using whichever of codecs is smallest once compressed.
+    """
+    nbins = info['divs'].size
+    candidates = [(c, _encode_bins(bins, nbins, _bits_for(nbins), c))
+                  for c in codecs]
+    codec, packed = min(candidates, key=lambda x: len(zlib.compress(x[1])))
+    table = None
+    if info['table']:
+        table = _pack_table(vname, info['divs'])
+    return _chunked_record(vname, packed, codec, table, bins.shape[0])
+
+
+def beaufort_diff(payload, previous):
+    """
+    Returns a payload holding the changes between the previous payload
+    and a new one, both of which must be in the original or chunked
+    format and on the same grid.  apply_beaufort_diff turns the previous
+    payload and the diff back into the new payload.
+
+    The diff is a version byte and the crc32 of the previous payload,
+    followed by the zlib compressed records of the chunked format (see
+    _chunked_record) holding the coordinates of the new payload and the
+    difference (modulo the number of bins) between the bins of each
+    variable and those of the previous payload at the same valid time.
+    Most bins don't change between forecast runs, so these are mostly
+    zeros.  New times are compared with the last time of the previous
+    payload.
+    """
+    coordinates, times, bins = _payload_bins(payload)
+    previous_coordinates, previous_times, previous_bins = \
+        _payload_bins(previous)
+    for vname in [conv.LAT, conv.LON, conv.ENSEMBLE, conv.LAND]:
+        if coordinates.get(vname) != previous_coordinates.get(vname):
+            raise ValueError("the payloads have different %s" % vname)
+    records = [_chunked_record(k, v) for k, v in coordinates.iteritems()]
+    for vname, (values, info) in bins.iteritems():
+        before = _previous_bins(vname, info, values.shape, previous_bins,
+                                times, previous_times)
+        residuals = np.mod(values - before, info['divs'].size)
+        records.append(_diff_record(vname, residuals, info,
+                                    ['raw', 'zlib', 'range', 'sparse']))
+    header = struct.pack('>BI', _DIFF_VERSION,
+                         zlib.crc32(previous) & 0xffffffff)
+    return header + zlib.compress(''.join(records), 9)
+
+
+def is_beaufort_diff(payload):
+    """
+    Returns whether payload is a diff written by beaufort_diff.
+    """
+    return payload_version(payload) == _DIFF_VERSION
+
+
+def apply_beaufort_diff(previous, diff):
+    """
+    Inverse of beaufort_diff, returns the new payload given the previous
+    payload and the diff.  The new payload is rebuilt in the chunked
+    format, so while it holds the same forecast it won't be the same
+    string that was passed to beaufort_diff.  It is however always the
+    same for the same previous payload and diff, so the sender can call
+    this to find what the recipient holds, and later send a diff from it.
+    """
+    version, crc = struct.unpack_from('>BI', diff, 0)
+    if version != _DIFF_VERSION:
+        raise ValueError("unsupported diff version %d" % version)
+    if crc != zlib.crc32(previous) & 0xffffffff:
+        raise ValueError("the diff doesn't apply to this payload")
+    _, previous_times, previous_bins = _payload_bins(previous)
+    # the diff is laid out like a chunked payload of residuals
+    residuals = chr(_CHUNKED_VERSION) + diff[struct.calcsize('>BI'):]
+    coordinates, times, bins = _payload_bins(residuals)
+    records = [_chunked_record(k, v) for k, v in coordinates.iteritems()]
+    for vname, (values, info) in bins.iteritems():
+        before = _previous_bins(vname, info, values.shape, previous_bins,
+                                times, previous_times)
+        values = np.mod(values + before, info['divs'].size)
+        records.append(_diff_record(vname, values, info, ['raw', 'sparse']))
+    return chr(_CHUNKED_VERSION) + zlib.compress(''.join(records), 9)
@@ -6,6 +6,7 @@ This contains tools for accessing data about the future/past state of the seas.
 from __future__ import with_statement
 
 import os
+import re
 import numpy as np
 import pandas as pd
 import urllib
@@ -13,13 +14,19 @@ import urllib2
 import logging
 import urlparse
 import datetime
+import threading
+
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
 
 from BeautifulSoup import BeautifulSoup
 
 import xray
+import netCDF4
 
 import sl.lib.conventions as conv
 
+from sl.lib import store
 from sl.lib import units
 from sl.lib.objects import NautAngle
 
@@ -37,6 +44,73 @@ _files = {'gfs': 'NCEP/GFS/Global_0p5deg/files/GFS_Global_0p5deg_%Y%m%d_%H00.gri
           'gefs': 'NCEP/GEFS/Global_1p0deg_Ensemble/files/Global_1p0deg_Ensemble_%Y%m%d_%H00.grib2'}
 
 
+# the forecast store (see set_forecast_store) and the size (in grid
+# cells) of the tiles it holds
+_forecast_store = None
+_tile_size = 32
+# the number of requests download makes at once
+_download_threads = 4
+# netCDF isn't thread safe, so opening and closing datasets is serialized
+_open_lock = threading.Lock()
+# the datasets which couldn't be closed (see _close)
+_unclosed = []
+# the cache of the latest run of each model on each server (see
+# set_run_cache).  A new run can't appear until _cycle after the last
+# one, after which the servers are checked at most every _min_ttl, and
+# servers with no runs are skipped for _dead_ttl.
+_run_cache = store.RunCache()
+_cycle = datetime.timedelta(hours=6)
+_min_ttl = datetime.timedelta(minutes=15)
+_dead_ttl = datetime.timedelta(minutes=10)
+# the timeout (in seconds) of requests to the thredds servers
+_timeout = 30
+# the cache of the metadata of each forecast run (see set_metadata_cache)
+_metadata_cache = store.MetadataCache()
+# the attribute of datasets made from metadata (see metadata_dataset)
+# which holds the url they were made from
+_URL_ATTR = 'opendap_url'
+
+# the names each forecast variable has gone by (see lookup_name)
+_variable_names = OrderedDict([
+    (conv.UWND, ['u-component_of_wind_height_above_ground', conv.UWND]),
+    (conv.VWND, ['v-component_of_wind_height_above_ground', conv.VWND]),
+    (conv.PRECIP, ['Precipitation_rate_surface_Mixed_Intervals_Average',
+                   conv.PRECIP]),
+    (conv.PRESSURE, ['Pressure_reduced_to_MSL_msl',
+                     'Pressure_reduced_to_MSL',
+                     conv.PRESSURE]),
+    (conv.LAND, ['Land_cover_0__sea_1__land_surface', conv.LAND])])
+# the attributes which say how a variable is packed
+_packing_keys = ['_FillValue', 'missing_value', 'scale_factor', 'add_offset']
+
+
+def set_forecast_store(store):
+    """
+    Sets the store.ForecastStore gridded_forecast reads data through
+    when it downloads forecasts, or None to always download them.
+    """
+    global _forecast_store
+    _forecast_store = store
+
+
+def set_run_cache(cache):
+    """
+    Sets the store.RunCache which holds the latest run of each model
+    on each server, or None to look them up for every request.
+    """
+    global _run_cache
+    _run_cache = cache
+
+
+def set_metadata_cache(cache):
+    """
+    Sets the store.MetadataCache which holds the metadata of each
+    forecast run, or None to read it from the server for every request.
+    """
+    global _metadata_cache
+    _metadata_cache = cache
+
+
 def latest_url(model, server):
     return '/'.join([server, 'thredds/catalog/grib', _models[model], 'latest.html'])
 
@@ -52,6 +126,17 @@ def best_url(model, server):
     return os.path.join(server, 'thredds/dodsC/grib', model, 'best.html')
 
 
+def open_dataset(url):
+    """
+    Opens the (openDAP) dataset at url.  Servers can also be given as
+    file:// urls of local stand ins, in which case the datasets are
+    netCDF files in the same layout as the openDAP urls.
+    """
+    if url.startswith('file://'):
+        url = url[len('file://'):]
+    return xray.open_dataset(url)
+
+
 def latest(model, server):
     """
     UCAR's thredds server provides access to the latest forecasts
@@ -60,7 +145,7 @@ def latest(model, server):
     recent forecast.
     """
     # create a beatiful soup
-    f = urllib2.urlopen(latest_url(model, server))
+    f = urllib2.urlopen(latest_url(model, server), timeout=_timeout)
     soup = BeautifulSoup(f.read())
 
     def is_grib(x):
@@ -82,23 +167,108 @@ def latest(model, server):
     return os.path.join(server, 'thredds/dodsC', dataset)
 
 
-def fallback(model, server):
+def _exists(url):
+    """
+    Returns whether there is an openDAP dataset at url, which is
+    much quicker to find out than opening it.
+    """
+    if url.startswith('file://'):
+        return os.path.exists(url[len('file://'):])
+    try:
+        urllib2.urlopen(url + '.dds', timeout=_timeout).close()
+        return True
+    except IOError:
+        return False
+
+
+def fallback_url(model, server, now=None):
+    """
+    Returns the url of the most recent of the last 12 runs (or if there
+    are none the 'best' forecast) which are on the server, checking
+    for all of them at once.
+    """
     # start at an overestimate of the most recent forecast and backtrack
     # until one is found.
-    start = datetime.datetime.utcnow().strftime('%Y-%m-%d 18:00')
-    for d in pd.date_range(start, periods=12, freq='-6H'):
+    now = now or datetime.datetime.utcnow()
+    start = now.strftime('%Y-%m-%d 18:00')
+    urls = [d.strftime(file_format(model, server))
+            for d in pd.date_range(start, periods=12, freq='-6H')]
+    urls.append(best_url(model, server))
+    pool = ThreadPool(len(urls))
+    try:
+        found = pool.map(_exists, urls, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    for url, exists in zip(urls, found):
+        if exists:
+            return url
+    raise ValueError("Could not find a valid forecast. "
+                     "Perhaps the server is down?")
+
+
+def fallback(model, server):
+    return open_dataset(fallback_url(model, server))
+
+
+def _run_time(url):
+    """
+    Returns the time of the model run in url, or None if it isn't
+    part of the url.
+    """
+    match = re.search(r'(\d{8})_(\d{2})00', url)
+    if match is None:
+        return None
+    return datetime.datetime.strptime(''.join(match.groups()), '%Y%m%d%H')
+
+
+def dataset_run(dataset):
+    """
+    Returns the time of the model run dataset was opened from (see
+    _run_time), or None if that isn't known.  The 'best' datasets, for
+    example, hold the latest forecast times of several runs.
+    """
+    url = dataset.attrs.get(_URL_ATTR) or _source(dataset)
+    if url is None:
+        return None
+    return _run_time(url)
+
+
+def resolve(model, server, now=None):
+    """
+    Returns the openDAP url of the latest 'model' run on server, found
+    using latest(), or failing that fallback_url(), or None if the
+    server doesn't have one.  The result is kept in the run cache (see
+    set_run_cache) until the next run could be on the server, or if
+    there wasn't one for _dead_ttl.
+    """
+    now = now or datetime.datetime.utcnow()
+    if _run_cache is not None:
         try:
-            url = d.strftime(file_format(model, server))
-            logger.info("Trying to load %s" % url)
-            ds = xray.open_dataset(url)
-            return ds
-        except:
+            return _run_cache.get(model, server, now)
+        except KeyError:
             pass
+    url = None
     try:
-        return xray.open_dataset(best_url(model, server))
-    except:
-        raise ValueError("Could not find a valid forecast. "
-                         "Perhaps the server is down?")
+        url = latest(model, server)
+    except (IOError, ValueError), e:
+        logger.warn("Couldn't find the latest %s on %s: %s"
+                    % (model, server, e))
+        try:
+            url = fallback_url(model, server, now)
+        except ValueError, e:
+            logger.warn("Attempt to directly access %s files on %s failed."
+                        % (model, server))
+    if _run_cache is not None:
+        if url is None:
+            expires = now + _dead_ttl
+        else:
+            run = _run_time(url)
+            expires = now + _min_ttl
+            if run is not None:
+                expires = max(expires, run + _cycle)
+        _run_cache.put(model, server, url, expires)
+    return url
 
 
 def latitude_slicer(lats, query):
@@ -259,6 +429,340 @@ def subset(remote_dataset, query, additional_slicers=None):
     return local_dataset
 
 
+def _close(dataset):
+    """
+    Closes dataset (an xray or netCDF4 Dataset).  Once a netCDF4 file
+    has been opened, closing an openDAP dataset fails, yet netCDF4 then
+    closes it again when it's garbage collected, by which time its id
+    may belong to another file.  So datasets which fail to close are
+    kept from being garbage collected.
+    """
+    try:
+        dataset.close()
+    except RuntimeError, e:
+        logger.debug("Couldn't close a dataset: %s" % e)
+        _unclosed.append(dataset)
+
+
+def _source(dataset):
+    """
+    Returns the file or url dataset was opened from, or None if it
+    wasn't opened from one.
+    """
+    for name in dataset:
+        source = dataset[name].encoding.get('source')
+        if source is not None:
+            return source
+    return None
+
+
+def _threads(dataset, threads=None):
+    """
+    The number of requests (by default _download_threads) which can be
+    made of dataset at once.  Local netCDF files can only be read one
+    request at a time.
+    """
+    source = _source(dataset)
+    if source is not None and not source.startswith(('http://',
+                                                      'https://')):
+        return 1
+    return threads or _download_threads
+
+
+def download(remote_dataset, select, threads=None, time_chunk=None):
+    """
+    Returns select(remote_dataset) loaded into memory, where select
+    lazily subsets a (remote) dataset.  Rather than downloading one
+    variable after another, each variable (split into chunks of
+    time_chunk forecast times if given) is downloaded in a separate
+    request, up to 'threads' (by default _download_threads) at once.
+
+    A netCDF dataset can't be read from several threads at once, so
+    each request to an openDAP server opens its own connection to the
+    dataset and local netCDF files are read one request at a time.
+    """
+    threads = _threads(remote_dataset, threads)
+    local_dataset = select(remote_dataset)
+    source = _source(remote_dataset)
+    remote = source is not None and source.startswith(('http://',
+                                                       'https://'))
+    tasks = []
+    for vname in local_dataset.vars:
+        if time_chunk and conv.TIME in local_dataset[vname].dims:
+            ntimes = local_dataset.dims[conv.TIME]
+            tasks.extend((vname, slice(i, i + time_chunk))
+                         for i in range(0, ntimes, time_chunk))
+        else:
+            tasks.append((vname, None))
+
+    def fetch(task):
+        vname, times = task
+        if remote:
+            with _open_lock:
+                ds = open_dataset(source)
+            try:
+                variable = select(ds)[vname].variable
+                if times is not None:
+                    variable = variable.isel(**{conv.TIME: times})
+                return variable.values
+            finally:
+                with _open_lock:
+                    _close(ds)
+        variable = local_dataset[vname].variable
+        if times is not None:
+            variable = variable.isel(**{conv.TIME: times})
+        return variable.values
+
+    logger.debug("Downloading %d chunks of %s using %d threads"
+                 % (len(tasks), ', '.join(local_dataset.vars), threads))
+    pool = ThreadPool(max(1, min(threads, len(tasks))))
+    try:
+        chunks = pool.map(fetch, tasks, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+    local_dataset = local_dataset.copy()
+    for vname in local_dataset.vars:
+        values = [x for (v, _), x in zip(tasks, chunks) if v == vname]
+        variable = local_dataset[vname].variable
+        if len(values) > 1:
+            values = [np.concatenate(values,
+                                     axis=variable.dims.index(conv.TIME))]
+        local_dataset[vname] = xray.Variable(variable.dims, values[0],
+                                             variable.attrs,
+                                             variable.encoding)
+    # anything left (such as coordinates) is small
+    local_dataset.load_data()
+    return local_dataset
+
+
+def lookup_name(fcst, possible_names):
+    """
+    Forecast variable names haven't been very predictable,
+    so this looks up the variable name ignoring case and
+    allowing for one of several different names.
+    """
+    actual_names = fcst.keys()
+    possible_names = set([x.lower() for x in possible_names])
+    possible_names.update(['%s_ens' % x.lower() for x in possible_names])
+    name = [x for x in actual_names if x.lower() in possible_names]
+    if not len(name) == 1:
+        raise ValueError("Couldn't find variable %s" % str(possible_names))
+    return name.pop()
+
+
+def forecast_metadata(fcst):
+    """
+    Returns the metadata of the (remote) forecast fcst that is needed
+    to subset it: the dimensions, shape, attributes and stored dtype of
+    each of the variables in _variable_names that it holds, and the
+    coordinates of their dimensions.  metadata_dataset turns this back
+    into a dataset.
+    """
+    variables = {}
+    for possible_names in _variable_names.values():
+        try:
+            name = lookup_name(fcst, possible_names)
+        except ValueError:
+            continue
+        v = fcst[name].variable
+        # the attributes as they are on the server, before decoding
+        attrs = dict(v.attrs)
+        attrs.update((k, v.encoding[k]) for k in _packing_keys
+                     if k in v.encoding)
+        variables[name] = {'dims': list(v.dims),
+                           'shape': list(v.shape),
+                           'dtype': np.dtype(v.encoding.get('dtype',
+                                                            v.dtype)).str,
+                           'attrs': attrs}
+    coordinates = {}
+    for v in variables.values():
+        for d in v['dims']:
+            if d in fcst and d not in coordinates:
+                c = fcst[d].variable
+                coordinates[d] = {'values': c.values,
+                                  'attrs': dict(c.attrs),
+                                  'encoding': dict((k, c.encoding[k])
+                                                   for k in ['units',
+                                                             'calendar']
+                                                   if k in c.encoding)}
+    return {'variables': variables, 'coordinates': coordinates}
+
+
+class RemoteArray(object):
+    """
+    The values of variable 'name' of the dataset at url, as they are
+    stored, which are only read when the array is indexed.  Each read
+    opens its own connection to the dataset so several threads can read
+    from openDAP servers at once, reads from local netCDF files are made
+    one at a time.
+    """
+
+    def __init__(self, url, name, shape, dtype):
+        self.url = url
+        self.name = name
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+    @property
+    def ndim(self):
+        return len(self.shape)
+
+    @property
+    def size(self):
+        return int(np.prod(self.shape))
+
+    def __array__(self, dtype=None):
+        return np.asarray(self[(slice(None),) * self.ndim], dtype=dtype)
+
+    def __getitem__(self, key):
+        path = self.url
+        if path.startswith('file://'):
+            path = path[len('file://'):]
+        remote = path.startswith(('http://', 'https://'))
+        with _open_lock:
+            nc = netCDF4.Dataset(path)
+        try:
+            variable = nc.variables[self.name]
+            # the values are decoded by xray
+            variable.set_auto_maskandscale(False)
+            if remote:
+                return variable[key]
+            with _open_lock:
+                return variable[key]
+        finally:
+            with _open_lock:
+                _close(nc)
+
+
+def metadata_dataset(url, metadata):
+    """
+    Returns the forecast at url as an xray.Dataset made from its
+    metadata (see forecast_metadata).  The coordinates are held in
+    memory, so the dataset can be subset without asking the server,
+    while the variables are only downloaded when they're used.
+    """
+    fcst = xray.Dataset()
+    for name, c in metadata['coordinates'].iteritems():
+        fcst[name] = xray.Variable((name,), c['values'], c['attrs'],
+                                   c['encoding'])
+    for name, v in metadata['variables'].iteritems():
+        data = RemoteArray(url, name, v['shape'], v['dtype'])
+        variable = xray.Variable(v['dims'], data, v['attrs'])
+        fcst[name] = xray.conventions.decode_cf_variable(variable)
+    fcst.attrs[_URL_ATTR] = url
+    return fcst
+
+
+def remote_forecast(url):
+    """
+    Returns the forecast at url (see metadata_dataset), which only
+    needs to be opened if its metadata isn't in the metadata cache.
+    """
+    metadata = None
+    if _metadata_cache is not None:
+        metadata = _metadata_cache.get(url)
+    if metadata is None:
+        logger.debug("Reading the metadata of %s" % url)
+        with _open_lock:
+            fcst = open_dataset(url)
+        try:
+            metadata = forecast_metadata(fcst)
+        finally:
+            with _open_lock:
+                _close(fcst)
+        if _metadata_cache is not None:
+            _metadata_cache.put(url, metadata)
+    return metadata_dataset(url, metadata)
+
+
+def _tile_range(indices):
+    """
+    Returns the indices of the tiles holding the grid cells 'indices'.
+    """
+    return range(min(indices) // _tile_size, max(indices) // _tile_size + 1)
+
+
+def stored_subset(remote_dataset, select, query, store, run,
+                  additional_slicers=None):
+    """
+    The same as subset, but reads the data through store, a
+    store.ForecastStore, which holds tiles of _tile_size by _tile_size
+    grid cells of each model run.  select, as in download, picks out
+    (and renames) the variables of remote_dataset which are wanted.
+    Only the tiles which cover the query domain and aren't in the store
+    already are downloaded, several at once, so repeated requests for
+    the same region of the same forecast run don't download anything.
+    Variables without a time dimension (such as the land cover) are
+    stored whole.
+    """
+    fcst = select(remote_dataset)
+    lat_inds = np.arange(fcst.dims[conv.LAT])
+    lat_inds = lat_inds[latitude_slicer(fcst[conv.LAT], query)]
+    lon_inds = np.arange(fcst.dims[conv.LON])
+    lon_inds = lon_inds[longitude_slicer(fcst[conv.LON], query)]
+    timed = dict((v, conv.TIME in fcst[v].dims) for v in fcst.vars)
+    ntimes = None
+    if any(timed.values()):
+        ntimes = time_slicer(fcst[conv.TIME], query).stop
+    lat_tiles = _tile_range(lat_inds)
+    lon_tiles = _tile_range(lon_inds)
+    tiles = {}
+    missing = []
+    for vname in fcst.vars:
+        for tile in [(i, j) for i in lat_tiles for j in lon_tiles]:
+            local = store.get(query['model'], run, vname, tile)
+            if local is None or (timed[vname] and
+                                 local.dims[conv.TIME] < ntimes):
+                missing.append((vname, tile))
+            else:
+                tiles[vname, tile] = local
+
+    def fetch(task):
+        vname, (lat, lon) = task
+        slicers = {conv.LAT: slice(lat * _tile_size, (lat + 1) * _tile_size),
+                   conv.LON: slice(lon * _tile_size, (lon + 1) * _tile_size)}
+        if timed[vname]:
+            slicers[conv.TIME] = slice(0, ntimes)
+        for k, v in (additional_slicers or {}).iteritems():
+            if k in fcst[vname].dims:
+                slicers[k] = v
+
+        def select_tile(ds):
+            return select(ds)[[vname]].isel(**slicers)
+        logger.debug("Downloading %s tile %s" % (vname, str((lat, lon))))
+        return download(remote_dataset, select_tile, threads=1)
+
+    if len(missing):
+        pool = ThreadPool(min(_threads(remote_dataset), len(missing)))
+        try:
+            fetched = pool.map(fetch, missing, chunksize=1)
+        finally:
+            pool.close()
+            pool.join()
+        for (vname, tile), local in zip(missing, fetched):
+            store.put(query['model'], run, vname, tile, local)
+            tiles[vname, tile] = local
+    local_dataset = None
+    for vname in fcst.vars:
+        times = {conv.TIME: slice(0, ntimes)} if timed[vname] else {}
+        rows = [xray.concat([tiles[vname, (i, j)].isel(**times)
+                             for j in lon_tiles], conv.LON)
+                for i in lat_tiles]
+        tiles_dataset = xray.concat(rows, conv.LAT)
+        if local_dataset is None:
+            local_dataset = tiles_dataset
+        else:
+            local_dataset = local_dataset.merge(tiles_dataset)
+    # the tiles start at the first grid cell of the first tile
+    slicers = {conv.LAT: lat_inds - lat_tiles[0] * _tile_size,
+               conv.LON: lon_inds - lon_tiles[0] * _tile_size}
+    local_dataset = local_dataset.isel(**slicers)
+    if not any(timed.values()):
+        return local_dataset
+    return subset_time(local_dataset, query['hours'])
+
+
 def forecast(query, fcst=None):
     assert isinstance(query, dict)
     forecast_fetchers = {'gridded': gridded_forecast,
@@ -269,6 +773,8 @@ def forecast(query, fcst=None):
 def forecast_containing_point(spot_query, fcst=None):
     modified_query = spot_query.copy()
     modified_query['vars'] = ['wind', 'press']
+    # a spot isn't masked, even if it's on land (a harbour for example)
+    modified_query.pop('land', None)
     lat = spot_query['location']['latitude']
     lon = spot_query['location']['longitude']
     modified_query['domain'] = {'N': lat + 0.5,
@@ -280,8 +786,11 @@ def forecast_containing_point(spot_query, fcst=None):
 
 def gridded_to_point_forecast(fcst, lon, lat):
     """
-    Takes a forecast and interpolates it to a single point.
+    Takes a forecast and interpolates it to a single point.  Any land
+    mask is dropped, since a spot is served even if it's on land.
     """
+    if conv.LAND in fcst:
+        fcst = fcst.drop_vars(conv.LAND)
     if (not np.any(lon >= fcst[conv.LON].values) or
         not np.any(lon <= fcst[conv.LON].values)):
         raise ValueError("Longitude %6.2f not in (%6.2f, %6.2f)"
@@ -344,80 +853,138 @@ def spot_forecast(query, fcst=None):
 def opendap_forecast(model):
     """
     Returns the most recent forecast for 'model'.  In an
-    attempt to be more robust, this tries accessing the
-    latest forecast from _servers.  If the latest forecast
-    cannot be found, it then falls back to try to infer the
-    most recent forecast using fallback().
+    attempt to be more robust, this tries each of _servers
+    in turn, see resolve().
     """
-    # First check the latest.html pages on each server.
     for server in _servers:
+        url = resolve(model, server)
+        if url is None:
+            continue
         try:
-            latest_opendap = latest(model, server)
-            logger.debug(latest_opendap)
-            return xray.open_dataset(latest_opendap)
-        except urllib2.HTTPError, e:
-            logger.warn("Attempt to fetch %s on %s failed."
-                        % (model, server))
-            logger.warn(str(e))
-            pass
-    # The latest() lookup didn't work on any of the servers.
-    # so we now try the fallback lookup.
-    for server in _servers:
-        try:
-            ds = fallback(model, server)
-            return ds
-        except Exception, e:
-            logger.warn("Attempt to directly access %s files on %s failed."
-                        % (model, server))
+            logger.debug(url)
+            return remote_forecast(url)
+        except (IOError, RuntimeError), e:
+            logger.warn("Attempt to open %s failed: %s" % (url, e))
+            # the run may have been removed from the server
+            if _run_cache is not None:
+                _run_cache.forget(model, server)
     # No luck!
     raise ValueError("Couldn't access %s data on %s" %
                      (model, ' or '.join(_servers)))
 
 
-def gridded_forecast(query, fcst=None):
+def latest_opendap_url(model, servers=None):
+    """
+    Returns the openDAP url of the latest forecast for 'model' on
+    the first of 'servers' (by default _servers) which has one.
+    """
+    for server in servers or _servers:
+        url = resolve(model, server)
+        if url is not None:
+            return url
+    raise ValueError("Couldn't find the latest %s forecast on %s" %
+                     (model, ' or '.join(servers or _servers)))
+
+
+def prefetch(queries, store, servers=None, fetched=None):
+    """
+    Downloads the forecasts for each of the gridded queries into store
+    (a store.ForecastStore) for the latest run of each model, so that
+    gridded_forecast can later read them from the store.
+
+    fetched maps from each model to the url of the last run fetched,
+    models whose latest run is in fetched are skipped, and fetched is
+    updated with the runs that are downloaded.  Returns the list of
+    models for which a new run was downloaded.
+    """
+    fetched = {} if fetched is None else fetched
+    new_runs = []
+    for model in sorted(set(q['model'] for q in queries)):
+        url = latest_opendap_url(model, servers)
+        if fetched.get(model) == url:
+            continue
+        logger.info("Prefetching %s" % url)
+        remote_dataset = remote_forecast(url)
+        for query in queries:
+            if query['model'] == model:
+                gridded_forecast(query, remote_dataset, store=store)
+        fetched[model] = url
+        new_runs.append(model)
+    return new_runs
+
+
+def land_mask(remote_dataset, query, renames, store=None, run=None):
+    """
+    Returns the land cells of the domain of query as a (lat, lon)
+    DataArray, which is 1 over land and 0 over sea, derived from the
+    land cover in remote_dataset (renames maps its dimensions to the
+    conventional names).  to_beaufort then leaves the land cells out of
+    the payload.  None is returned if remote_dataset doesn't hold the
+    land cover or the domain has no sea.  If store and run are given
+    the land cover is read through the store, as in stored_subset.
+    """
+    try:
+        name = lookup_name(remote_dataset, _variable_names[conv.LAND])
+    except ValueError:
+        return None
+    dims = remote_dataset[name].dims
+    renames = dict((k, v) for k, v in renames.iteritems() if k in dims)
+    renames[name] = conv.LAND
+
+    def select(ds):
+        ds = ds[[name]].rename(renames)
+        # the land cover hardly changes so only the first time is used
+        return ds.isel(**dict((d, 0) for d in ds[conv.LAND].dims
+                              if d.startswith('time')))
+
+    def select_domain(ds):
+        ds = select(ds)
+        return ds.isel(**{conv.LAT: latitude_slicer(ds[conv.LAT], query),
+                          conv.LON: longitude_slicer(ds[conv.LON], query)})
+    if run is None:
+        land = download(remote_dataset, select_domain)[conv.LAND]
+    else:
+        land = stored_subset(remote_dataset, select, query, store,
+                             run)[conv.LAND]
+    land = land.transpose(conv.LAT, conv.LON)
+    mask = (land.values >= 0.5).astype(np.int8)
+    if np.all(mask):
+        return None
+    return xray.DataArray(mask, coords=[land[conv.LAT], land[conv.LON]])
+
+
+def gridded_forecast(query, fcst=None, store=None):
     """
     Returns an xray Dataset holding the gridded forecast
-    requested by 'query'
+    requested by 'query'.  If fcst isn't given the latest
+    forecast is downloaded, through the forecast store if
+    one has been set (see set_forecast_store).  A store
+    can also be passed in directly.
+
+    If query['land'] is True and the forecast holds the land cover, the
+    land cells are included as a conv.LAND variable (see land_mask),
+    which only decoders that know of land masks can read.
     """
     if fcst is None:
+        store = store or _forecast_store
         fcst = opendap_forecast(query['model'])
-
-    def lookup_name(possible_names):
-        """
-        Forecast variable names haven't been very predictable,
-        so this looks up the variable name ignoring case and
-        allowing for one of several different names.
-        """
-        actual_names = fcst.keys()
-        possible_names = set([x.lower() for x in possible_names])
-        possible_names.update(['%s_ens' % x.lower() for x in possible_names])
-        name = [x for x in actual_names if x.lower() in possible_names]
-        if not len(name) == 1:
-            raise ValueError("Couldn't find variable %s" % str(possible_names))
-        return name.pop()
+    remote_dataset = fcst
 
     variables = {}
+    wanted = []
     if 'wind' in query['vars']:
-        uwnd_name = lookup_name(['u-component_of_wind_height_above_ground',
-                                 conv.UWND])
-        variables[uwnd_name] = conv.UWND
-        vwnd_name = lookup_name(['v-component_of_wind_height_above_ground',
-                                 conv.VWND])
-        variables[vwnd_name] = conv.VWND
+        wanted.extend([conv.UWND, conv.VWND])
     if len(set(['rain', 'precip']).intersection(query['vars'])):
-        precip_name = lookup_name(['Precipitation_rate_surface_Mixed_Intervals_Average',
-                                   conv.PRECIP])
-        variables[precip_name] = conv.PRECIP
+        wanted.append(conv.PRECIP)
     if len(set(['press', 'pressure', 'mslp']).intersection(query['vars'])):
-        press_name = lookup_name(['Pressure_reduced_to_MSL_msl',
-                                  'Pressure_reduced_to_MSL',
-                                  conv.PRESSURE])
-        variables[press_name] = conv.PRESSURE
+        wanted.append(conv.PRESSURE)
+    for vname in wanted:
+        variables[lookup_name(fcst, _variable_names[vname])] = vname
     if len(variables) == 0:
         raise ValueError("No valid variables in query")
 
-    lat_name = lookup_name(['lat', 'latitude', conv.LAT])
-    lon_name = lookup_name(['lon', 'longitude', conv.LON])
+    lat_name = lookup_name(fcst, ['lat', 'latitude', conv.LAT])
+    lon_name = lookup_name(fcst, ['lon', 'longitude', conv.LON])
     # reduce the datset to only the variables we care about
     # the dataset has still not been loaded into memory.
     fcst = fcst[variables.keys()]
@@ -448,12 +1015,30 @@ def gridded_forecast(query, fcst=None):
             raise ValueError("Expected a single height for wind speeds")
     # reduce the dataset to only the domain we care about
     # this step may take a while because it may require actually
-    # downloading some of the data
-    fcst = subset(fcst, query, additional_slicers)
+    # downloading some of the data, each variable is downloaded
+    # concurrently (see download).
+    def select(ds):
+        return ds[variables.keys()].rename(renames)
+    # tiles are stored by model run, which isn't known for every dataset
+    run = dataset_run(remote_dataset) if store is not None else None
+    if store is not None and run is None:
+        logger.warn("Not storing the forecast since its model run "
+                    "isn't known")
+    if run is None:
+        fcst = download(remote_dataset,
+                        lambda ds: subset(select(ds), query,
+                                          additional_slicers))
+    else:
+        fcst = stored_subset(remote_dataset, select, query, store, run,
+                             additional_slicers)
     logger.debug("Subsetted to the domain")
     # Remove the height above ground dimension
     if len(dims_to_squeeze):
         fcst = fcst.squeeze(dims_to_squeeze)
+    if query.get('land', False):
+        land = land_mask(remote_dataset, query, renames, store, run)
+        if land is not None:
+            fcst[conv.LAND] = ((conv.LAT, conv.LON), land.values)
     # normalize to the expected units etc ...
     fcst = fcst.copy(deep=True)
     return units.normalize_variables(fcst)
@@ -1,6 +1,7 @@
 import os
 import sys
 import json
+import hashlib
 import xray
 import numpy as np
 import logging
@@ -15,6 +16,9 @@ from sl.lib import objects, tinylib, saildocs, emaillib
 
 _smtp_server = 'localhost'
 _windbreaker_email = 'query@ensembleweather.com'
+# diffs are only sent against a forecast which was sent within a model
+# cycle, so a recipient who missed an email soon gets a full forecast
+_max_previous_age = datetime.timedelta(hours=6)
 
 _email_body = """
 %(
@@ -91,12 +95,91 @@ def query_to_beaufort(query, forecast_path=None):
     # Acquires a forecast corresponding to a query
     fcst = get_forecast(query, path=forecast_path)
     logging.debug('Obtained the forecast')
+    # if the query asked for it the land cells are left out
     compressed_forecast = tinylib.to_beaufort(fcst)
     logging.debug("Compressed Size: %d" % len(compressed_forecast))
     return compressed_forecast
 
 
-def respond_to_query(query, reply_to, subject=None, forecast_path=None):
+def previous_payload_path(query, reply_to, previous_dir):
+    """
+    Returns the path in previous_dir which holds the last forecast sent
+    in response to query from reply_to.
+    """
+    query = dict((k, v) for k, v in query.iteritems() if k != 'warnings')
+    key = json.dumps([reply_to, query], sort_keys=True)
+    return os.path.join(previous_dir, '%s.fcst' % hashlib.sha1(key).hexdigest())
+
+
+def diff_against_previous(compressed_forecast, path, now=None):
+    """
+    Returns (diff, baseline) where diff is a diff of compressed_forecast
+    against the forecast stored at path, or None if there isn't one, it
+    was sent more than _max_previous_age ago, it can't be diffed or the
+    diff isn't smaller.  baseline is the forecast the recipient will hold
+    once they have received what is sent, which should be stored at path
+    (see store_previous) only once it has been sent.
+    """
+    now = now or datetime.datetime.now()
+    if not os.path.exists(path):
+        return None, compressed_forecast
+    sent = datetime.datetime.fromtimestamp(os.path.getmtime(path))
+    if now - sent > _max_previous_age:
+        logging.debug("Not sending a diff: the previous forecast is old")
+        return None, compressed_forecast
+    with open(path, 'rb') as f:
+        previous = f.read()
+    try:
+        diff = tinylib.beaufort_diff(compressed_forecast, previous)
+    except ValueError, e:
+        logging.debug("Not sending a diff: %s" % e)
+        return None, compressed_forecast
+    logging.debug("Diff Size: %d" % len(diff))
+    if len(diff) >= len(compressed_forecast):
+        return None, compressed_forecast
+    # store the forecast as the recipient will rebuild it
+    return diff, tinylib.apply_beaufort_diff(previous, diff)
+
+
+def store_previous(path, baseline):
+    """
+    Stores baseline, the forecast a recipient holds, at path.
+    """
+    directory = os.path.dirname(path)
+    if directory and not os.path.exists(directory):
+        os.makedirs(directory)
+    # write to a temporary file first so the previous forecast is never
+    # left half written
+    fd, tmp = tempfile.mkstemp(suffix='.tmp', dir=directory or '.')
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            f.write(baseline)
+        os.rename(tmp, path)
+    except:
+        os.remove(tmp)
+        raise
+
+
+def apply_forecast(payload, previous_path):
+    """
+    The recipient's side of respond_to_query's diffs.  Returns the
+    forecast held in payload, an attachment that was sent, which if it
+    is a diff is applied to the forecast stored at previous_path.  The
+    forecast is then stored at previous_path so the next diff can be
+    applied to it.
+    """
+    if tinylib.is_beaufort_diff(payload):
+        if not os.path.exists(previous_path):
+            raise ValueError("The forecast is a diff, but there is no "
+                             "previous forecast at %s" % previous_path)
+        with open(previous_path, 'rb') as f:
+            payload = tinylib.apply_beaufort_diff(f.read(), payload)
+    store_previous(previous_path, payload)
+    return payload
+
+
+def respond_to_query(query, reply_to, subject=None, forecast_path=None,
+                     previous_dir=None):
     """
     Takes a parsed query string fetches the forecast,
     compresses it and replies to the sender.
@@ -113,6 +196,12 @@ def respond_to_query(query, reply_to, subject=None, forecast_path=None):
         the query is used.
     forecast_path : string (optional)
         The path to an optional cached forecast.
+    previous_dir : string (optional)
+        A directory holding the last forecast sent for each query and
+        address.  If given, and a previous forecast for the same query
+        was recently sent to reply_to, only the changes since are sent
+        whenever that's smaller (see tinylib.beaufort_diff).  The
+        recipient rebuilds the forecast using apply_forecast.
 
     Returns
     ----------
@@ -121,6 +210,13 @@ def respond_to_query(query, reply_to, subject=None, forecast_path=None):
     """
     compressed_forecast = query_to_beaufort(query, forecast_path)
     logging.debug("Compressed Size: %d" % len(compressed_forecast))
+    file_fmt = '%Y-%m-%d_%H%m.fcst'
+    if previous_dir is not None:
+        path = previous_payload_path(query, reply_to, previous_dir)
+        diff, baseline = diff_against_previous(compressed_forecast, path)
+        if diff is not None:
+            compressed_forecast = diff
+            file_fmt = '%Y-%m-%d_%H%m.diff.fcst'
     # create a file-like forecast attachment
     forecast_attachment = StringIO(compressed_forecast)
     # Make sure the forecast file isn't too large for sailmail
@@ -128,7 +224,6 @@ def respond_to_query(query, reply_to, subject=None, forecast_path=None):
         raise saildocs.BadQuery("Forecast was too large (%d bytes) for sailmail!"
                        % len(compressed_forecast))
     # creates the new mime email
-    file_fmt = '%Y-%m-%d_%H%m.fcst'
     filename = datetime.datetime.today().strftime(file_fmt)
     filename = '_'.join([query['type'], filename])
     weather_email = emaillib.create_email(reply_to, _windbreaker_email,
@@ -138,15 +233,23 @@ def respond_to_query(query, reply_to, subject=None, forecast_path=None):
     logging.debug('Sending email to %s' % reply_to)
     emaillib.send_email(weather_email)
     logging.debug('Email sent.')
+    if previous_dir is not None:
+        # only now that it's been sent does the recipient hold it
+        store_previous(path, baseline)
     return forecast_attachment
 
 
 def process_email(mime_text, ncdf_weather=None,
-                  fail_hard=False, log_input=False):
+                  fail_hard=False, log_input=False, previous_dir=None,
+                  land=False):
     """
     Takes a mime_text email that contains one or several saildoc-like
     requests and replies to the sender with emails containing the
-    desired compressed forecasts.
+    desired compressed forecasts.  If previous_dir is given the
+    forecasts are sent as changes to the previously sent forecasts
+    when possible (see respond_to_query).  If land is True the land
+    cells are left out of gridded forecasts (see
+    poseidon.gridded_forecast), which older decoders can't read.
     """
     exceptions = None if fail_hard else Exception
     # here we store the input to a temp file so if it
@@ -171,8 +274,11 @@ def process_email(mime_text, ncdf_weather=None,
     for query_string in queries:
         try:
             query = parse_query(query_string)
+            if land:
+                query['land'] = True
             respond_to_query(query, reply_to=reply_to,
-                             forecast_path=ncdf_weather)
+                             forecast_path=ncdf_weather,
+                             previous_dir=previous_dir)
         except saildocs.BadQuery, e:
             # It would be nice to be able to try processing all queries
             # in an email even if some of them failed, but a hard fail on
@@ -1,7 +1,7 @@
 #!/usr/bin/python2.7
 import os
 import sys
-import zlib
+import time
 import logging
 import argparse
 import tempfile
@@ -20,18 +20,22 @@ console_handler = logging.StreamHandler(sys.stderr)
 logger.addHandler(console_handler)
 logger.setLevel("INFO")
 
-from sl import windbreaker
-from sl.lib import (griblib, tinylib, rtefcst, enslib, saildocs, conventions)
+from sl import windbreaker, poseidon
+from sl.lib import (griblib, tinylib, rtefcst, enslib, saildocs, conventions,
+                    store)
 
 
 def handle_spot(args):
     """
     Converts a packed spot forecast to a spot text message.
     """
-    from sl.lib import visualize
     payload = args.input.read()
-    fcsts = tinylib.from_beaufort(payload)
+    # spot messages are written straight from the decoded arrays, which
+    # doesn't need xray (see tinylib.beaufort_to_dict)
+    fcsts = tinylib.beaufort_to_dict(payload)
     if conventions.ENSEMBLE in fcsts:
+        from sl.lib import visualize
+        fcsts = tinylib.from_beaufort(payload)
         assert fcsts[conventions.LAT].size == 1
         assert fcsts[conventions.LON].size == 1
         fcsts = fcsts.isel(**{conventions.LON: 0, conventions.LAT: 0})
@@ -44,7 +48,8 @@ def handle_netcdf(args):
     """
     Converts a packed ensemble forecast to a netCDF4 file.
     """
-    tinyfcst = zlib.decompress(args.input.read())
+    # from_beaufort decompresses the payload itself
+    tinyfcst = args.input.read()
     fcst = tinylib.from_beaufort(tinyfcst)
     out_file = args.output.name
     args.output.close()
@@ -55,20 +60,50 @@ def handle_grib(args):
     """
     Converts a packed ensemble forecast to a standard GRIB.
     """
-    tinyfcst = zlib.decompress(args.input.read())
+    # from_beaufort decompresses the payload itself
+    tinyfcst = args.input.read()
     fcst = tinylib.from_beaufort(tinyfcst)
     griblib.save(fcst, target=args.output, append=False)
 
 
+def handle_apply_diff(args):
+    """
+    Rebuilds a forecast which was sent as the changes since the previous
+    one, which is kept in --previous, and writes the full forecast.
+    """
+    payload = windbreaker.apply_forecast(args.input.read(), args.previous)
+    args.output.write(payload)
+
+
+def use_store(args):
+    """
+    Downloads forecasts through a forecast store in --store-dir,
+    if given, which also holds the caches of the latest runs and
+    of their metadata.  Returns the forecast store, or None.
+    """
+    if args.store_dir is None:
+        return None
+    forecast_store = store.ForecastStore(args.store_dir)
+    poseidon.set_forecast_store(forecast_store)
+    poseidon.set_run_cache(store.RunCache(os.path.join(args.store_dir,
+                                                       'runs.json')))
+    poseidon.set_metadata_cache(store.MetadataCache(
+        os.path.join(args.store_dir, 'metadata')))
+    return forecast_store
+
+
 def handle_query(args):
     """
     Process a queries from the command line.  This is mostly used
     for debuging.
     """
+    use_store(args)
     queries = list(saildocs.iterate_query_strings(args.input.read()))
     if len(queries) != 1:
         raise NotImplementedError("Can only process one query at a time")
     query = windbreaker.parse_query(queries.pop(0))
+    if args.land:
+        query['land'] = True
     args.output.write(windbreaker.query_to_beaufort(query,
                                                     args.forecast))
 
@@ -77,25 +112,55 @@ def handle_email(args):
     """
     Processes a MIME e-mail from --input (or stdin) extracting
     a saildocs-like request and replying to the sender with
-    an packed ensemble forecast.
+    an packed ensemble forecast.  The reply is emailed, so
+    --output (which the query command shares) isn't used.
     """
+    use_store(args)
     try:
         # process the email
         windbreaker.process_email(args.input.read(), args.forecast,
-                                output=args.output,
-                                fail_hard=args.fail_hard,
-                                log_input=True)
+                                  fail_hard=args.fail_hard,
+                                  log_input=True,
+                                  previous_dir=args.previous_dir,
+                                  land=args.land)
     except Exception, e:
         logging.exception(e)
         raise
 
 
+def handle_prefetch(args):
+    """
+    Polls the thredds catalogs for new forecast runs, downloading the
+    queries in --queries into the forecast store whenever one appears.
+    """
+    queries = [windbreaker.parse_query(q) for q in
+               saildocs.iterate_query_strings(args.queries.read())]
+    if any(q['type'] != 'gridded' for q in queries):
+        raise ValueError("Only gridded queries can be prefetched")
+    forecast_store = use_store(args)
+    fetched = {}
+    while True:
+        try:
+            new_runs = poseidon.prefetch(queries, forecast_store,
+                                         servers=args.servers,
+                                         fetched=fetched)
+            if new_runs:
+                logger.info("Prefetched %s" % ', '.join(new_runs))
+        except Exception, e:
+            # try again at the next poll
+            logging.exception(e)
+        if args.once:
+            break
+        time.sleep(args.interval)
+
+
 def handle_route_forecast(args):
     """
     Generates a gpx waypoint file with wind forecast info along a route
     provided in an input file.
     """
-    tinyfcst = zlib.decompress(args.input.read())
+    # from_beaufort decompresses the payload itself
+    tinyfcst = args.input.read()
     args.input.close()
     fcst = tinylib.from_beaufort(tinyfcst)
 
@@ -131,6 +196,20 @@ def setup_parser_grib(p):
                    default=sys.stdout)
 
 
+def setup_parser_apply_diff(p):
+    """
+    Configures the argument subparser for handle_apply_diff.  p is the
+    ArgumentParser object for the apply-diff subparser.
+    """
+    p.add_argument('--input', type=argparse.FileType('rb'), default=sys.stdin,
+                   help="the forecast attachment, a diff or a full forecast")
+    p.add_argument('--output', type=argparse.FileType('wb'),
+                   default=sys.stdout)
+    p.add_argument('--previous', required=True,
+                   help="file holding the previous forecast, which is "
+                        "replaced by the rebuilt one")
+
+
 def setup_parser_email(p):
     """
     Configures the argument subparser for handle_email.  p is the
@@ -144,6 +223,35 @@ def setup_parser_email(p):
                    help="path to a netCDF forecast")
     p.add_argument('--fail-hard', default=False,
                    action='store_true')
+    p.add_argument('--store-dir', default=None,
+                   help="directory in which downloaded forecasts are kept "
+                        "for reuse")
+    p.add_argument('--previous-dir', default=None,
+                   help="directory of previously sent forecasts, when "
+                        "given only the changes since are sent")
+    p.add_argument('--land', default=False, action='store_true',
+                   help="leave land cells out of gridded forecasts, which "
+                        "needs a decoder that knows of land masks")
+
+
+def setup_parser_prefetch(p):
+    """
+    Configures the argument subparser for handle_prefetch.  p is the
+    ArgumentParser object for the prefetch subparser.
+    """
+    p.add_argument('--queries', type=argparse.FileType('rb'),
+                   required=True,
+                   help="file of saildocs-like queries for the regions, "
+                        "hours and variables to prefetch")
+    p.add_argument('--store-dir', required=True,
+                   help="directory in which the forecasts are kept")
+    p.add_argument('--interval', type=float, default=600.,
+                   help="seconds between polls of the catalogs")
+    p.add_argument('--servers', nargs='+', default=None,
+                   help="thredds servers to poll (file:// urls of local "
+                        "stand ins work too)")
+    p.add_argument('--once', default=False, action='store_true',
+                   help="poll once then exit")
 
 
 def setup_parser_route_forecast(p):
@@ -210,9 +318,11 @@ _task_handler = {'email': (handle_email, setup_parser_email),
                  'query': (handle_query, setup_parser_email),
                  'grib': (handle_grib, setup_parser_grib),
                  'netcdf': (handle_netcdf, setup_parser_grib),
+                 'apply-diff': (handle_apply_diff, setup_parser_apply_diff),
                  'route-forecast': (handle_route_forecast,
                                     setup_parser_route_forecast),
-                 'spot': (handle_spot, setup_parser_spot)}
+                 'spot': (handle_spot, setup_parser_spot),
+                 'prefetch': (handle_prefetch, setup_parser_prefetch)}
 
 if __name__ == "__main__":
 
@@ -0,0 +1,35 @@
+"""
+Helpers shared by the tests.
+"""
+import xray
+import numpy as np
+
+
+def sample_forecast(n_time=6, n_ens=None, n_lat=12, n_lon=15, seed=1982):
+    """
+    Creates a random forecast holding all the variables to_beaufort
+    knows how to encode.
+    """
+    np.random.seed(seed)
+    ds = xray.Dataset()
+    ds['time'] = ('time', 3 * np.arange(n_time),
+                  {'units': 'hours since 2013-12-12 12:00:00'})
+    ds['latitude'] = ('latitude', np.linspace(-30., -35.5, n_lat),
+                      {'units': 'degrees north'})
+    ds['longitude'] = ('longitude', np.linspace(-175., -168., n_lon),
+                       {'units': 'degrees east'})
+    dims = ('time', 'latitude', 'longitude')
+    if n_ens is not None:
+        ds['ens'] = ('ens', np.arange(n_ens))
+        dims = ('time', 'ens', 'latitude', 'longitude')
+    shape = tuple(ds.dims[d] for d in dims)
+    uwnd = 8. * np.random.normal(size=shape)
+    ds['uwnd'] = (dims, uwnd.astype(np.float32), {'units': 'm/s'})
+    vwnd = 8. * np.random.normal(size=shape)
+    ds['vwnd'] = (dims, vwnd.astype(np.float32), {'units': 'm/s'})
+    precip = np.maximum(1e-3 * np.random.normal(size=shape), 0.)
+    ds['precip'] = (dims, precip.astype(np.float32),
+                    {'units': 'kg.m-2.s-1'})
+    pres = 101000. + 1000. * np.random.normal(size=shape)
+    ds['pressure'] = (dims, pres.astype(np.float32), {'units': 'Pa'})
+    return ds
@@ -1,21 +1,35 @@
+import os
+import re
+import time
+import shutil
+import struct
+import urllib
+import datetime
+import tempfile
 import unittest
+import contextlib
+import SocketServer
+import BaseHTTPServer
+import multiprocessing
 
 import numpy as np
 
 from sl import poseidon
+from sl.lib import store
 
 import xray
 
 
-def test_forecast():
+def test_forecast(ntimes=65):
     ds = xray.Dataset()
     ds['longitude'] = ('longitude', np.arange(-180., 180.))
     ds['latitude'] = ('latitude', np.arange(-90., 90.))
     u, v = np.meshgrid(np.arange(-90., 90.), np.arange(-180., 180.))
-    u = np.array([u] * 65)
-    v = np.array([v] * 65)
+    u = np.array([u] * ntimes)
+    v = np.array([v] * ntimes)
     time = xray.Dataset()
-    time['time'] = ('time', np.linspace(0, 192, 65),
+    # three hourly
+    time['time'] = ('time', np.linspace(0, 3 * (ntimes - 1), ntimes),
                     {'units': 'hours since 2014-03-28'})
     ds['time'] = xray.conventions.decode_cf_variable(time['time'].variable)
     ds['uwnd'] = (['time', 'longitude', 'latitude'], u)
@@ -25,6 +39,139 @@ def test_forecast():
     return ds
 
 
+class FakeOpendapHandler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """
+    Answers the DAP2 requests (.dds, .das and .dods) that netCDF makes
+    for the datasets of a FakeOpendapServer.  Only the parts of DAP2 that
+    netCDF uses for simple gridded datasets are supported.
+    """
+    _types = {'float32': 'Float32', 'float64': 'Float64', 'int32': 'Int32',
+              'int16': 'Int16'}
+
+    def log_message(self, *args):
+        pass
+
+    def projections(self, ds, constraint):
+        # returns (variable, index) for each variable in the constraint
+        if not constraint:
+            return [(name, Ellipsis) for name in ds]
+        out = []
+        for projection in constraint.split(','):
+            name, hyperslabs = re.match(r'([^\[]+)(.*)$', projection).groups()
+            key = []
+            for hyperslab in re.findall(r'\[([^\]]*)\]', hyperslabs):
+                inds = [int(x) for x in hyperslab.split(':')]
+                if len(inds) == 3:
+                    key.append(slice(inds[0], inds[2] + 1, inds[1]))
+                else:
+                    key.append(slice(inds[0], inds[-1] + 1))
+            out.append((name, tuple(key)))
+        return out
+
+    def dds(self, name, ds, projections):
+        lines = ['Dataset {']
+        for vname, key in projections:
+            v = ds[vname].variable
+            shape = np.empty(v.shape)[key].shape
+            dims = ''.join('[%s = %d]' % x for x in zip(v.dims, shape))
+            lines.append('    %s %s%s;' % (self._types[v.dtype.name],
+                                           vname, dims))
+        lines.append('} %s;' % name)
+        return '\n'.join(lines) + '\n'
+
+    def das(self, ds):
+        lines = ['Attributes {']
+        for vname in ds:
+            lines.append('    %s {' % vname)
+            for k, v in ds[vname].attrs.items():
+                if isinstance(v, basestring):
+                    lines.append('        String %s "%s";' % (k, v))
+                else:
+                    v = np.asarray(v)
+                    lines.append('        %s %s %s;'
+                                 % (self._types[v.dtype.name], k,
+                                    ', '.join(repr(x) for x in v.ravel())))
+            lines.append('    }')
+        lines.append('}')
+        return '\n'.join(lines) + '\n'
+
+    def do_GET(self):
+        with self.server.requests.get_lock():
+            self.server.requests.value += 1
+        path, _, constraint = self.path.partition('?')
+        name, _, ext = path.lstrip('/').rpartition('.')
+        ds = self.server.datasets.get(name)
+        if ds is None or ext not in ['dds', 'das', 'dods']:
+            self.send_error(404)
+            return
+        if ext == 'das':
+            body = self.das(ds)
+        else:
+            projections = self.projections(ds, urllib.unquote(constraint))
+            body = self.dds(name, ds, projections)
+        if ext == 'dods':
+            body += '\nData:\n'
+            for vname, key in projections:
+                values = np.asarray(ds[vname].values[key])
+                if values.dtype == np.int16:
+                    # which are sent as 32 bit integers
+                    values = values.astype(np.int32)
+                body += struct.pack('>ii', values.size, values.size)
+                body += values.astype(values.dtype.newbyteorder('>')).tostring()
+            self.server.wait()
+        self.send_response(200)
+        self.send_header('Content-Description',
+                         'dods-das' if ext == 'das' else 'dods-dds')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class FakeOpendapServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    """
+    A local openDAP server of 'datasets', a dictionary from names to
+    xray Datasets, which adds latency (in seconds) to each data request
+    and counts the requests, and the most that were served at once.
+    """
+    daemon_threads = True
+
+    def __init__(self, datasets, latency=0.):
+        BaseHTTPServer.HTTPServer.__init__(self, ('127.0.0.1', 0),
+                                           FakeOpendapHandler)
+        self.datasets = datasets
+        self.latency = latency
+        self.requests = multiprocessing.Value('i', 0)
+        self.active = multiprocessing.Value('i', 0)
+        self.max_active = multiprocessing.Value('i', 0)
+
+    def wait(self):
+        with self.active.get_lock():
+            self.active.value += 1
+            self.max_active.value = max(self.max_active.value,
+                                        self.active.value)
+        time.sleep(self.latency)
+        with self.active.get_lock():
+            self.active.value -= 1
+
+
+@contextlib.contextmanager
+def fake_opendap(datasets, latency=0.):
+    """
+    Serves datasets from a FakeOpendapServer, yielding the server.  It
+    runs in another process since opening a dataset holds onto the GIL.
+    """
+    server = FakeOpendapServer(datasets, latency)
+    process = multiprocessing.Process(target=server.serve_forever)
+    process.daemon = True
+    process.start()
+    try:
+        yield server
+    finally:
+        process.terminate()
+        process.join()
+        server.server_close()
+
+
 class PoseidonTest(unittest.TestCase):
 
     def test_latitude_slicer(self):
@@ -176,6 +323,439 @@ class PoseidonTest(unittest.TestCase):
         subset2 = poseidon.forecast_containing_point(query, subset)
         self.assertTrue(subset2.equals(subset))
 
+    def test_spot_forecast_on_land(self):
+        query = {'location': {'latitude': -20.3, 'longitude': -154.7},
+                 'model': 'gfs',
+                 'type': 'spot',
+                 'hours': np.array([0, 24]),
+                 'vars': ['wind'],
+                 'land': True,
+                 'warnings': []}
+        fcst = test_forecast(ntimes=9)
+        # the spot is closest to land, but the cells to its east are sea
+        dims = fcst['uwnd'].dims
+        lon = fcst['longitude'].values[np.newaxis, :, np.newaxis]
+        land_cover = (lon < -154.5) * np.ones(fcst['uwnd'].shape)
+        fcst['Land_cover_0__sea_1__land_surface'] = (dims, land_cover)
+        gridded = poseidon.gridded_forecast(dict(query, domain={
+            'N': -20., 'S': -21., 'E': -154., 'W': -155.}), fcst)
+        self.assertIn('land', gridded)
+        self.assertNotIn('land', poseidon.spot_forecast(query, gridded))
+        opendap_forecast = poseidon.opendap_forecast
+        poseidon.opendap_forecast = lambda model: fcst
+        try:
+            spot = poseidon.spot_forecast(query)
+        finally:
+            poseidon.opendap_forecast = opendap_forecast
+        self.assertNotIn('land', spot)
+        np.testing.assert_array_almost_equal(spot['vwnd'].values, -154.7)
+
+    def test_land_mask(self):
+        query = {'hours': np.array([0, 24]),
+                 'domain': {'N': 10., 'S': -10.,
+                            'E': 10., 'W': -10.},
+                 'grid_delta': (2., 2.),
+                 'model': 'gfs',
+                 'type': 'gridded',
+                 'vars': ['wind']}
+        fcst = test_forecast(ntimes=9)
+        # without the land cover there is no land mask
+        self.assertNotIn('land', poseidon.gridded_forecast(query, fcst))
+        dims = fcst['uwnd'].dims
+        lon = fcst['longitude'].values[np.newaxis, :, np.newaxis]
+        land_cover = (lon > 5.) * np.ones(fcst['uwnd'].shape)
+        fcst['Land_cover_0__sea_1__land_surface'] = (dims, land_cover)
+        # nor is there unless the query asks for one
+        without = poseidon.gridded_forecast(query, fcst)
+        self.assertNotIn('land', without)
+        self.assertTrue(without.equals(poseidon.gridded_forecast(
+            query, fcst[['uwnd', 'vwnd']])))
+        query['land'] = True
+        actual = poseidon.gridded_forecast(query, fcst)
+        self.assertEqual(actual['land'].dims, ('latitude', 'longitude'))
+        expected = (actual['longitude'].values > 5.) * np.ones((11, 1))
+        np.testing.assert_array_equal(actual['land'].values, expected)
+        # a domain which is all land doesn't get a mask
+        query['domain'] = {'N': 10., 'S': -10., 'E': 20., 'W': 10.}
+        self.assertNotIn('land', poseidon.gridded_forecast(query, fcst))
+        # the land cover is kept in the forecast store like the wind
+        query['domain'] = {'N': 10., 'S': -10., 'E': 10., 'W': -10.}
+        fcst.attrs[poseidon._URL_ATTR] = (
+            'http://thredds.ucar.edu/thredds/dodsC/grib/NCEP/GFS/'
+            'Global_0p5deg/files/GFS_Global_0p5deg_20140328_0000.grib2')
+        directory = tempfile.mkdtemp()
+        try:
+            forecast_store = store.ForecastStore(
+                directory, max_age=datetime.timedelta(days=365 * 100))
+            stored = poseidon.gridded_forecast(query, fcst,
+                                               store=forecast_store)
+            self.assertTrue(stored.equals(actual))
+            self.assertEqual(sum(os.path.basename(x[0]).startswith('land_')
+                                 for x in forecast_store.tiles()), 2)
+            fcst['Land_cover_0__sea_1__land_surface'].values[:] = 0.
+            stored = poseidon.gridded_forecast(query, fcst,
+                                               store=forecast_store)
+            np.testing.assert_array_equal(stored['land'].values, expected)
+        finally:
+            shutil.rmtree(directory)
+
+    def test_stored_land_cover(self):
+        query = {'hours': np.array([0, 12]),
+                 'domain': {'N': 5., 'S': -5.,
+                            'E': 165., 'W': 155.},
+                 'grid_delta': (1., 1.),
+                 'model': 'gfs',
+                 'type': 'gridded',
+                 'vars': ['wind'],
+                 'land': True}
+        fcst = xray.Dataset()
+        fcst['time'] = ('time', np.arange(0., 25., 6.),
+                        {'units': 'hours since 2014-03-28 00:00:00'})
+        fcst['latitude'] = ('latitude', np.arange(10., -10.5, -1.))
+        fcst['longitude'] = ('longitude', np.arange(150., 170.5, 1.))
+        dims = ('time', 'latitude', 'longitude')
+        shape = tuple(fcst.dims[d] for d in dims)
+        for vname in ['uwnd', 'vwnd']:
+            fcst[vname] = (dims,
+                           np.random.normal(size=shape).astype(np.float32))
+        land_cover = fcst['longitude'].values > 160. * np.ones(shape)
+        fcst['Land_cover_0__sea_1__land_surface'] = (
+            dims, land_cover.astype(np.float32))
+        run = 'gfs_20140328_0000'
+        directory = tempfile.mkdtemp()
+        try:
+            forecast_store = store.ForecastStore(
+                directory, max_age=datetime.timedelta(days=365 * 100))
+            with fake_opendap({run: fcst}) as server:
+                remote = poseidon.remote_forecast('http://%s:%d/%s' % (
+                    server.server_address + (run, )))
+                expected = poseidon.gridded_forecast(query, remote,
+                                                     store=forecast_store)
+                self.assertIn('land', expected)
+                # a repeated request, land cover and all, is read from
+                # the store without asking the server
+                server.requests.value = 0
+                actual = poseidon.gridded_forecast(query, remote,
+                                                   store=forecast_store)
+                self.assertEqual(server.requests.value, 0)
+                self.assertTrue(actual.equals(expected))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_forecast_store(self):
+        query = {'hours': np.array([0, 24, 48, 96]),
+                 'domain': {'N': 10., 'S': -10.,
+                            'E': 10., 'W': -10.},
+                 'grid_delta': (2., 2.),
+                 'model': 'gfs',
+                 'type': 'gridded',
+                 'vars': ['wind', 'press']}
+        fcst = test_forecast(ntimes=41)
+        expected = poseidon.gridded_forecast(query, fcst.copy(deep=True))
+        directory = tempfile.mkdtemp()
+        try:
+            # the test forecast is from 2014
+            forecast_store = store.ForecastStore(
+                directory, max_age=datetime.timedelta(days=365 * 100))
+            # forecasts which aren't from a known run aren't stored
+            actual = poseidon.gridded_forecast(query, fcst.copy(deep=True),
+                                               store=forecast_store)
+            self.assertTrue(actual.equals(expected))
+            self.assertEqual(forecast_store.tiles(), [])
+            fcst.attrs[poseidon._URL_ATTR] = (
+                'http://thredds.ucar.edu/thredds/dodsC/grib/NCEP/GFS/'
+                'Global_0p5deg/files/GFS_Global_0p5deg_20140328_0000.grib2')
+            actual = poseidon.gridded_forecast(query, fcst.copy(deep=True),
+                                               store=forecast_store)
+            self.assertTrue(actual.equals(expected))
+            # three variables on 2 x 1 tiles
+            self.assertEqual(len(forecast_store.tiles()), 6)
+            # the second time round nothing is downloaded
+            changed = fcst.copy(deep=True)
+            changed['uwnd'].values[:] = 0.
+            actual = poseidon.gridded_forecast(query, changed,
+                                               store=forecast_store)
+            self.assertTrue(actual.equals(expected))
+            # unless more hours are needed
+            query['hours'] = np.array([0, 120])
+            actual = poseidon.gridded_forecast(query, changed,
+                                               store=forecast_store)
+            np.testing.assert_array_equal(actual['uwnd'].values, 0.)
+            self.assertEqual(len(forecast_store.tiles()), 6)
+            # the least recently used tiles are evicted first
+            for path, _, _, _ in forecast_store.tiles():
+                if 'pressure' in path:
+                    os.utime(path, (time.time() + 60,) * 2)
+            forecast_store.max_bytes = sum(x[2] for x in forecast_store.tiles()
+                                           if 'pressure' in x[0])
+            forecast_store.evict()
+            self.assertEqual(sorted(os.path.basename(x[0])[:8]
+                                    for x in forecast_store.tiles()),
+                             ['pressure'] * 2)
+            # as are old runs
+            forecast_store.max_age = datetime.timedelta(days=1)
+            forecast_store.evict()
+            self.assertEqual(forecast_store.tiles(), [])
+            self.assertTrue(os.path.exists(directory))
+        finally:
+            shutil.rmtree(directory)
+
+    def test_prefetch(self):
+        server = tempfile.mkdtemp()
+        fcst = test_forecast(ntimes=17)
+
+        def publish(run):
+            # a stand in for the thredds catalog and openDAP server
+            dataset = 'grib/NCEP/GFS/Global_0p5deg/files/GFS_%s.grib2' % run
+            catalog = os.path.join(server, 'thredds/catalog',
+                                   poseidon._models['gfs'].join(['grib/', '']))
+            if not os.path.exists(catalog):
+                os.makedirs(catalog)
+            with open(os.path.join(catalog, 'latest.html'), 'w') as f:
+                f.write('<html><a href="catalog.html?dataset=%s">'
+                        '<tt>%s</tt></a></html>'
+                        % (dataset, os.path.basename(dataset)))
+            path = os.path.join(server, 'thredds/dodsC', dataset)
+            if os.path.exists(path):
+                os.remove(path)
+            elif not os.path.exists(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            fcst.dump(path)
+            return path
+
+        query = {'hours': np.array([0, 24, 48]),
+                 'domain': {'N': 10., 'S': -10.,
+                            'E': 10., 'W': -10.},
+                 'grid_delta': (1., 1.),
+                 'model': 'gfs',
+                 'type': 'gridded',
+                 'vars': ['wind', 'press']}
+        servers = poseidon._servers
+        run_cache = poseidon._run_cache
+        try:
+            # look up the latest run for every prefetch
+            poseidon.set_run_cache(None)
+            forecast_store = store.ForecastStore(
+                os.path.join(server, 'store'),
+                max_age=datetime.timedelta(days=365 * 100))
+            poseidon._servers = ['file://%s' % server]
+            publish('20140328_0000')
+            fetched = {}
+            self.assertEqual(poseidon.prefetch([query], forecast_store,
+                                               fetched=fetched), ['gfs'])
+            self.assertEqual(len(forecast_store.tiles()), 6)
+            expected = poseidon.gridded_forecast(query, fcst.copy(deep=True))
+            # requests are now read from the store
+            fcst['uwnd'].values[:] = 0.
+            publish('20140328_0000')
+            actual = poseidon.gridded_forecast(query, store=forecast_store)
+            self.assertTrue(actual.equals(expected))
+            # until there is a new run
+            self.assertEqual(poseidon.prefetch([query], forecast_store,
+                                               fetched=fetched), [])
+            fcst['time'] = ('time',
+                            fcst['time'].values + np.timedelta64(6, 'h'))
+            publish('20140328_0600')
+            self.assertEqual(poseidon.prefetch([query], forecast_store,
+                                               fetched=fetched), ['gfs'])
+            self.assertEqual(len(forecast_store.tiles()), 12)
+            actual = poseidon.gridded_forecast(query, store=forecast_store)
+            np.testing.assert_array_equal(actual['uwnd'].values, 0.)
+        finally:
+            poseidon._servers = servers
+            poseidon.set_run_cache(run_cache)
+            shutil.rmtree(server)
+
+    def test_run_cache(self):
+        directory = tempfile.mkdtemp()
+        server = 'file://%s' % os.path.join(directory, 'server')
+        run = datetime.datetime(2014, 3, 28, 6)
+        url = run.strftime(poseidon.file_format('gfs', server))
+        catalog = os.path.dirname(poseidon.latest_url('gfs', server))
+        catalog = catalog[len('file://'):]
+        path = url[len('file://'):]
+        run_cache = poseidon._run_cache
+        try:
+            os.makedirs(catalog)
+            with open(os.path.join(catalog, 'latest.html'), 'w') as f:
+                dataset = url.split('thredds/dodsC/')[1]
+                f.write('<html><a href="catalog.html?dataset=%s">'
+                        '<tt>%s</tt></a></html>'
+                        % (dataset, os.path.basename(dataset)))
+            cache_path = os.path.join(directory, 'runs.json')
+            poseidon.set_run_cache(store.RunCache(cache_path))
+            now = datetime.datetime(2014, 3, 28, 10)
+            self.assertEqual(poseidon.resolve('gfs', server, now), url)
+            # the catalog isn't read again until the next run is due
+            os.remove(os.path.join(catalog, 'latest.html'))
+            now += datetime.timedelta(hours=1)
+            self.assertEqual(poseidon.resolve('gfs', server, now), url)
+            # which other processes share
+            poseidon.set_run_cache(store.RunCache(cache_path))
+            self.assertEqual(poseidon.resolve('gfs', server, now), url)
+            # with no catalog the runs are looked for directly, but there
+            # aren't any so the server is skipped for a while
+            now = run + poseidon._cycle
+            self.assertIsNone(poseidon.resolve('gfs', server, now))
+            os.makedirs(os.path.dirname(path))
+            test_forecast(ntimes=2).dump(path)
+            now += poseidon._dead_ttl - datetime.timedelta(seconds=1)
+            self.assertIsNone(poseidon.resolve('gfs', server, now))
+            now += datetime.timedelta(seconds=1)
+            self.assertEqual(poseidon.resolve('gfs', server, now), url)
+            # the fallback finds the most recent run
+            later = run + datetime.timedelta(hours=12)
+            later_path = later.strftime(poseidon.file_format('gfs', server))
+            shutil.copy(path, later_path[len('file://'):])
+            self.assertEqual(poseidon.fallback_url('gfs', server, later),
+                             later_path)
+            self.assertEqual(poseidon._run_time(later_path), later)
+            # processes writing the cache at once keep each other's runs
+            processes = [multiprocessing.Process(
+                             target=store.RunCache(cache_path).put,
+                             args=('gfs', 'server%d' % i, url, later))
+                         for i in range(8)]
+            for p in processes:
+                p.start()
+            for p in processes:
+                p.join()
+            shared = store.RunCache(cache_path)
+            for i in range(8):
+                self.assertEqual(shared.get('gfs', 'server%d' % i, now), url)
+        finally:
+            poseidon.set_run_cache(run_cache)
+            shutil.rmtree(directory)
+
+    def test_metadata_cache(self):
+        query = {'hours': np.array([0, 12, 24]),
+                 'domain': {'N': 10., 'S': -10.,
+                            'E': 170., 'W': 150.},
+                 'grid_delta': (1., 1.),
+                 'model': 'gfs',
+                 'type': 'gridded',
+                 'vars': ['wind', 'press']}
+        fcst = xray.Dataset()
+        fcst['time'] = ('time', np.arange(0., 49., 3.),
+                        {'units': 'hours since 2014-03-28 00:00:00'})
+        fcst['lat'] = ('lat', np.arange(20., -20.5, -1.))
+        fcst['lon'] = ('lon', np.arange(140., 180.5, 1.))
+        fcst['height_above_ground1'] = ('height_above_ground1', [2., 10.])
+        shape = tuple(fcst.dims[d] for d in ['time', 'height_above_ground1',
+                                             'lat', 'lon'])
+        for vname in ['u-component_of_wind_height_above_ground',
+                      'v-component_of_wind_height_above_ground']:
+            fcst[vname] = (('time', 'height_above_ground1', 'lat', 'lon'),
+                           np.random.normal(size=shape).astype(np.float32))
+        # pressure is packed into integers
+        packed = np.random.randint(-1000, 1000, size=shape[:1] + shape[2:])
+        packed[0, 0, 0] = -32767
+        fcst['Pressure_reduced_to_MSL_msl'] = (
+            ('time', 'lat', 'lon'), packed.astype(np.int16),
+            {'units': 'Pa', 'scale_factor': np.float32(2.),
+             'add_offset': np.float32(101300.),
+             '_FillValue': np.int16(-32767)})
+        local = xray.Dataset()
+        for k in fcst:
+            local[k] = xray.conventions.decode_cf_variable(fcst[k].variable)
+        expected = poseidon.gridded_forecast(query, local)
+        directory = tempfile.mkdtemp()
+        metadata_cache = poseidon._metadata_cache
+        try:
+            with fake_opendap({'gfs': fcst}) as server:
+                url = 'http://%s:%d/gfs' % server.server_address
+                cache = store.MetadataCache(directory)
+                poseidon.set_metadata_cache(cache)
+                remote = poseidon.remote_forecast(url)
+                self.assertGreater(server.requests.value, 0)
+                actual = poseidon.gridded_forecast(query, remote)
+                self.assertTrue(actual.equals(expected))
+                # another process can subset the run without asking
+                # the server, which is only asked for the data
+                poseidon.set_metadata_cache(store.MetadataCache(directory))
+                server.requests.value = 0
+                remote = poseidon.remote_forecast(url)
+                lats = remote['lat'][poseidon.latitude_slicer(remote['lat'],
+                                                              query)]
+                poseidon.longitude_slicer(remote['lon'], query)
+                poseidon.time_slicer(remote['time'], query)
+                self.assertEqual(server.requests.value, 0)
+                np.testing.assert_array_equal(lats.values,
+                                              expected['latitude'].values)
+                actual = poseidon.gridded_forecast(query, remote)
+                self.assertTrue(actual.equals(expected))
+                self.assertGreater(server.requests.value, 0)
+                # only the most recent runs are kept
+                cache.max_entries = 1
+                cache.put('%s_2' % url, cache.get(url))
+                self.assertEqual(len(os.listdir(directory)), 1)
+                self.assertIsNone(store.MetadataCache(directory).get(url))
+        finally:
+            poseidon.set_metadata_cache(metadata_cache)
+            shutil.rmtree(directory)
+
+    def test_download(self):
+        query = {'hours': np.array([0, 12, 24]),
+                 'domain': {'N': 10., 'S': -10.,
+                            'E': 170., 'W': 150.},
+                 'grid_delta': (1., 1.),
+                 'model': 'gfs',
+                 'type': 'gridded',
+                 'vars': ['wind', 'press', 'rain']}
+        fcst = xray.Dataset()
+        fcst['time'] = ('time', np.arange(0., 49., 3.),
+                        {'units': 'hours since 2014-03-28 00:00:00'})
+        fcst['latitude'] = ('latitude', np.arange(20., -20.5, -0.5))
+        fcst['longitude'] = ('longitude', np.arange(140., 180.5, 0.5))
+        shape = tuple(fcst.dims[d] for d in ['time', 'latitude', 'longitude'])
+        for vname in ['uwnd', 'vwnd', 'pressure', 'precip']:
+            fcst[vname] = (('time', 'latitude', 'longitude'),
+                           np.random.normal(size=shape).astype(np.float32))
+        local = fcst.copy(deep=True)
+        local['time'] = xray.conventions.decode_cf_variable(
+            fcst['time'].variable)
+        expected = poseidon.gridded_forecast(query, local)
+        run = 'gfs_20140328_0000'
+        with fake_opendap({'gfs': fcst, run: fcst}, latency=0.1) as server:
+            url = 'http://%s:%d/gfs' % server.server_address
+            remote = poseidon.open_dataset(url)
+            actual = poseidon.gridded_forecast(query, remote)
+            self.assertTrue(actual.equals(expected))
+            # each variable is downloaded at once
+            self.assertEqual(server.max_active.value, 4)
+
+            def select(ds):
+                return poseidon.subset(ds, query)
+            server.max_active.value = 0
+            start = time.time()
+            sequential = poseidon.download(remote, select, threads=1)
+            sequential_time = time.time() - start
+            self.assertEqual(server.max_active.value, 1)
+            start = time.time()
+            chunked = poseidon.download(remote, select, threads=8,
+                                        time_chunk=2)
+            chunked_time = time.time() - start
+            self.assertTrue(chunked.equals(sequential))
+            # two time chunks of each of the four variables at once
+            self.assertEqual(server.max_active.value, 8)
+            self.assertLess(chunked_time, sequential_time / 2.)
+            remote.close()
+            # as are the tiles missing from a forecast store
+            directory = tempfile.mkdtemp()
+            try:
+                forecast_store = store.ForecastStore(
+                    directory, max_age=datetime.timedelta(days=365 * 100))
+                server.max_active.value = 0
+                remote = poseidon.open_dataset('http://%s:%d/%s' % (
+                    server.server_address + (run, )))
+                actual = poseidon.gridded_forecast(query, remote,
+                                                   store=forecast_store)
+                remote.close()
+                self.assertTrue(actual.equals(expected))
+                # four variables on 2 x 2 tiles
+                self.assertEqual(len(forecast_store.tiles()), 16)
+                self.assertEqual(server.max_active.value, 4)
+            finally:
+                shutil.rmtree(directory)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,83 @@
+import numpy as np
+import unittest
+
+from sl.lib import rangecoder
+
+
+class RangeCoderTest(unittest.TestCase):
+
+    def test_round_trip(self):
+        np.random.seed(1982)
+        for nsymbols in [2, 3, 4, 15, 16]:
+            for shape in [(), (1,), (7,), (3, 5), (2, 3, 9, 11)]:
+                # use a range of skewed and uniform distributions
+                for alpha in [0.05, 1., 20.]:
+                    p = np.random.dirichlet(alpha * np.ones(nsymbols))
+                    bins = np.random.choice(nsymbols, size=shape, p=p)
+                    encoded = rangecoder.encode_grid(bins, nsymbols)
+                    actual = rangecoder.decode_grid(encoded, shape, nsymbols)
+                    self.assertEqual(actual.shape, bins.shape)
+                    np.testing.assert_array_equal(actual, bins)
+
+    def test_smooth_fields_are_small(self):
+        # a smooth field should take far less than the 4 bits
+        # per cell it would if it were packed.
+        y, x = np.mgrid[0:50, 0:60]
+        bins = (np.sin(x / 15.) + np.cos(y / 10.) + 2.) * 15. / 4.
+        bins = bins.astype(np.int64)
+        encoded = rangecoder.encode_grid(bins, 16)
+        self.assertLess(len(encoded), bins.size / 8)
+        np.testing.assert_array_equal(
+            rangecoder.decode_grid(encoded, bins.shape, 16), bins)
+
+    def test_constant(self):
+        bins = np.zeros((100, 100), dtype=np.int64)
+        encoded = rangecoder.encode_grid(bins, 16)
+        self.assertLess(len(encoded), 50)
+        np.testing.assert_array_equal(
+            rangecoder.decode_grid(encoded, bins.shape, 16), bins)
+
+    def test_predicted_round_trip(self):
+        np.random.seed(1982)
+        for nsymbols in [2, 3, 16]:
+            for shape in [(), (1,), (7,), (3, 5), (2, 3, 9, 11)]:
+                bins = np.random.randint(nsymbols, size=shape)
+                encoded = rangecoder.encode_predicted_grid(bins, nsymbols)
+                actual = rangecoder.decode_predicted_grid(encoded, shape,
+                                                          nsymbols)
+                self.assertEqual(actual.shape, bins.shape)
+                np.testing.assert_array_equal(actual, bins)
+
+    def test_median_prediction(self):
+        self.assertEqual(rangecoder.median_prediction(3, 5, 4), 4)
+        # along an edge the prediction follows the edge
+        self.assertEqual(rangecoder.median_prediction(3, 5, 5), 3)
+        self.assertEqual(rangecoder.median_prediction(3, 5, 3), 5)
+
+    def test_predicted_smooth_fields(self):
+        # pressure like fields should be smaller when predicted.
+        np.random.seed(1982)
+        y, x = np.mgrid[0:60, 0:90]
+        field = (1.5 * np.sin(x / 15.) * np.cos(y / 11.) +
+                 0.03 * np.random.normal(size=x.shape))
+        bins = np.clip((field + 2.) * 4., 0, 15).astype(np.int64)
+        encoded = rangecoder.encode_predicted_grid(bins, 16)
+        self.assertLess(len(encoded), len(rangecoder.encode_grid(bins, 16)))
+        np.testing.assert_array_equal(
+            rangecoder.decode_predicted_grid(encoded, bins.shape, 16), bins)
+
+    def test_joint_round_trip(self):
+        np.random.seed(1982)
+        nminor = [1, 2, 8, 8]
+        for shape in [(1,), (7,), (3, 5), (2, 3, 9, 11)]:
+            major = np.random.randint(len(nminor), size=shape)
+            steps = 8 // np.array(nminor)[major]
+            minor = np.random.randint(8, size=shape) // steps * steps
+            encoded = rangecoder.encode_joint_grid(major, minor, nminor)
+            actual = rangecoder.decode_joint_grid(encoded, shape, nminor)
+            np.testing.assert_array_equal(actual[0], major)
+            np.testing.assert_array_equal(actual[1], minor)
+
+
+if __name__ == "__main__":
+    unittest.main()
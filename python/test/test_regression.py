@@ -3,6 +3,8 @@ import xray
 import zlib
 import numpy as np
 import base64
+import shutil
+import tempfile
 import unittest
 import datetime
 import functools
@@ -10,6 +12,8 @@ import contextlib
 
 from sl.lib import tinylib
 
+from helpers import sample_forecast
+
 from email import Parser
 
 _data_dir = os.path.join(os.path.dirname(__file__), '../..', 'data')
@@ -84,3 +88,97 @@ class WindbreakerRegression(unittest.TestCase):
                               np.timedelta64(datetime.timedelta(days=1)),
                               "Forecasts are more than a day old.")
 
+    def test_diff_against_previous(self):
+        from sl import windbreaker
+        query = windbreaker.parse_query(
+            'send GFS:30s,40s,160w,175w|0.5,0.5|0,3..120|WIND')
+        previous_dir = tempfile.mkdtemp()
+        try:
+            path = windbreaker.previous_payload_path(query, 'foo@bar.com',
+                                                     previous_dir)
+            self.assertNotEqual(path, windbreaker.previous_payload_path(
+                query, 'baz@bar.com', previous_dir))
+            fcst = sample_forecast(n_time=8)
+            first = tinylib.to_beaufort(fcst.isel(time=slice(0, 6)))
+            # the first forecast is sent in full
+            diff, baseline = windbreaker.diff_against_previous(first, path)
+            self.assertIsNone(diff)
+            self.assertEqual(baseline, first)
+            # nothing is stored until it has been sent
+            self.assertFalse(os.path.exists(path))
+            windbreaker.store_previous(path, baseline)
+            second = tinylib.to_beaufort(fcst.isel(time=slice(2, 8)))
+            diff, baseline = windbreaker.diff_against_previous(second, path)
+            self.assertLess(len(diff), len(second))
+            # the recipient rebuilds the second forecast from the first
+            rebuilt = tinylib.apply_beaufort_diff(first, diff)
+            self.assertEqual(rebuilt, baseline)
+            self.assertTrue(tinylib.from_beaufort(rebuilt).equals(
+                tinylib.from_beaufort(second)))
+            # but once the previous forecast is old a full one is sent
+            later = (datetime.datetime.now() + windbreaker._max_previous_age
+                     + datetime.timedelta(minutes=1))
+            diff, baseline = windbreaker.diff_against_previous(second, path,
+                                                               now=later)
+            self.assertIsNone(diff)
+            self.assertEqual(baseline, second)
+        finally:
+            shutil.rmtree(previous_dir)
+
+    def test_diff_emails(self):
+        fcst = sample_forecast(n_time=8)
+        payloads = [tinylib.to_beaufort(fcst.isel(time=slice(0, 6))),
+                    tinylib.to_beaufort(fcst.isel(time=slice(2, 8)))]
+        emails = []
+        tmp_dir = tempfile.mkdtemp()
+        # neither directory exists yet
+        previous_dir = os.path.join(tmp_dir, 'sent')
+        boat_path = os.path.join(tmp_dir, 'boat', 'previous.fcst')
+        with self.get_windbreaker(emails) as windbreaker:
+            query_to_beaufort = windbreaker.query_to_beaufort
+            windbreaker.query_to_beaufort = lambda *args: payloads.pop(0)
+            try:
+                query = windbreaker.parse_query(
+                    'send GFS:30s,40s,160w,175w|0.5,0.5|0,3..120|WIND')
+                for expected in [0, 2]:
+                    windbreaker.respond_to_query(query, 'foo@bar.com',
+                                                 previous_dir=previous_dir)
+                    email = Parser.Parser().parsestr(
+                        emails.pop().args[0].as_string())
+                    body, attach = email.get_payload()
+                    payload = base64.b64decode(attach.get_payload())
+                    # which the boat rebuilds from what it last received
+                    payload = windbreaker.apply_forecast(payload, boat_path)
+                    actual = tinylib.from_beaufort(payload)
+                    self.assertTrue(actual.equals(tinylib.from_beaufort(
+                        tinylib.to_beaufort(fcst.isel(
+                            time=slice(expected, expected + 6))))))
+                # only the second was sent as a diff
+                self.assertIn('.diff.', attach.get_filename())
+            finally:
+                windbreaker.query_to_beaufort = query_to_beaufort
+                shutil.rmtree(tmp_dir)
+
+    def test_unsent_forecast_is_not_stored(self):
+        from sl import windbreaker
+
+        def fail_to_send(email):
+            raise IOError("no connection")
+
+        query = windbreaker.parse_query(
+            'send GFS:30s,40s,160w,175w|0.5,0.5|0,3..120|WIND')
+        previous_dir = tempfile.mkdtemp()
+        send_email = windbreaker.emaillib.send_email
+        query_to_beaufort = windbreaker.query_to_beaufort
+        windbreaker.emaillib.send_email = fail_to_send
+        windbreaker.query_to_beaufort = lambda *args: tinylib.to_beaufort(
+            sample_forecast())
+        try:
+            self.assertRaises(IOError, windbreaker.respond_to_query,
+                              query, 'foo@bar.com', previous_dir=previous_dir)
+            self.assertFalse(os.path.exists(windbreaker.previous_payload_path(
+                query, 'foo@bar.com', previous_dir)))
+        finally:
+            windbreaker.emaillib.send_email = send_email
+            windbreaker.query_to_beaufort = query_to_beaufort
+            shutil.rmtree(previous_dir)
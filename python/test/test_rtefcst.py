@@ -6,6 +6,7 @@ import zlib
 import os.path
 import pickle
 import numpy as np
+import xray
 
 from sl.lib import rtefcst
 from sl.lib import objects
@@ -225,6 +226,44 @@ class RouteTest(unittest.TestCase):
         deltaT = r.utcArrival - tArrival
         self.assertAlmostEqual(units.total_seconds(deltaT), 0, places=1)
 
+    @unittest.skipIf(not hasattr(xray, 'decode_cf_datetime'),
+                     "RouteForecast needs xray.decode_cf_datetime")
+    def testRouteForecastOverLand(self):
+        # the land cells (west of 152E) of a masked forecast are nans
+        fcst = xray.Dataset()
+        time = ('time', 3 * np.arange(17),
+                {'units': 'hours since 2014-02-02 18:00:00'})
+        fcst['time'] = time
+        fcst['latitude'] = ('latitude', np.arange(-35., -32.5, 0.5),
+                            {'units': 'degrees north'})
+        fcst['longitude'] = ('longitude', np.arange(151., 155.5, 0.5),
+                             {'units': 'degrees east'})
+        shape = tuple(fcst.dims[d] for d in ('time', 'latitude',
+                                             'longitude'))
+        wind = 5. * np.ones(shape, dtype=np.float32)
+        for vname in ['uwnd', 'vwnd']:
+            fcst[vname] = (('time', 'latitude', 'longitude'), wind,
+                           {'units': 'm/s'})
+        land = fcst['longitude'].values < 152. * np.ones((5, 1))
+        fcst = tinylib.from_beaufort(tinylib.to_beaufort(fcst, land=land))
+        self.assertIn('land', fcst)
+        # RouteForecast decodes the times itself
+        fcst['time'] = time
+        ifh = StringIO.StringIO(testCSV)
+        rte = rtefcst.Route(ifh=ifh, inFmt='csv',
+                            utcDept=dt.datetime(2014, 2, 2, 18),
+                            avrgSpeed=5.0)
+        ifh.close()
+        rf = rtefcst.RouteForecast(rte, fcst)
+        # the route starts next to land, so has no forecast there
+        self.assertRaises(rtefcst.PointNotInsideGrid, rf.getCurPosFcst, 0)
+        rf.rte.curPos = objects.Position(rf.rte.curPos.lat,
+                                         objects.NautAngle(153.2))
+        out = rf.getCurPosFcst(0)
+        self.assertNotIn('land', out)
+        self.assertTrue(np.all(np.isfinite(out.values())))
+        rf.rte.resetCurPos()
+
 """
 class RteFcstTest(unittest.TestCase):
 
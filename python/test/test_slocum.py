@@ -0,0 +1,89 @@
+import os
+import base64
+import shutil
+import argparse
+import tempfile
+import unittest
+import functools
+
+import xray
+
+from email import Parser
+from StringIO import StringIO
+
+from sl import windbreaker
+from sl.lib import tinylib, griblib, emaillib
+
+from helpers import sample_forecast
+
+try:
+    import slocum
+except ImportError:
+    # slocum needs matplotlib for its plots
+    slocum = None
+
+
+@unittest.skipIf(slocum is None, "slocum's dependencies aren't installed")
+class SlocumTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.payload = tinylib.to_beaufort(sample_forecast())
+        self.input_path = os.path.join(self.directory, 'forecast.fcst')
+        with open(self.input_path, 'wb') as f:
+            f.write(self.payload)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_netcdf(self):
+        # the attachment is passed to from_beaufort as is, which
+        # decompresses it
+        output_path = os.path.join(self.directory, 'forecast.nc')
+        args = argparse.Namespace(input=open(self.input_path, 'rb'),
+                                  output=open(output_path, 'wb'))
+        slocum.handle_netcdf(args)
+        actual = xray.open_dataset(output_path)
+        expected = tinylib.from_beaufort(self.payload)
+        self.assertTrue(actual['uwnd'].equals(expected['uwnd']))
+        self.assertTrue(actual['pressure'].equals(expected['pressure']))
+
+    @unittest.skipIf(not griblib._has_gribapi, "gribapi isn't installed")
+    def test_grib(self):
+        output_path = os.path.join(self.directory, 'forecast.grb')
+        with open(output_path, 'wb') as output:
+            slocum.handle_grib(argparse.Namespace(
+                input=open(self.input_path, 'rb'), output=output))
+        self.assertGreater(os.path.getsize(output_path), 0)
+
+    def test_email(self):
+        emails = []
+
+        def send_email(*args, **kwdargs):
+            emails.append(functools.partial(lambda x: x, *args, **kwdargs))
+        query = emaillib.create_email(
+            'query@ensembleweather.com', 'foo@bar.com',
+            'send GFS:30s,40s,160w,175w|0.5,0.5|0,3..120|WIND')
+        args = argparse.Namespace(input=StringIO(query.as_string()),
+                                  output=StringIO(), forecast=None,
+                                  fail_hard=True, store_dir=None,
+                                  previous_dir=None, land=False)
+        actual_send_email = emaillib.send_email
+        query_to_beaufort = windbreaker.query_to_beaufort
+        emaillib.send_email = send_email
+        windbreaker.query_to_beaufort = lambda *args: self.payload
+        try:
+            slocum.handle_email(args)
+        finally:
+            emaillib.send_email = actual_send_email
+            windbreaker.query_to_beaufort = query_to_beaufort
+        self.assertEqual(len(emails), 1)
+        email = Parser.Parser().parsestr(emails.pop().args[0].as_string())
+        self.assertEqual(email['To'], 'foo@bar.com')
+        body, attach = email.get_payload()
+        self.assertEqual(base64.b64decode(attach.get_payload()),
+                         self.payload)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -1,9 +1,17 @@
+import os
 import sys
 import xray
+import zlib
+import cPickle
+import subprocess
 import numpy as np
 import unittest
 
-from sl.lib import tinylib
+from cStringIO import StringIO
+
+from sl.lib import tinylib, objects
+
+from helpers import sample_forecast
 
 
 class TinylibTest(unittest.TestCase):
@@ -88,6 +96,92 @@ class TinylibTest(unittest.TestCase):
         recovered = tinylib.unpack_ints(**packed)
         self.assertTrue(np.all(orig == recovered))
 
+        # test packing 1 bit ints with an odd length
+        orig = np.array([1, 0, 1, 1, 0, 1, 0, 1, 1, 1])
+        packed = tinylib.pack_ints(orig, req_bits=1)
+        recovered = tinylib.unpack_ints(**packed)
+        self.assertTrue(np.all(orig == recovered))
+
+    def test_pack_widths(self):
+        np.random.seed(1982)
+        for bits in range(1, 17):
+            for size in [1, 7, 8, 9, 100, 1001]:
+                orig = np.random.randint(2 ** bits, size=size)
+                packed = tinylib.pack_ints(orig, bits)
+                self.assertEqual(len(packed['packed_array']),
+                                 np.ceil(size * bits / 8.))
+                recovered = tinylib.unpack_ints(**packed)
+                np.testing.assert_array_equal(orig, recovered)
+        self.assertRaises(ValueError,
+                          lambda: tinylib.pack_ints(np.arange(4), 17))
+        self.assertRaises(ValueError,
+                          lambda: tinylib.pack_ints(np.arange(5), 2))
+        # tiny arrays can use any number of bits
+        orig = np.random.normal(size=(30, 20))
+        for bits in [3, 5, 6]:
+            tiny = tinylib.tiny_array(orig, bits=bits)
+            recovered = tinylib.expand_array(**tiny)
+            resolution = np.ptp(orig) / (2 ** bits - 1)
+            self.assertLessEqual(np.max(np.abs(recovered - orig)),
+                                 resolution)
+
+    def test_expand_unmasked(self):
+        np.random.seed(1982)
+        divs = np.sort(np.random.normal(size=11))
+        for bits in [1, 2, 3, 4, 8]:
+            for size in [1, 7, 9, 1001]:
+                bins = np.random.randint(min(2 ** bits, divs.size), size=size)
+                packed = tinylib.pack_ints(bins, bits)['packed_array']
+                for dtype, wrap_val in [(None, None), (np.float32, np.pi)]:
+                    expected = tinylib.expand_bins(bins, divs, dtype,
+                                                   wrap_val=wrap_val)
+                    upper = np.minimum(bins + 1, divs.size - 1)
+                    if wrap_val is None:
+                        np.testing.assert_array_equal(
+                            expected, 0.5 * (divs[bins] + divs[upper]))
+                    actual = tinylib.expand_unmasked(packed, bits, (size,),
+                                                     divs, dtype, wrap_val)
+                    self.assertEqual(actual.dtype, expected.dtype)
+                    np.testing.assert_array_equal(actual, expected)
+        # the tables are cached per divs
+        first = tinylib._byte_values(divs, 4)
+        self.assertIs(first, tinylib._byte_values(divs.copy(), 4))
+        self.assertIsNot(first, tinylib._byte_values(divs + 1., 4))
+        self.assertRaises(IndexError,
+                          lambda: tinylib.expand_bins(np.array([11]), divs))
+
+    def test_pack_layout(self):
+        # values are packed most significant first, and the values
+        # in a partially filled last byte are right aligned.
+        cases = [(np.mod(np.arange(15), 4), 2, '\x1b\x1b\x1b\x06'),
+                 (np.arange(15), 4, '\x01\x23\x45\x67\x89\xab\xcd\x0e'),
+                 (np.array([1, 0, 1, 1, 0, 1, 0, 1, 1, 1]), 1, '\xb5\x03'),
+                 # values can straddle bytes
+                 (np.array([1, 2, 3, 4, 5]), 3, '\x29\x65'),
+                 (np.array([0xabc, 0x123]), 12, '\xab\xc1\x23'),
+                 (np.array([0x1ff, 0x0]), 9, '\xff\x80\x00')]
+        for orig, bits, expected in cases:
+            packed = tinylib.pack_ints(orig, bits)
+            self.assertEqual(packed['packed_array'], expected)
+
+    def test_wind_speed_and_direction(self):
+        np.random.seed(1982)
+        shape = (3, 2, 5, 7)
+        uwnd = (10 * np.random.normal(size=shape)).astype(np.float32)
+        vwnd = (10 * np.random.normal(size=shape)).astype(np.float32)
+        speeds, dirs = tinylib.wind_speed_and_direction(uwnd, vwnd)
+        self.assertEqual(speeds.shape, shape)
+        self.assertEqual(dirs.shape, shape)
+        bins = tinylib.bin_array(dirs, tinylib._direction_bins, wrap=True)
+        names = ['S', 'SSW', 'SW', 'WSW', 'W', 'WNW', 'NW', 'NNW', 'N',
+                 'NNE', 'NE', 'ENE', 'E', 'ESE', 'SE', 'SSE']
+        # make sure we agree with the Wind object.
+        for ind in np.ndindex(*shape):
+            wind = objects.Wind(uwnd[ind], vwnd[ind])
+            self.assertEqual(wind.speed, speeds[ind])
+            self.assertEqual(wind.dir, dirs[ind])
+            self.assertEqual(wind.readable, names[bins[ind]])
+
     def test_small(self):
         least_significant_digit = 2
         expected = np.random.normal(size=102).reshape(51, 2)
@@ -102,10 +196,44 @@ class TinylibTest(unittest.TestCase):
         ds = xray.Dataset()
         ds['time'] = (('time'), np.arange(10),
                       {'units': 'hours since 2013-12-12 12:00:00'})
-        sm_time = tinylib.small_time(ds['time'])
+        for sequence in [False, True]:
+            sm_time = tinylib.small_time(ds['time'], sequence)
+            self.assertEqual(sm_time['packed_array'][0] ==
+                             tinylib._SEQUENCE_MARKER, sequence)
+            ret = tinylib.expand_small_time(**sm_time)
+            self.assertTrue(np.all(ret[0] == ds['time'].values))
+            self.assertTrue(ret[1] == ds['time'].attrs['units'])
+        # irregular times can't be stored as a sequence
+        ds['time'] = (('time'), np.array([0, 3, 6, 12, 24]),
+                      {'units': 'hours since 2013-12-12 12:00:00'})
+        sm_time = tinylib.small_time(ds['time'], sequence=True)
+        self.assertNotEqual(sm_time['packed_array'][0],
+                            tinylib._SEQUENCE_MARKER)
         ret = tinylib.expand_small_time(**sm_time)
         self.assertTrue(np.all(ret[0] == ds['time'].values))
-        self.assertTrue(ret[1] == ds['time'].attrs['units'])
+
+    def test_small_sequence(self):
+        for values, head in [([], 0), ([3], 0), ([5, 3, 1, -1], 0),
+                             ([735214, 43200, 0, 6, 12], 2),
+                             ([735214, 43200], 2)]:
+            packed = tinylib.small_sequence(values, head)
+            self.assertLess(len(packed), 12)
+            actual_head, actual = tinylib.expand_small_sequence(packed)
+            np.testing.assert_array_equal(actual_head, values[:head])
+            np.testing.assert_array_equal(actual, values[head:])
+        self.assertIsNone(tinylib.small_sequence([0, 1, 3]))
+        # regular grids only take a few bytes, irregular ones fall
+        # back to zlib.
+        for lats, regular in [(np.linspace(-30., -35.5, 12), True),
+                              (np.linspace(-30., -35., 13), False)]:
+            small = tinylib.small_array(lats, least_significant_digit=2,
+                                        sequence=True)
+            self.assertEqual(len(small['packed_array']) < 10, regular)
+            np.testing.assert_allclose(tinylib.expand_small_array(**small),
+                                       lats, atol=0.005)
+        # but by default they are compressed as in the original format
+        small = tinylib.small_array(lats, least_significant_digit=2)
+        zlib.decompress(small['packed_array'])
 
     def test_beaufort(self):
         np.random.seed(1982)
@@ -180,5 +308,512 @@ class TinylibTest(unittest.TestCase):
         np.testing.assert_allclose(actual['pressure'].values, ds['pressure'].values,
                                    atol=1e-4, rtol=1e-4)
 
+    def test_unstring_beaufort(self):
+        payload = zlib.decompress(tinylib.to_beaufort(sample_forecast()))
+        variables = list(tinylib.unstring_beaufort(payload))
+        self.assertEqual([k for k, _ in variables],
+                         ['time', 'latitude', 'longitude', 'wind_speed',
+                          'wind_dir', 'precip', 'pressure'])
+        # the packed arrays should be views into the payload
+        for _, info in variables:
+            self.assertIsInstance(info['packed_array'], buffer)
+        # but the variable lookup table should be left alone
+        self.assertNotIn('packed_array', tinylib._variables['wind_speed'])
+        # a truncated payload can't be parsed
+        self.assertRaises(ValueError,
+                          lambda: list(tinylib.unstring_beaufort(payload[:-1])))
+
+    def test_read_beaufort(self):
+        beaufort = tinylib.to_beaufort(sample_forecast(n_ens=3))
+        expected = list(tinylib.unstring_beaufort(zlib.decompress(beaufort)))
+        for chunk_size in [1, 7, 100, len(beaufort)]:
+            actual = list(tinylib.read_beaufort(StringIO(beaufort),
+                                                chunk_size))
+            self.assertEqual([k for k, _ in actual], [k for k, _ in expected])
+            for (_, x), (_, y) in zip(actual, expected):
+                self.assertEqual(str(x['packed_array']),
+                                 str(y['packed_array']))
+
+        parser = tinylib.BeaufortParser()
+        self.assertGreater(len(parser.feed(beaufort[:-20])), 0)
+        self.assertRaises(ValueError, parser.close)
+
+        # variables still held by the decompressor are parsed on close
+        class Decompressor(object):
+            def __init__(self):
+                self.held = []
+
+            def decompress(self, data):
+                self.held.append(zlib.decompress(data))
+                return ''
+
+            def flush(self):
+                return ''.join(self.held)
+
+        parser = tinylib.BeaufortParser()
+        parser._decompressor = Decompressor()
+        self.assertEqual(parser.feed(beaufort), [])
+        actual = parser.close()
+        self.assertEqual([k for k, _ in actual], [k for k, _ in expected])
+
+    def test_indexed_beaufort(self):
+        fcst = sample_forecast(n_time=10, n_ens=3)
+        beaufort = tinylib.to_beaufort(fcst)
+        indexed = tinylib.to_beaufort(fcst, indexed=True)
+        self.assertEqual(tinylib.payload_version(beaufort), 1)
+        self.assertEqual(tinylib.payload_version(indexed), 2)
+        expected = tinylib.from_beaufort(beaufort)
+        self.assertTrue(expected.equals(tinylib.from_beaufort(indexed)))
+
+        # pull out the wind at a couple of hours
+        actual = tinylib.from_beaufort(indexed, variables=['wind'],
+                                       hours=[6, 24])
+        self.assertNotIn('pressure', actual)
+        self.assertNotIn('precip', actual)
+        self.assertTrue(actual.equals(expected[['uwnd', 'vwnd',
+                                                'wind_speed', 'wind_dir']]
+                                      .isel(time=[2, 8])))
+        # the same selection should work with the original format
+        self.assertTrue(actual.equals(tinylib.from_beaufort(
+            beaufort, variables=['wind'], hours=[6, 24])))
+        self.assertRaises(ValueError,
+                          lambda: tinylib.from_beaufort(indexed, hours=[7]))
+        # coordinates whose names merely contain 'time' are left alone
+        out = tinylib._select_hours({'time': ('time', np.arange(0, 9, 3)),
+                                     'runtime': ('runtime', np.arange(2))},
+                                    [3])
+        np.testing.assert_array_equal(out['time'][1], [3])
+        np.testing.assert_array_equal(out['runtime'][1], [0, 1])
+        # the sea cells of a masked grid are stored as one row, which
+        # can be longer than 65535
+        fcst = sample_forecast(n_time=1, n_lat=256, n_lon=257)
+        land = np.zeros((256, 257), dtype=np.bool_)
+        land[0, 0] = True
+        indexed = tinylib.to_beaufort(fcst[['uwnd', 'vwnd']], indexed=True,
+                                      land=land)
+        shapes = [e['shape'] for e in tinylib._read_index(indexed)
+                  if e['vname'] == 'wind_speed']
+        self.assertEqual(shapes, [(1, 65791)])
+        expected = tinylib.from_beaufort(tinylib.to_beaufort(
+            fcst[['uwnd', 'vwnd']], land=land))
+        self.assertTrue(expected.equals(tinylib.from_beaufort(indexed)))
+
+    def test_codecs(self):
+        fcst = sample_forecast(n_ens=2)
+        expected = tinylib.from_beaufort(tinylib.to_beaufort(fcst))
+        for codec in tinylib._codecs:
+            for indexed in [False, True]:
+                beaufort = tinylib.to_beaufort(fcst, indexed=indexed,
+                                               codec=codec)
+                self.assertTrue(expected.equals(
+                    tinylib.from_beaufort(beaufort)))
+        # codecs can also be chosen per variable
+        beaufort = tinylib.to_beaufort(fcst, codec={'wind_speed': 'range',
+                                                    'pressure': 'zlib'})
+        self.assertTrue(expected.equals(tinylib.from_beaufort(beaufort)))
+        self.assertRaises(ValueError,
+                          lambda: tinylib.to_beaufort(fcst, codec='foo'))
+
+    def test_time_residuals(self):
+        np.random.seed(1982)
+        bins = np.random.randint(16, size=(5, 3, 4))
+        residuals = tinylib.time_residuals(bins, 16)
+        self.assertTrue(np.all(residuals[0] == bins[0]))
+        self.assertTrue(np.all(residuals >= 0))
+        self.assertTrue(np.all(residuals < 16))
+        self.assertTrue(np.all(tinylib.undo_time_residuals(residuals, 16)
+                               == bins))
+        # a forecast which barely changes from one time to the next
+        # should be much smaller when stored as residuals.
+        fcst = sample_forecast(n_time=8)
+        for v in ['uwnd', 'vwnd']:
+            fcst[v].values[1:] = fcst[v].values[0]
+            fcst[v].values[-1, 0, 0] += 10.
+        expected = tinylib.from_beaufort(tinylib.to_beaufort(fcst))
+        fields = tinylib._beaufort_fields(fcst)
+        speed = fields['wind_speed']
+        delta = tinylib._encode_field('wind_speed', speed, 'delta')
+        self.assertLess(len(delta),
+                        len(tinylib._encode_field('wind_speed', speed,
+                                                  'range')) / 2)
+        beaufort = tinylib.to_beaufort(fcst, codec='delta')
+        self.assertTrue(expected.equals(tinylib.from_beaufort(beaufort)))
+        # in indexed payloads the residuals are stored as a single chunk
+        beaufort = tinylib.to_beaufort(fcst, indexed=True, codec='delta')
+        actual = tinylib.from_beaufort(beaufort, hours=[3, 9])
+        self.assertTrue(expected.isel(time=[1, 3]).equals(actual))
+
+    def test_ensemble_residuals(self):
+        np.random.seed(1982)
+        bins = np.random.randint(16, size=(3, 4, 5, 6))
+        residuals = tinylib.ensemble_residuals(bins, 16)
+        np.testing.assert_array_equal(residuals[:, 0], bins[:, 0])
+        np.testing.assert_array_equal(
+            tinylib.undo_ensemble_residuals(residuals, 16), bins)
+        # an ensemble in which most members agree with the control
+        fcst = sample_forecast(n_ens=10)
+        for v in ['uwnd', 'vwnd']:
+            fcst[v].values[:, 1:] = fcst[v].values[:, :1]
+            fcst[v].values[:, 1:] += np.random.normal(
+                scale=0.3, size=fcst[v].values[:, 1:].shape)
+        fields = tinylib._beaufort_fields(fcst)
+        for vname in ['wind_speed', 'wind_dir']:
+            ensemble = tinylib._encode_field(vname, fields[vname], 'ensemble')
+            self.assertLess(len(ensemble),
+                            len(tinylib._encode_field(vname, fields[vname],
+                                                      'range')) / 2)
+        expected = tinylib.from_beaufort(tinylib.to_beaufort(fcst))
+        for indexed in [False, True]:
+            beaufort = tinylib.to_beaufort(fcst, indexed=indexed,
+                                           codec='ensemble')
+            self.assertTrue(expected.equals(tinylib.from_beaufort(beaufort)))
+            actual = tinylib.from_beaufort(beaufort, hours=[3, 15])
+            self.assertTrue(expected.isel(time=[1, 5]).equals(actual))
+
+    def test_sparse(self):
+        values = [0, 1, 127, 128, 300, 2 ** 14, 2 ** 35]
+        packed = tinylib._pack_varints(values)
+        self.assertEqual(tinylib._unpack_varints(packed + 'x', 7),
+                         (values, len(packed)))
+        actual, offset = tinylib._unpack_varint_array('x' + packed, 7, 1)
+        np.testing.assert_array_equal(actual, values)
+        self.assertEqual(offset, len(packed) + 1)
+
+        np.random.seed(1982)
+        for shape in [(1, ), (10, 7), (3, 20, 30)]:
+            for density in [0., 0.1, 1.]:
+                bins = np.random.randint(1, 3, size=shape)
+                bins[np.random.uniform(size=shape) >= density] = 0
+                packed = tinylib.sparse_bins(bins, 3)
+                np.testing.assert_array_equal(
+                    tinylib.expand_sparse_bins(packed, shape, 3), bins)
+
+        # a mostly dry forecast
+        fcst = sample_forecast()
+        precip = fcst['precip'].values
+        precip[np.random.uniform(size=precip.shape) < 0.95] = 0.
+        expected = tinylib.from_beaufort(tinylib.to_beaufort(fcst))
+        for kwdargs in [{'indexed': True}, {'progressive': 2.}]:
+            raw = tinylib.to_beaufort(fcst, codec={'precip': 'raw'},
+                                      **kwdargs)
+            beaufort = tinylib.to_beaufort(fcst, **kwdargs)
+            self.assertLess(len(beaufort), len(raw))
+            self.assertTrue(expected.equals(tinylib.from_beaufort(beaufort)))
+        # but the original format, and wet forecasts, are still packed
+        for fcst in [fcst, sample_forecast()]:
+            packed = dict(tinylib.unstring_beaufort(zlib.decompress(
+                tinylib.to_beaufort(fcst))))
+            self.assertEqual(packed['precip']['codec'], 'raw')
+
+    def test_adaptive_tables(self):
+        for vname, divs in [('wind_speed', np.array([-1., 0., 5., 10.])),
+                            ('pressure', tinylib._pressure_scale),
+                            ('wind_dir', tinylib.compass_divs(8))]:
+            table = tinylib._pack_table(vname, divs)
+            actual, size = tinylib._unpack_table(vname, table + 'extra')
+            self.assertEqual(size, len(table))
+            np.testing.assert_array_equal(actual, divs)
+        np.testing.assert_array_equal(tinylib.compass_divs(16),
+                                      tinylib._direction_bins)
+
+        # a forecast in which pressure only spans a couple of the
+        # fixed bins.
+        fcst = sample_forecast()
+        y, x = np.mgrid[0:fcst.dims['latitude'], 0:fcst.dims['longitude']]
+        fcst['pressure'].values[:] = (101100. + 150. * np.sin(x / 6.) *
+                                      np.cos(y / 5.))
+        truth = fcst['pressure'].values.copy()
+
+        def error(payload):
+            actual = tinylib.from_beaufort(payload)['pressure'].values
+            return np.max(np.abs(actual - truth))
+
+        fixed = error(tinylib.to_beaufort(fcst.copy(deep=True)))
+        for indexed in [False, True]:
+            adaptive = tinylib.to_beaufort(fcst.copy(deep=True),
+                                           indexed=indexed, adaptive=True)
+            self.assertLess(error(adaptive), fixed / 4.)
+            # or fewer bits for similar precision
+            two_bits = tinylib.to_beaufort(fcst.copy(deep=True),
+                                           indexed=indexed,
+                                           adaptive={'pressure': 2})
+            self.assertLess(error(two_bits), fixed)
+            self.assertLess(len(two_bits), len(adaptive))
+        # the other variables are unaffected
+        expected = tinylib.from_beaufort(tinylib.to_beaufort(fcst))
+        actual = tinylib.from_beaufort(adaptive)
+        self.assertTrue(expected['wind_speed'].equals(actual['wind_speed']))
+        # and the tables also work with the other codecs
+        for codec in tinylib._codecs:
+            beaufort = tinylib.to_beaufort(fcst, codec=codec, adaptive=True)
+            self.assertTrue(actual.equals(tinylib.from_beaufort(beaufort)))
+        self.assertRaises(ValueError,
+                          lambda: tinylib.to_beaufort(
+                              fcst, adaptive=['precip']))
+        # directions can use fewer compass points and speeds more bits
+        beaufort = tinylib.to_beaufort(fcst, adaptive={'wind_dir': 3,
+                                                       'wind_speed': 5})
+        actual = tinylib.from_beaufort(beaufort)
+        speed, direction = tinylib.wind_speed_and_direction(
+            fcst['uwnd'].values, fcst['vwnd'].values)
+        self.assertEqual(np.unique(actual['wind_dir'].values).size, 8)
+        # from_beaufort converts the directions to degrees
+        diff = np.mod(np.radians(actual['wind_dir'].values) - direction +
+                      np.pi, 2 * np.pi) - np.pi
+        self.assertLessEqual(np.max(np.abs(diff)), np.pi / 8 + 1e-6)
+        self.assertLess(np.abs(actual['wind_speed'].values - speed).mean(),
+                        np.abs(expected['wind_speed'].values - speed).mean())
+        # but tables can't hold more than 7 bits worth of divs
+        for vname in ['wind_speed', 'wind_dir', 'pressure']:
+            for bits in [0, 8]:
+                self.assertRaises(ValueError, tinylib.to_beaufort, fcst,
+                                  adaptive={vname: bits})
+        # a variable without any values keeps the fixed divs
+        self.assertIsNone(tinylib.adaptive_divs([np.nan], 4, 10.))
+        fcst['pressure'].values[:] = np.nan
+        self.assertEqual(tinylib.to_beaufort(fcst, adaptive=True),
+                         tinylib.to_beaufort(fcst))
+
+    def test_large_forecasts(self):
+        # each of the binned variables takes more than 64KB
+        fcst = sample_forecast(n_time=20, n_ens=21, n_lat=25, n_lon=30)
+        beaufort = tinylib.to_beaufort(fcst)
+        self.assertEqual(tinylib.payload_version(beaufort),
+                         tinylib._CHUNKED_VERSION)
+        actual = tinylib.from_beaufort(beaufort)
+        # the variables are split into chunks of whole times.
+        chunks = list(tinylib.read_beaufort(StringIO(beaufort), 1000))
+        speeds = [info for vname, info in chunks if vname == 'wind_speed']
+        self.assertGreater(len(speeds), 1)
+        self.assertEqual(sum(info['ntimes'] for info in speeds), 20)
+        # which hold the same values as if each time were sent on its own
+        for i in [0, 11, 19]:
+            expected = tinylib.from_beaufort(
+                tinylib.to_beaufort(fcst.isel(time=[i])))
+            self.assertTrue(expected['wind_speed'].equals(
+                actual['wind_speed'].isel(time=[i])))
+            self.assertTrue(expected['pressure'].equals(
+                actual['pressure'].isel(time=[i])))
+        self.assertTrue(actual.equals(
+            tinylib.from_beaufort(tinylib.to_beaufort(fcst, indexed=True))))
+        subset = tinylib.from_beaufort(beaufort, variables=['wind'],
+                                       hours=[3, 30])
+        self.assertTrue(subset['uwnd'].equals(
+            actual['uwnd'].isel(time=[1, 10])))
+        beaufort = tinylib.to_beaufort(fcst, codec='zlib', adaptive=True)
+        self.assertEqual(tinylib.payload_version(beaufort),
+                         tinylib._CHUNKED_VERSION)
+        adaptive = tinylib.from_beaufort(beaufort)
+        self.assertTrue(actual['wind_speed'].equals(adaptive['wind_speed']))
+        # times which compress worse than the first (calm, so stored
+        # sparsely) get smaller chunks
+        fcst['uwnd'].values[:2] = 0.
+        fcst['vwnd'].values[:2] = 0.
+        speeds = tinylib._beaufort_fields(fcst)['wind_speed']
+        records = tinylib._chunked_field_records('wind_speed', speeds)
+        self.assertGreater(len(records), 1)
+        self.assertTrue(all(len(r) <= tinylib._MAX_RECORD_SIZE
+                            for r in records))
+        self.assertTrue(tinylib.from_beaufort(tinylib.to_beaufort(fcst))[
+            'wind_speed'].equals(tinylib.from_beaufort(tinylib.to_beaufort(
+                fcst, indexed=True))['wind_speed']))
+        # but small forecasts still fit in the original format
+        small = tinylib.to_beaufort(fcst.isel(time=[0], ens=[0]))
+        self.assertEqual(tinylib.payload_version(small), 1)
+
+    def test_land_mask(self):
+        np.random.seed(1982)
+        land = np.random.uniform(size=(12, 15)) < 0.1
+        packed = tinylib.small_land(land)
+        self.assertLess(len(packed), land.size / 8)
+        np.testing.assert_array_equal(
+            tinylib.expand_small_land(packed, land.shape), land)
+
+        # a coastal forecast which is 40% land
+        y, x = np.mgrid[0:12, 0:15]
+        land = (x + 2 * y) > 19
+        self.assertAlmostEqual(land.mean(), 0.4, places=1)
+        for n_ens, codec in [(None, None), (None, 'range'),
+                             (5, 'ensemble'), (5, 'median')]:
+            fcst = sample_forecast(n_ens=n_ens)
+            expected = tinylib.from_beaufort(
+                tinylib.to_beaufort(fcst.copy(deep=True), codec=codec))
+            for indexed in [False, True]:
+                beaufort = tinylib.to_beaufort(fcst.copy(deep=True),
+                                               indexed=indexed, codec=codec,
+                                               land=land)
+                self.assertLess(len(beaufort), 0.8 * len(tinylib.to_beaufort(
+                    fcst.copy(deep=True), indexed=indexed, codec=codec)))
+                actual = tinylib.from_beaufort(beaufort)
+                np.testing.assert_array_equal(actual['land'].values, land)
+                for v in ['uwnd', 'wind_dir', 'precip', 'pressure']:
+                    self.assertTrue(np.all(np.isnan(
+                        actual[v].values[..., land])))
+                    np.testing.assert_array_equal(
+                        actual[v].values[..., ~land],
+                        expected[v].values[..., ~land])
+                subset = tinylib.from_beaufort(beaufort, variables=['wind'],
+                                               hours=[3, 9])
+                self.assertTrue(subset['uwnd'].equals(
+                    actual['uwnd'].isel(time=[1, 3])))
+        # the mask can also be a variable of the forecast
+        fcst['land'] = (('latitude', 'longitude'), land)
+        self.assertEqual(tinylib.to_beaufort(fcst.copy(deep=True),
+                                             codec=codec),
+                         tinylib.to_beaufort(fcst.copy(deep=True),
+                                             codec=codec, land=land))
+        self.assertRaises(ValueError,
+                          lambda: tinylib.to_beaufort(fcst, land=land.T))
+
+    def test_joint_wind(self):
+        speeds, directions = tinylib.wind_codebook()
+        self.assertEqual(speeds.size, 201)
+        # calms have a single direction
+        self.assertEqual(np.sum(speeds == speeds.min()), 1)
+        packed = tinylib.tiny_wind(speeds, directions)
+        self.assertEqual(ord(packed[0]), tinylib._WIND_CODEBOOK)
+        actual = tinylib.expand_wind(packed, speeds.shape)
+        np.testing.assert_array_equal(actual[0], speeds)
+        np.testing.assert_array_equal(actual[1], directions)
+
+        # a smoothly varying wind field
+        fcst = sample_forecast(n_ens=3)
+        y, x = np.mgrid[0:12, 0:15]
+        for i, v in enumerate(['uwnd', 'vwnd']):
+            fcst[v].values[:] = (3. + i + 8. * np.sin(x / (7. + i)) *
+                                 np.cos(y / 5.) +
+                                 0.2 * fcst[v].values[:] / 8.)
+        fcst['uwnd'].values[0, 0, :2] = 0.1
+        expected = tinylib.from_beaufort(
+            tinylib.to_beaufort(fcst.copy(deep=True)))
+        light = expected['wind_speed'].values < tinylib._beaufort_scale[2]
+        self.assertTrue(np.any(light))
+        for indexed in [False, True]:
+            beaufort = tinylib.to_beaufort(fcst.copy(deep=True),
+                                           indexed=indexed, joint_wind=True)
+            self.assertLess(len(beaufort), len(tinylib.to_beaufort(
+                fcst.copy(deep=True), indexed=indexed, codec='range')))
+            actual = tinylib.from_beaufort(beaufort)
+            # the speeds, and the directions of all but the lightest
+            # winds, are the same as when stored separately
+            np.testing.assert_array_equal(actual['wind_speed'].values,
+                                          expected['wind_speed'].values)
+            np.testing.assert_array_equal(actual['wind_dir'].values[~light],
+                                          expected['wind_dir'].values[~light])
+            self.assertTrue(actual['pressure'].equals(expected['pressure']))
+            subset = tinylib.from_beaufort(beaufort, variables=['wind'],
+                                           hours=[3, 9])
+            self.assertTrue(subset['uwnd'].equals(
+                actual['uwnd'].isel(time=[1, 3])))
+        # which also works along with a land mask
+        beaufort = tinylib.to_beaufort(fcst.copy(deep=True), land=x > 12,
+                                       joint_wind=True)
+        masked = tinylib.from_beaufort(beaufort)
+        self.assertTrue(np.all(np.isnan(masked['uwnd'].values[..., x > 12])))
+        self.assertTrue(masked['uwnd'].isel(longitude=slice(0, 13)).equals(
+            actual['uwnd'].isel(longitude=slice(0, 13))))
+        packed = tinylib.to_beaufort(fcst.copy(deep=True), joint_wind=True)
+        variables = dict(tinylib.unstring_beaufort(zlib.decompress(packed)))
+        self.assertNotIn('wind_speed', variables)
+        self.assertNotIn('wind_dir', variables)
+
+    def test_progressive(self):
+        # a half degree forecast
+        fcst = sample_forecast(n_ens=2, n_lat=12, n_lon=15)
+        self.assertEqual(tinylib.progressive_strides(
+            fcst['latitude'].values, fcst['longitude'].values, 2.),
+            [4, 2, 1])
+        self.assertEqual(tinylib.progressive_strides([0., 1.], [0.], 0.5),
+                         [1])
+        y, x = np.mgrid[0:12, 0:15]
+        for kwargs in [{}, {'codec': 'range'}, {'land': x + y > 20},
+                       {'joint_wind': True, 'adaptive': True}]:
+            expected = tinylib.from_beaufort(
+                tinylib.to_beaufort(fcst.copy(deep=True), **kwargs))
+            beaufort = tinylib.to_beaufort(fcst.copy(deep=True),
+                                           progressive=2., **kwargs)
+            self.assertEqual(tinylib.payload_version(beaufort),
+                             tinylib._PROGRESSIVE_VERSION)
+            self.assertTrue(expected.equals(tinylib.from_beaufort(beaufort)))
+            subset = tinylib.from_beaufort(beaufort, variables=['wind'],
+                                           hours=[3, 9])
+            self.assertTrue(subset['uwnd'].equals(
+                expected['uwnd'].isel(time=[1, 3])))
+            # a truncated payload holds a coarser forecast
+            sizes = set()
+            for end in range(len(beaufort) // 8, len(beaufort), 97):
+                actual = tinylib.from_beaufort(beaufort[:end])
+                sizes.add(actual.dims['latitude'])
+                coarse = expected.sel(latitude=actual['latitude'],
+                                      longitude=actual['longitude'])
+                self.assertTrue(actual['uwnd'].equals(coarse['uwnd']))
+                self.assertTrue(actual['precip'].equals(coarse['precip']))
+            self.assertEqual(sizes, set([3, 6]))
+            for end in [1, 2, 4, 20]:
+                self.assertRaises(ValueError, tinylib.from_beaufort,
+                                  beaufort[:end])
+        self.assertRaises(ValueError,
+                          lambda: tinylib.to_beaufort(fcst, indexed=True,
+                                                      progressive=2.))
+
+    def test_beaufort_diff(self):
+        fcst = sample_forecast(n_time=8, n_ens=2)
+        y, x = np.mgrid[0:12, 0:15]
+        for kwargs in [{}, {'codec': 'range'}, {'land': x + y > 20},
+                       {'adaptive': True}]:
+            previous = tinylib.to_beaufort(
+                fcst.isel(time=slice(0, 6)).copy(deep=True), **kwargs)
+            # the next run is six hours later and changes a few winds
+            later = fcst.isel(time=slice(2, 8)).copy(deep=True)
+            later['uwnd'].values[:, :, :3, :3] += 5.
+            payload = tinylib.to_beaufort(later.copy(deep=True), **kwargs)
+            diff = tinylib.beaufort_diff(payload, previous)
+            self.assertLess(len(diff), len(payload) / 2)
+            rebuilt = tinylib.apply_beaufort_diff(previous, diff)
+            expected = tinylib.from_beaufort(payload)
+            self.assertTrue(expected.equals(tinylib.from_beaufort(rebuilt)))
+            # nothing has changed since the rebuilt payload
+            self.assertLess(len(tinylib.beaufort_diff(payload, rebuilt)),
+                            len(diff) / 4)
+            self.assertRaises(ValueError,
+                              lambda: tinylib.apply_beaufort_diff(payload,
+                                                                  diff))
+        other = tinylib.to_beaufort(fcst.isel(latitude=slice(1, None)))
+        self.assertRaises(ValueError,
+                          lambda: tinylib.beaufort_diff(other, previous))
+        joint = tinylib.to_beaufort(fcst.copy(deep=True), joint_wind=True)
+        self.assertRaises(ValueError,
+                          lambda: tinylib.beaufort_diff(joint, previous))
+
+    def test_decode_without_xray(self):
+        fcst = sample_forecast(n_ens=2)
+        y, x = np.mgrid[0:12, 0:15]
+        payloads = [tinylib.to_beaufort(fcst.copy(deep=True), **kwargs)
+                    for kwargs in [{}, {'indexed': True}, {'codec': 'range'},
+                                   {'land': x + y > 20}, {'progressive': 2.}]]
+        # decode the payloads in a python which can't import pandas or xray
+        script = '\n'.join([
+            "import sys, cPickle",
+            "sys.modules['pandas'] = sys.modules['xray'] = None",
+            "from sl.lib import tinylib",
+            "payloads = cPickle.load(sys.stdin)",
+            "decoded = [tinylib.beaufort_to_dict(p) for p in payloads]",
+            "cPickle.dump(decoded, sys.stdout, -1)"])
+        root = os.path.join(os.path.dirname(__file__), '..')
+        proc = subprocess.Popen([sys.executable, '-c', script], cwd=root,
+                                stdin=subprocess.PIPE,
+                                stdout=subprocess.PIPE)
+        out, _ = proc.communicate(cPickle.dumps(payloads, -1))
+        self.assertEqual(proc.returncode, 0)
+        for payload, decoded in zip(payloads, cPickle.loads(out)):
+            expected = tinylib.beaufort_to_dict(payload)
+            self.assertEqual(sorted(decoded), sorted(expected))
+            for k, v in expected.iteritems():
+                self.assertEqual(len(decoded[k]), len(v))
+                self.assertEqual(decoded[k][0], v[0])
+                np.testing.assert_array_equal(decoded[k][1], v[1])
+                self.assertEqual(decoded[k][2:], v[2:])
+
+
 if __name__ == "__main__":
     sys.exit(unittest.main())